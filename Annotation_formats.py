@@ -14,12 +14,20 @@ DEFAULT_ALLOWED_INACCURACY = 5
 DEFAULT_MINIMUM_OVERLAP = 5
 
 
-class GeneItem:
-    def __init__(self):
-        self.itemName = ''
-        self.start = 0
-        self.end = 0
-        self.frame = 0
+# Annotation classes use __slots__, since large annotation files contain hundreds of thousands of them
+# All slots are always set, so that they can be pickled using __getstate__ and __setstate__
+# Gene items are pickled as constructor arguments, which makes unpickling a lot faster
+class GeneItem(object):
+    __slots__ = ('itemName', 'start', 'end', 'frame')
+
+    def __init__(self, start = 0, end = 0, frame = 0, itemName = ''):
+        self.itemName = itemName
+        self.start = start
+        self.end = end
+        self.frame = frame
+
+    def __reduce__(self):
+        return (GeneItem, (self.start, self.end, self.frame, self.itemName))
 
     def getLength(self):
         return self.end - self.start
@@ -108,7 +116,9 @@ class GeneItem:
 
 
 
-class GeneDescription:
+class GeneDescription(object):
+    __slots__ = ('seqname', 'source', 'genename', 'transcriptname', 'strand', 'start', 'end', 'score', 'items', 'chromid')
+
     def __init__(self):
         self.seqname = ''
         self.source = ''
@@ -119,7 +129,14 @@ class GeneDescription:
         self.end = -1
         self.score = 0.0
         self.items = []
+        self.chromid = -1           # Chromosome id, set when annotations are loaded for evaluation
 
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for (name, value) in zip(self.__slots__, state):
+            setattr(self, name, value)
 
     def getLength(self):
         return self.end - self.start
@@ -190,22 +207,174 @@ class GeneDescription:
 
     # Check if annotation items are equal to another annotation
     def itemsEqual(self, otherGS):
-        items1 = sorted(self.items, key = lambda it: it.start)
-        items2 = sorted(otherGS.items, key = lambda it: it.start)
-
-        if len(items1) != len(items2):
-            return False
-
-        for i in xrange(len(items1)):
-            item1 = items1[i]
-            item2 = items2[i]
-            if item1.start != item2.start or item1.end != item2.end:
-                return False
-
-        return True
-
+        return self.itemsSignature() == otherGS.itemsSignature()
+
+    # Returns a hashable description of annotation items (a tuple of item starts and ends, ordered by start)
+    # Annotations with equal items have equal signatures
+    def itemsSignature(self):
+        return tuple(sorted((item.start, item.end) for item in self.items))
+
+
+# An index for quickly finding annotations that overlap a given interval
+# Overlap is determined in the same way as in GeneDescription.overlapsGene
+# Annotations are stored in an array sorted by start position. The array is treated as an
+# implicit binary tree (a node at index i on level k has children at i - 2^(k-1) and i + 2^(k-1)),
+# and each node holds the maximum end position in its subtree (the same layout as used by cgranges)
+# Building the index takes O(n log n) and a single query takes O(log n + k),
+# where k is the number of overlapping annotations
+class AnnotationIndex:
+    def __init__(self, annotations):
+        # Remembering original positions, so that the query results can be returned
+        # in the same order in which they appear in the original list
+        self.order = sorted(xrange(len(annotations)), key = lambda i: annotations[i].start)
+        self.annotations = [annotations[i] for i in self.order]
+        self.starts = [annotation.start for annotation in self.annotations]
+        self.ends = [annotation.end for annotation in self.annotations]
+        self.maxends = list(self.ends)
+        self.max_level = self.buildIndex()
+
+    def __len__(self):
+        return len(self.annotations)
+
+    # Calculates maximum end position for each node of the implicit tree
+    # Returns the level of the root node (-1 if the index is empty)
+    def buildIndex(self):
+        n = len(self.starts)
+        if n == 0:
+            return -1
+
+        ends = self.ends
+        maxends = self.maxends
+
+        # Leaves are at level 0 (even indices)
+        last_i = 0      # The rightmost node in the tree
+        last = 0        # Max end position at node last_i
+        for i in xrange(0, n, 2):
+            last_i = i
+            last = maxends[i] = ends[i]
+
+        # Processing internal nodes bottom up
+        k = 1
+        while (1 << k) <= n:
+            x = 1 << (k-1)
+            i0 = (x << 1) - 1
+            step = x << 2
+            for i in xrange(i0, n, step):
+                el = maxends[i - x]                         # Left child
+                er = maxends[i + x] if i + x < n else last  # Right child
+                e = ends[i]
+                if el > e:
+                    e = el
+                if er > e:
+                    e = er
+                maxends[i] = e
+            # Moving last_i to its parent
+            if (last_i >> k) & 1:
+                last_i -= x
+            else:
+                last_i += x
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+
+        return k - 1
+
+    # Returns indices (into self.annotations) of all annotations overlapping interval [startpos, endpos)
+    def findOverlappingIdx(self, startpos, endpos):
+        result = []
+        n = len(self.starts)
+        if n == 0:
+            return result
+
+        starts = self.starts
+        ends = self.ends
+        maxends = self.maxends
+
+        # Top down traversal, each stack element is (level, node index, left child processed)
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]
+        while stack:
+            k, x, leftdone = stack.pop()
+            if k <= 3:
+                # Small subtree, checking every node in it
+                i0 = x >> k << k
+                i1 = i0 + (1 << (k+1)) - 1
+                if i1 > n:
+                    i1 = n
+                i = i0
+                while i < i1 and starts[i] < endpos:
+                    if startpos < ends[i]:
+                        result.append(i)
+                    i += 1
+            elif not leftdone:
+                # Re-adding the node with the left child marked as processed
+                # and processing the left child first if it can contain an overlap
+                y = x - (1 << (k-1))
+                stack.append((k, x, True))
+                if y >= n or maxends[y] > startpos:
+                    stack.append((k-1, y, False))
+            elif x < n and starts[x] < endpos:
+                if startpos < ends[x]:
+                    result.append(x)
+                stack.append((k-1, x + (1 << (k-1)), False))
+
+        return result
+
+    # Returns all annotations overlapping interval [startpos, endpos)
+    # Annotations are returned in the same order as in the list the index was built from,
+    # so the result is the same as checking overlapsGene for each annotation in that list
+    def findOverlapping(self, startpos, endpos):
+        idxlist = self.findOverlappingIdx(startpos, endpos)
+        idxlist.sort(key = lambda i: self.order[i])
+        return [self.annotations[i] for i in idxlist]
+
+
+# Sweep line over annotations sorted according to start position, used to find annotations overlapping
+# a sequence of intervals (e.g. reads) ordered by position, without building an index
+# Annotations are taken from the input (which can be a generator) only when an interval reaches them,
+# and only annotations that can still overlap later intervals are kept in an active window.
+# Annotations are returned in the same order as in the input, as with AnnotationIndex
+class AnnotationSweep:
+    def __init__(self, annotations):
+        self.annotations = iter(annotations)
+        self.pending = next(self.annotations, None)     # The first annotation not yet in the active window
+        self.active = []
+        self.position = None        # Current position of the sweep line
+        self.minend = None          # Minimum end position of active annotations
+
+    # Moves the sweep line to a given position and removes annotations ending at or before it
+    # Later intervals must not start before this position
+    def advance(self, position):
+        if self.position is not None and position < self.position:
+            raise Exception('\nERROR: Sweep line can not move back (from %d to %d)!' % (self.position, position))
+        self.position = position
+        if self.minend is not None and self.minend <= position:
+            self.active = [annotation for annotation in self.active if annotation.end > position]
+            self.minend = min(annotation.end for annotation in self.active) if len(self.active) > 0 else None
+
+    # Returns all annotations overlapping interval [startpos, endpos)
+    # The interval must not start before the sweep line
+    def findOverlapping(self, startpos, endpos):
+        if self.position is not None and startpos < self.position:
+            raise Exception('\nERROR: Interval (%d, %d) starts before the sweep line (%d)!' % (startpos, endpos, self.position))
+
+        # Adding annotations that start before the end of the interval
+        while self.pending is not None and self.pending.start < endpos:
+            annotation = self.pending
+            self.pending = next(self.annotations, None)
+            if self.pending is not None and self.pending.start < annotation.start:
+                raise Exception('\nERROR: Annotations for the sweep line are not sorted according to start position (%s)!' % self.pending.genename)
+            if self.position is not None and annotation.end <= self.position:
+                continue
+            self.active.append(annotation)
+            if self.minend is None or self.minend > annotation.end:
+                self.minend = annotation.end
+
+        return [annotation for annotation in self.active if annotation.start < endpos and startpos < annotation.end]
+
+
+class GFFLine(object):
+    __slots__ = ('seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attribute')
 
-class GFFLine:
     def __init__(self):
         self.seqname = ''
         self.source = ''
@@ -268,15 +437,16 @@ def Annotation_From_GFF(gffline):
     genedscp.transcriptname = gffline.attribute['transcript_id'][1:-1]
 
     # constructing a single gene item (exon)
-    geneitem = GeneItem()
-    geneitem.frame = gffline.frame
-    geneitem.start = gffline.start
-    geneitem.end = gffline.end + 1
-    genedscp.items.append(geneitem)
+    genedscp.items.append(GeneItem_From_GFF(gffline))
 
     return genedscp
 
 
+# Constructs a gene item (exon) described by a GFF line
+def GeneItem_From_GFF(gffline):
+    return GeneItem(gffline.start, gffline.end + 1, gffline.frame)
+
+
 def Load_Annotation_From_File(filename, check_duplicates = False):
 
     fname, fext = os.path.splitext(filename)
@@ -302,25 +472,23 @@ def Load_Annotation_From_File(filename, check_duplicates = False):
         old_annt_name = ''
         curr_annt = None        # Current collected annotation
         for gffline in gff_lines:
-            new_annt = Annotation_From_GFF(gffline)
-            new_annt_name = new_annt.transcriptname
+            # Removing double quotes, as in Annotation_From_GFF
+            new_annt_name = gffline.attribute['transcript_id'][1:-1]
             if old_annt_name != new_annt_name:
                 if old_annt_name != '':
                     # Store the last collected annotation (calculate start and end position from items first)
                     curr_annt.calcBoundsFromItems()
                     annotations.append(curr_annt)
                 # Start a new collected annotation
-                curr_annt = new_annt
+                curr_annt = Annotation_From_GFF(gffline)
             else:
-                if new_annt.seqname != curr_annt.seqname or \
-                   new_annt.source != curr_annt.source or \
-                   new_annt.strand != curr_annt.strand or \
-                   new_annt.genename != curr_annt.genename or \
-                   new_annt.transcriptname != curr_annt.transcriptname:
+                # A new annotation is not created for lines of the same transcript, only a new item (exon)
+                if gffline.seqname != curr_annt.seqname or \
+                   gffline.source != curr_annt.source or \
+                   gffline.strand != curr_annt.strand or \
+                   gffline.attribute['gene_id'][1:-1] != curr_annt.genename:
                     raise Exception('Invalid GFF/GTF line for transcript %s' % new_annt_name)
-                # Assuming that new_annt has only one item
-                assert len(new_annt.items) == 1
-                curr_annt.items.append(new_annt.items[0])
+                curr_annt.items.append(GeneItem_From_GFF(gffline))
 
             old_annt_name = new_annt_name
 
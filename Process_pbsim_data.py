@@ -1,6 +1,9 @@
 #! /usr/bin/python
 
 import sys, os
+import itertools
+import collections
+import multiprocessing
 import paramsparser
 
 from datetime import datetime
@@ -11,6 +14,7 @@ sys.path.append(os.path.join(SCRIPT_PATH, 'samscripts/src'))
 import utility_sam
 import Annotation_formats
 import RNAseqEval
+import progress
 from report import EvalReport, ReportType
 from RNAseq_benchmark import benchmark_params
 
@@ -55,7 +59,11 @@ paramdefs = {'--version' : 0,
              '--alowed_inaccurycy' : 1,
              '-ai' : 1,
              '--min_overlap' : 1,
-             '-mo' : 1}
+             '-mo' : 1,
+             '--truth' : 1,
+             '-t' : 1,
+             '--threads' : 1,
+             '--status_file' : 1}
 
 # Obsolete
 def interval_equals(interval1, interval2, allowed_inacc = Annotation_formats.DEFAULT_ALLOWED_INACCURACY, min_overlap = Annotation_formats.DEFAULT_MINIMUM_OVERLAP):
@@ -79,134 +87,367 @@ def interval_overlaps(interval1, interval2, allowed_inacc = Annotation_formats.D
         return True
 
 
-def processData(datafolder, resultfile, annotationfile, paramdict):
-
-    split_qnames = False
-    filename = ''
-    if '--split-qnames' in paramdict:
-        split_qnames = True
-        filename = paramdict['--split-qnames'][0]
-
-    filename_correct = filename + '_correct.names'
-    filename_hitall = filename + '_hitall.names'
-    filename_hitone = filename + '_hitone.names'
-    filename_bad = filename + '_incorrect.names'
-    filename_unmapped = filename + '_unmapped.names'
-
-    printMap = False
-    filename_mapping = ''
-    if '--print_mapping' in paramdict:
-        filename_mapping = paramdict['--print_mapping'][0]
-        printMap = True
-
-    file_correct = None
-    file_hitall = None
-    file_hitone = None
-    file_bad = None
-    file_unmapped = None
-    folder = os.getcwd()
+# Reads a MAF file generated by pbsim and returns original positions of all simulated reads in it
+# For each query name, a tuple (start, length, strand, reference length) is stored, taken from
+# the reference line preceding the query (only the first occurrence of a query is used)
+def load_maf_positions(maf_path):
+    positions = {}
+    maf_startpos = maf_length = 0
+    maf_strand = '0'
+    maf_reflen = 0
+    with open(maf_path, 'rU') as maffile:
+        for line in maffile:
+            if line[0] == 's':
+                # Query name should be a second item, sequence (the last item) is not needed
+                elements = line.split(None, 6)
+                maf_qname = elements[1]
+                if maf_qname == 'ref':              # Have to remember data for the last reference before the actual read
+                    maf_startpos = int(elements[2])
+                    maf_length = int(elements[3])
+                    maf_strand = elements[4]
+                    maf_reflen = int(elements[5])
+                elif maf_qname not in positions:
+                    positions[maf_qname] = (maf_startpos, maf_length, maf_strand, maf_reflen)
+    return positions
+
+
+# Original positions of simulated reads, for each simulation folder and each MAF file in it
+# Each MAF file is read only once, when the first read simulated from it is looked up
+maf_positions_cache = {}
+
+# Returns the original position (see load_maf_positions) of a simulated read,
+# or None if the read can not be found in the MAF file
+def get_maf_position(simFilePath, simMafFileName, simQName):
+    folder_cache = maf_positions_cache.setdefault(simFilePath, {})
+    if simMafFileName not in folder_cache:
+        folder_cache[simMafFileName] = load_maf_positions(os.path.join(simFilePath, simMafFileName))
+    return folder_cache[simMafFileName].get(simQName)
+
+
+# Walks through all simulation folders and collects files simulated for each transcript
+# Returns a dictionary: simulation folder -> transcript number -> [gene name, ref file, fastq file, maf file]
+# Gene name is the header of the reference (.ref) file, missing fastq or maf files are stored as None
+def load_simulation_files(datafolder, simFileSuffix = 'sd'):
+    simulation_files = {}
+    for simFolder in set(simFolderDict.values()):
+        simFilePath = os.path.join(datafolder, simFolder)
+        folder_files = {}
+        simulation_files[simFolder] = folder_files
+        if not os.path.isdir(simFilePath):
+            continue
+
+        filenames = set(os.listdir(simFilePath))
+        for simRefFileName in filenames:
+            simFileName, ext = os.path.splitext(simRefFileName)
+            if ext != '.ref' or not simFileName.startswith(simFileSuffix + '_'):
+                continue
+            try:
+                simRefNumber = int(simFileName[len(simFileSuffix)+1:])
+            except ValueError:
+                continue
+
+            simSeqFileName = simFileName + '.fastq'
+            simMafFileName = simFileName + '.maf'
+            if simSeqFileName not in filenames:
+                simSeqFileName = None
+            if simMafFileName not in filenames:
+                simMafFileName = None
+
+            # Reading reference file
+            [headers, seqs, quals] = read_fastq(os.path.join(simFilePath, simRefFileName))
+            simGeneName = headers[0]
+            folder_files[simRefNumber] = [simGeneName, simRefFileName, simSeqFileName, simMafFileName]
+
+    return simulation_files
+
+
+# Parses the query name of a simulated read
+# Everything before the first underscore is the simulation folder short name (see simFolderDict)
+# and everything after that is simulated query name (S<transcript number>_<read number>)
+# Returns [simulation folder, simulated query name, transcript number]
+def parse_sim_qname(qname):
+    # Look for the first underscore in query name
+    pos = qname.find('_')
+    if pos < 0:
+        raise Exception('Invalid query name in results file (%s)!' % qname)
+
+    simFolderKey = qname[:pos]
+    if simFolderKey not in simFolderDict:
+        # import pdb
+        # pdb.set_trace()
+        raise Exception('Bad simulation folder short name (%s)!' % simFolderKey)
+    simFolder = simFolderDict[simFolderKey]
+    simQName = qname[pos+1:]
 
-    # If splittng qnames into files, have to open files first
-    if split_qnames:
-        file_correct = open(os.path.join(folder, filename_correct), 'w+')
-        file_hitall = open(os.path.join(folder, filename_hitall), 'w+')
-        file_hitone = open(os.path.join(folder, filename_hitone), 'w+')
-        file_bad = open(os.path.join(folder, filename_bad), 'w+')
+    # Due to error in data preparation, have to make some extra processing
+    if simQName[:6] == 'SimG2_':
+        simQName = simQName[6:]
 
-    # Loading results SAM file
-    report = EvalReport(ReportType.FASTA_REPORT)    # not really needed, used for unmapped query names
-    # Have to preserve the paramdict
-    # paramdict = {}
+    pos = simQName.find('_')
+    pos2 = simQName.find('_part')
+    if pos < 0:
+        raise Exception('Invalid simulated query name in results file (%s)!' % simQName)
 
-    sys.stderr.write('\n(%s) Loading and processing SAM file with mappings ... ' % datetime.now().time().isoformat())
-    all_sam_lines = RNAseqEval.load_and_process_SAM(resultfile, paramdict, report, BBMapFormat = True)
+    # BBMap separates a query into smaller parts he can manage
+    # Extends query with '_part_#', which has to be ignored
+    if pos2 <> -1:
+        simQName = simQName[:pos2]
 
+    simRefNumber = int(simQName[1:pos])
+    return [simFolder, simQName, simRefNumber]
 
-    # Reading annotation file
-    annotations = Annotation_formats.Load_Annotation_From_File(annotationfile)
 
-    s_num_multiexon_genes = 0
+# Finds the origin of a simulated read in the simulation data (see load_simulation_files)
+# Returns [gene name, original position of the read in the MAF file]
+def get_sim_origin(qname, datafolder, simulation_files, simFolder, simQName, simRefNumber):
+    simFilePath = os.path.join(datafolder, simFolder)
 
-    mapfile = None
-    if printMap:
-        mapfile = open(filename_mapping, 'w+')
+    # Gene name and simulation files are preloaded for each simulated transcript
+    folder_files = simulation_files.get(simFolder, {})
+    if simRefNumber not in folder_files:
+        # import pdb
+        # pdb.set_trace()
+        raise Exception('Reference file for simulated read %s does not exist!' % qname)
+    [simGeneName, simRefFileName, simSeqFileName, simMafFileName] = folder_files[simRefNumber]
+    if simSeqFileName is None:
+        # import pdb
+        # pdb.set_trace()
+        raise Exception('Sequence file for simulated read %s does not exist!' % qname)
+    if simMafFileName is None:
+        # import pdb
+        # pdb.set_trace()
+        raise Exception('Sequence alignment (MAF) for simulated read %s does not exist!' % qname)
 
-    # Hashing annotations according to name
-    annotation_dict = {}
-    for annotation in annotations:
-        if annotation.genename in annotation_dict:
-            sys.stderr.write('\nWARNING: anotation with name %s already in the dictionary!' % annotation.genename)
+    # Looking up original position and length of the simulated read in the MAF file
+    maf_position = get_maf_position(simFilePath, simMafFileName, simQName)
+    if maf_position is None:
+        # import pdb
+        # pdb.set_trace()
+        raise Exception('ERROR: could not find query %s in maf file %s' % (qname, simMafFileName))
+
+    return [simGeneName, maf_position]
+
+
+# Calculates expected partial alignments of a simulated read on the genome, from the original position
+# of the read on the transcript (see load_maf_positions) and the annotation used to generate the transcript
+# Returns a list of intervals (start, end), one for each exon covered by the read
+def calc_expected_partial_alignments(annotation, maf_position):
+    (maf_startpos, maf_length, maf_strand, maf_reflen) = maf_position
+
+    # IMPORTANT: If the reads were generated from an annotation on reverse strand
+    #            expected partial alignments must be reversed
+    if annotation.strand == Annotation_formats.GFF_STRANDRV:
+        maf_startpos = maf_reflen - maf_length - maf_startpos
+
+    # 1. Calculating the index of the first exon
+    # i - the index of exon currently being considered
+    i = 0
+    while annotation.items[i].getLength() < maf_startpos:
+        maf_startpos -= annotation.items[i].getLength()
+        i += 1
+
+    # Calculating expected partial alignments by filling up exons using maf_length
+    expected_partial_alignments = []
+    while maf_length > 0:
+        start = annotation.items[i].start + maf_startpos
+        end = annotation.items[i].end
+        assert start <= end
+
+        # OLD: length = end-start+1
+        # KK: End is already indicating position after the last base, so adding one when callculating length is not correct
+        length = end - start
+        if length <= maf_length:
+            expected_partial_alignments.append((start, end))
+            maf_length -= length
+            i += 1
         else:
-            annotation_dict[annotation.genename] = annotation
-        if len(annotation.items) > 1:
-            s_num_multiexon_genes += 1
-
-
-    # Statistical information for evaluating the qualitiy of mapping
-    s_gene_hits = 0
-    s_gene_misses = 0
-    s_whole_alignment_hits = 0
-    s_whole_alignment_misses = 0
-    s_partial_alignment_hits = 0
-    s_partial_alignment_misses = 0
-    s_num_start_hits = 0
-    s_num_end_hits = 0
-    s_num_start_end_hits = 0
-
-    s_num_fw_strand = 0
-    s_num_rv_strand = 0
-
-    s_num_split_alignment = 0
-    s_num_oversplit_alignment = 0       # Alignments that have more parts than exons
-
-    s_num_good_alignments = 0
-
-    s_num_badchrom_alignments = 0
-
-    s_maf_suspicious_alignments = 0
-    s_maf_bad_alignments = 0
-    s_maf_good_alignments = 0
-
-    s_maf_split_reads = 0
-    s_maf_good_split_alignments = 0
-    s_maf_bad_split_alignments = 0
+            expected_partial_alignments.append((start, start + maf_length))
+            maf_length = 0
+            i += 1
 
-    s_maf_hit_all_parts = 0
-    s_maf_hit_one_part = 0
-    s_maf_eq_one_part = 0
-    s_maf_multihit_parts = 0
+        # Start position should only be considered for the first exon
+        maf_startpos = 0
 
-    s_maf_split_hit_all_parts = 0
-    s_maf_split_hit_one_part = 0
-    s_maf_split_eq_one_part = 0
+    return expected_partial_alignments
 
-    s_maf_miss_alignment = 0
-    s_maf_too_many_alignments = 0
 
-    s_num_potential_bad_strand = 0
+# Truth file columns: simulation folder, simulated query name, gene name, chromosome, strand
+# and expected partial alignments, written as comma separated start-end intervals
+# Besides simulated reads, the truth file contains the number of annotations and multiexon genes
+# (TRUTH_ANNOTATIONS line) and the extent and exons of each gene used in the simulation (TRUTH_GENE lines),
+# so that reads can be compared to annotations without loading the annotations file
+TRUTH_HEADER = '#folder\tquery\tgene\tchromosome\tstrand\texpected_alignments\n'
+TRUTH_ANNOTATIONS = '@annotations'
+TRUTH_GENE = '@gene'
 
-    allowed_inacc = Annotation_formats.DEFAULT_ALLOWED_INACCURACY       # Allowing some shift in positions
-    min_overlap = Annotation_formats.DEFAULT_MINIMUM_OVERLAP       		# Minimum overlap that is considered
+def format_intervals(intervals):
+    return ','.join('%d-%d' % (start, end) for (start, end) in intervals)
 
-    # Setting allowed_inaccuracy from parameters
-    if '--allowed_inacc' in paramdict:
-        allowed_inacc = int(paramdict['--allowed_inacc'][0])
-    elif '-ai' in paramdict:
-        allowed_inacc = int(paramdict['-ai'][0])
+def parse_intervals(text):
+    intervals = []
+    for interval in text.split(','):
+        if interval != '':
+            [start, end] = interval.split('-')
+            intervals.append((int(start), int(end)))
+    return intervals
 
-    # Setting minimum overlap from parameters
-    if '--allowed_inacc' in paramdict:
-        min_overlap = int(paramdict['--allowed_inacc'][0])
-    elif '-mo' in paramdict:
-        min_overlap = int(paramdict['-mo'][0])
+# Walks through the simulation data once and writes the origin of each simulated read into a truth file
+# The truth file can then be used to evaluate any number of SAM files without reading the simulation data
+def build_truth(datafolder, annotationfile, truthfile):
+    sys.stderr.write('\n(%s) Loading annotations ... ' % datetime.now().time().isoformat())
+    annotations = Annotation_formats.Load_Annotation_From_File(annotationfile)
+    annotation_dict = {}
+    num_multiexon_genes = 0
+    for annotation in annotations:
+        if annotation.genename not in annotation_dict:
+            annotation_dict[annotation.genename] = annotation
+        if len(annotation.items) > 1:
+            num_multiexon_genes += 1
+
+    sys.stderr.write('\n(%s) Loading simulated transcripts ... ' % datetime.now().time().isoformat())
+    simulation_files = load_simulation_files(datafolder)
+
+    sys.stderr.write('\n(%s) Writing truth file ... ' % datetime.now().time().isoformat())
+    num_reads = 0
+    genes_written = set()
+    with open(truthfile, 'w') as tfile:
+        tfile.write(TRUTH_HEADER)
+        tfile.write('%s\t%d\t%d\n' % (TRUTH_ANNOTATIONS, len(annotation_dict), num_multiexon_genes))
+        for simFolder in sorted(simulation_files.keys()):
+            folder_files = simulation_files[simFolder]
+            simFilePath = os.path.join(datafolder, simFolder)
+            for simRefNumber in sorted(folder_files.keys()):
+                [simGeneName, simRefFileName, simSeqFileName, simMafFileName] = folder_files[simRefNumber]
+                if simMafFileName is None:
+                    continue
+                if simGeneName not in annotation_dict:
+                    sys.stderr.write('\nWARNING: annotation %s used for simulation %s not found!' % (simGeneName, os.path.join(simFilePath, simRefFileName)))
+                    continue
+                annotation = annotation_dict[simGeneName]
+
+                if simGeneName not in genes_written:
+                    exons = [(item.start, item.end) for item in annotation.items]
+                    tfile.write('%s\t%s\t%d-%d\t%s\n' % (TRUTH_GENE, simGeneName, annotation.start, annotation.end, format_intervals(exons)))
+                    genes_written.add(simGeneName)
+
+                maf_positions = load_maf_positions(os.path.join(simFilePath, simMafFileName))
+                for simQName in sorted(maf_positions.keys()):
+                    expected_partial_alignments = calc_expected_partial_alignments(annotation, maf_positions[simQName])
+                    tfile.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (simFolder, simQName, simGeneName, annotation.seqname, annotation.strand, format_intervals(expected_partial_alignments)))
+                    num_reads += 1
+
+    sys.stderr.write('\n(%s) Done, %d simulated reads written to %s\n' % (datetime.now().time().isoformat(), num_reads, truthfile))
+
+
+# Loads a truth file (see build_truth)
+# Returns [truth, genes, num_annotations, num_multiexon_genes], where truth is a dictionary
+# (simulation folder, simulated query name) -> [gene name, chromosome, strand, expected partial alignments]
+# and genes is a dictionary gene name -> annotation (only extent and exons are known)
+def load_truth(truthfile):
+    truth = {}
+    genes = {}
+    num_annotations = 0
+    num_multiexon_genes = 0
+    with open(truthfile, 'rU') as tfile:
+        for line in tfile:
+            if line[0] == '#':
+                continue
+            elements = line.rstrip('\r\n').split('\t')
+            if elements[0] == TRUTH_ANNOTATIONS:
+                num_annotations = int(elements[1])
+                num_multiexon_genes = int(elements[2])
+            elif elements[0] == TRUTH_GENE:
+                annotation = Annotation_formats.GeneDescription()
+                annotation.genename = elements[1]
+                [(annotation.start, annotation.end)] = parse_intervals(elements[2])
+                annotation.items = [Annotation_formats.GeneItem(start, end) for (start, end) in parse_intervals(elements[3])]
+                genes[annotation.genename] = annotation
+            elif len(elements) >= 6:
+                truth[(elements[0], elements[1])] = [elements[2], elements[3], elements[4], parse_intervals(elements[5])]
+
+    for [simGeneName, chromname, strand, expected_partial_alignments] in truth.itervalues():
+        if simGeneName not in genes:
+            raise Exception('\nERROR: gene %s not described in truth file %s, build the truth file again!' % (simGeneName, truthfile))
+
+    return [truth, genes, num_annotations, num_multiexon_genes]
+
+
+# Counters for statistical information on the quality of mapping of simulated reads
+# Counters are calculated separately for each shard of reads and then summed up
+SIM_COUNTERS = ['gene_hits', 'gene_misses', 'whole_alignment_hits', 'whole_alignment_misses',
+                'partial_alignment_hits', 'partial_alignment_misses',
+                'num_start_hits', 'num_end_hits', 'num_start_end_hits', 'num_fw_strand', 'num_rv_strand',
+                'num_split_alignment', 'num_oversplit_alignment', 'num_good_alignments', 'num_badchrom_alignments',
+                'maf_suspicious_alignments', 'maf_bad_alignments', 'maf_good_alignments',
+                'maf_split_reads', 'maf_good_split_alignments', 'maf_bad_split_alignments',
+                'maf_hit_all_parts', 'maf_hit_one_part', 'maf_eq_one_part', 'maf_multihit_parts',
+                'maf_split_hit_all_parts', 'maf_split_hit_one_part', 'maf_split_eq_one_part',
+                'maf_miss_alignment', 'maf_too_many_alignments', 'num_potential_bad_strand']
+
+# Query name categories, used when splitting query names into files (--split-qnames)
+SIM_QNAME_CATEGORIES = ['correct', 'hitall', 'hitone', 'bad']
+
+def new_sim_stats():
+    return {name: 0 for name in SIM_COUNTERS}
+
+def add_sim_stats(total, part):
+    for name in SIM_COUNTERS:
+        total[name] += part[name]
+
+
+# Name under which progress of the evaluation is reported (see progress.py)
+SIM_PROGRESS_PART = 'simulated reads'
+
+# Everything needed to evaluate simulated reads and the reads themselves (samline lists, one for each read)
+# They are set in the main process before worker processes are started (see init_sim_context),
+# so that forked workers inherit them and only shard ranges have to be sent to the workers
+sim_context = None
+sim_reads = None
+
+def init_sim_context(context, reads):
+    global sim_context, sim_reads
+    sim_context = context
+    sim_reads = reads
+
+
+# Evaluates a shard of simulated reads (reads from start to end, see init_sim_context) against their origins
+def eval_sim_reads(shard):
+    (start, end) = shard
+    return eval_sim_read_list(sim_reads[start:end])
+
+
+# Evaluates a list of simulated reads (samline lists, one for each read) against their origins
+# Returns [stats, qnames, mapping], where stats are counters (see SIM_COUNTERS), qnames is a dictionary
+# with lists of query names for each category (see SIM_QNAME_CATEGORIES) and mapping is a list of strings
+# describing actual and expected alignments (see --print_mapping)
+def eval_sim_read_list(reads):
+    paramdict = sim_context['paramdict']
+    datafolder = sim_context['datafolder']
+    annotation_dict = sim_context['annotation_dict']
+    resolver = sim_context['resolver']
+    chromnames = resolver.chromnames
+    truth = sim_context['truth']
+    truth_genes = sim_context['truth_genes']
+    simulation_files = sim_context['simulation_files']
+    allowed_inacc = sim_context['allowed_inacc']
+    min_overlap = sim_context['min_overlap']
+    split_qnames = sim_context['split_qnames']
+    printMap = sim_context['printMap']
+
+    stats = new_sim_stats()
+    qnames = {category: [] for category in SIM_QNAME_CATEGORIES}
+    mapping = []
+
+    progress.start_part(SIM_PROGRESS_PART)
 
     # All samlines in a list should have the same query name
-    for samline_list in all_sam_lines:
+    for samline_list in reads:
+        progress.add_reads()
         qname = samline_list[0].qname
 
         isSplitAlignment = False
         if len(samline_list) > 1:
-            s_num_split_alignment += 1
+            stats['num_split_alignment'] += 1
             isSplitAlignment = True
 
         # Checking the SAM file if all samlines in a list have the same qname
@@ -214,150 +455,27 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
             if samline.qname != qname:
                 sys.stderr.write('\nWARNING: two samlines in the same list with different query names (%s/%s)' % (qname, samline.qname))
 
-        # Look for the first underscore in query name
-        # Everything before that is the simulation folder name
-        # Everything after that is simulated query name
-        pos = qname.find('_')
-        if pos < 0:
-            raise Exception('Invalid query name in results file (%s)!' % qname)
-
-        simFolderKey = qname[:pos]
-        if simFolderKey not in simFolderDict:
-            # import pdb
-            # pdb.set_trace()
-            raise Exception('Bad simulation folder short name (%s)!' % simFolderKey)
-        simFolder = simFolderDict[simFolderKey]
-        simQName = qname[pos+1:]
-
-        # Due to error in data preparation, have to make some extra processing
-        if simQName[:6] == 'SimG2_':
-            simQName = simQName[6:]
-
-
-#        if simFolderKey == 'SimG1':
-#            simFileSuffix = 'g1'
-#        elif simFolderKey == 'SimG2':
-#            simFileSuffix = 'g2'
-#        elif simFolderKey == 'SimG3':
-#            simFileSuffix = 'g3'
-#        else:
-#            simFileSuffix = 'sd'
-
-        simFileSuffix = 'sd'
-
-
-        pos = simQName.find('_')
-        pos2 = simQName.find('_part')
-        if pos < 0:
-            raise Exception('Invalid simulated query name in results file (%s)!' % simQName)
-
-        simQLetter = simQName[0]       # Should always be S
-
-        # BBMap separates a query into smaller parts he can manage
-        # Extends query with '_part_#', which has to be ignored
-        if pos2 <> -1:
-            simQName = simQName[:pos2]
-
-        simRefNumber = int(simQName[1:pos])
-        simQNumber = int(simQName[pos+1:])
-        simFileName = simFileSuffix + '_%04d' % simRefNumber
-        simRefFileName = simFileName + '.ref'
-        simSeqFileName = simFileName + '.fastq'
-        simMafFileName = simFileName + '.maf'
-
-        simFilePath = os.path.join(datafolder, simFolder)
-        simRefFilePath = os.path.join(simFilePath, simRefFileName)
-        simSeqFilePath = os.path.join(simFilePath, simSeqFileName)
-        simMafFilePath = os.path.join(simFilePath, simMafFileName)
-
-        if not os.path.exists(simRefFilePath):
-            # import pdb
-            # pdb.set_trace()
-            raise Exception('Reference file for simulated read %s does not exist!' % qname)
-        if not os.path.exists(simSeqFilePath):
-            # import pdb
-            # pdb.set_trace()
-            raise Exception('Sequence file for simulated read %s does not exist!' % qname)
-        if not os.path.exists(simMafFilePath):
-            # import pdb
-            # pdb.set_trace()
-            raise Exception('Sequence alignment (MAF) for simulated read %s does not exist!' % qname)
-
-        # Reading reference file
-        [headers, seqs, quals] = read_fastq(simRefFilePath)
-        simGeneName = headers[0]
-        annotation = annotation_dict[simGeneName]       # Getting the correct annotation
+        # Determining the annotation, chromosome, strand and the correct (expected) partial alignments for the read
+        [simFolder, simQName, simRefNumber] = parse_sim_qname(qname)
+        if truth is not None:
+            if (simFolder, simQName) not in truth:
+                raise Exception('Simulated read %s not found in truth file!' % qname)
+            [simGeneName, chromname, strand, expected_partial_alignments] = truth[(simFolder, simQName)]
+            annotation = truth_genes[simGeneName]           # Gene extent and exons from the truth file
+            # Streamed reads are resolved here, so that all chromosome ids come from the same resolver
+            chromid = resolver.getChromId(chromname)
+            for samline in samline_list:
+                samline.chromid = resolver.getChromId(samline.rname)
+        else:
+            [simGeneName, maf_position] = get_sim_origin(qname, datafolder, simulation_files, simFolder, simQName, simRefNumber)
+            annotation = annotation_dict[simGeneName]       # Getting the correct annotation
+            chromid = annotation.chromid
+            strand = annotation.strand
+            expected_partial_alignments = calc_expected_partial_alignments(annotation, maf_position)
 
         if len(samline_list) > len(annotation.items):
             # sys.stderr.write('\nWARNING: A number of partial alignments exceeds the number of exons for query %s! (%d / %d)' % (qname, len(samline_list), len(annotation.items)))
-            s_num_oversplit_alignment += 1
-
-        # Reading MAF file to get original position and length of the simulated read
-        # Query name should be a second item
-        maf_startpos = maf_length = 0
-        maf_strand = '0'
-        maf_reflen = 0
-        i = 0
-        with open(simMafFilePath, 'rU') as maffile:
-            i += 1
-            for line in maffile:
-                if line[0] == 's':
-                    elements = line.split()
-                    maf_qname = elements[1]
-                    if maf_qname == 'ref':              # Have to remember data for the last reference before the actual read
-                        maf_startpos = int(elements[2])
-                        maf_length = int(elements[3])
-                        maf_strand = elements[4]
-                        maf_reflen = int(elements[5])
-                    if maf_qname == simQName:
-                        # maf_startpos = int(elements[2])
-                        # maf_length = int(elements[3])
-                        break
-
-        if maf_qname != simQName:
-            # import pdb
-            # pdb.set_trace()
-            raise Exception('ERROR: could not find query %s in maf file %s' % (qname, simMafFileName))
-
-        # IMPORTANT: If the reads were generated from an annotation on reverse strand
-        #            expected partial alignments must be reversed
-        if annotation.strand == Annotation_formats.GFF_STRANDRV:
-            maf_startpos = maf_reflen - maf_length - maf_startpos
-
-        # Saving "maf_length" and "maf_startpos" to be able to check it later
-        t_maf_length = maf_length
-        t_maf_startpos = maf_startpos
-
-        # Calculating expected partial alignmetns from MAF and annotations
-
-        # 1. Calculating the index of the first exon
-        # i - the index of exon currently being considered
-        i = 0
-        while annotation.items[i].getLength() < maf_startpos:
-            maf_startpos -= annotation.items[i].getLength()
-            i += 1
-
-        # Calculating expected partial alignments by filling up exons using maf_length
-        expected_partial_alignments = []
-        while maf_length > 0:
-            start = annotation.items[i].start + maf_startpos
-            end = annotation.items[i].end
-            assert start <= end
-            
-            # OLD: length = end-start+1
-            # KK: End is already indicating position after the last base, so adding one when callculating length is not correct
-            length = end - start
-            if length <= maf_length:
-                expected_partial_alignments.append((start, end))
-                maf_length -= length
-                i += 1
-            else:
-                expected_partial_alignments.append((start, start + maf_length))
-                maf_length = 0
-                i += 1
-
-            # Start position should only be considered for the first exon
-            maf_startpos = 0
+            stats['num_oversplit_alignment'] += 1
 
         # import pdb
         # pdb.set_trace()
@@ -370,7 +488,7 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
 
         isSplitRead = False
         if len(expected_partial_alignments) > 1:
-            s_maf_split_reads += 1
+            stats['maf_split_reads'] += 1
             isSplitRead = True
 
         oneHit = False
@@ -380,14 +498,14 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
         good_alignment = False
         has_miss_alignments = False
 
-        if RNAseqEval.getChromName(samline_list[0].rname) != RNAseqEval.getChromName(annotation.seqname):
+        if samline_list[0].chromid != chromid:
             # import pdb
             # pdb.set_trace()
-            s_num_badchrom_alignments += 1
+            stats['num_badchrom_alignments'] += 1
         else:
             if len(samline_list) != len(expected_partial_alignments):
             # sys.stderr.write('\nWARNING: suspicious number of alignments for query %s!' % qname)
-                s_maf_suspicious_alignments += 1
+                stats['maf_suspicious_alignments'] += 1
             # import pdb
             # pdb.set_trace()
 
@@ -396,7 +514,7 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
             for samline in samline_list:
                 # sl_startpos = samline.pos - 1   # SAM positions are 1-based
                 sl_startpos = samline.pos
-                reflength = samline.CalcReferenceLengthFromCigar()
+                reflength = RNAseqEval.get_compact_cigar(samline).reflength
                 sl_endpos = sl_startpos + reflength
 
                 # Comparing a samline to the corresponding expected partial alignment
@@ -428,7 +546,7 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
                 overlap = False
                 for samline in samline_list:
                     sl_startpos = samline.pos
-                    reflength = samline.CalcReferenceLengthFromCigar()
+                    reflength = RNAseqEval.get_compact_cigar(samline).reflength
                     sl_endpos = sl_startpos + reflength
                     if interval_overlaps((sl_startpos, sl_endpos), (maf_startpos, maf_endpos), allowed_inacc, min_overlap):
                         overlap = True
@@ -437,7 +555,7 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
                     break
 
             if len(samline_list) < len(expected_partial_alignments):
-                s_maf_too_many_alignments += 1
+                stats['maf_too_many_alignments'] += 1
 
             # Testing the evaluation process
             # import pdb
@@ -446,28 +564,28 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
                 good_alignment = False
 
             if good_alignment:
-                s_maf_good_alignments += 1
+                stats['maf_good_alignments'] += 1
 
                 # Writting qnames to files
                 if split_qnames:
-                    file_correct.write(samline_list[0].qname + '\n')
+                    qnames['correct'].append(samline_list[0].qname)
 
                 if isSplitRead:
-                    s_maf_good_split_alignments += 1
+                    stats['maf_good_split_alignments'] += 1
             else:
                 # import pdb
                 # pdb.set_trace()
-                s_maf_bad_alignments += 1
+                stats['maf_bad_alignments'] += 1
                 if isSplitRead:
-                    s_maf_bad_split_alignments += 1
+                    stats['maf_bad_split_alignments'] += 1
                 # TODO: check which alignments are bad and why
                 # If the choromosome is different its obviously a bad alignment
-                if RNAseqEval.getChromName(samline.rname) == RNAseqEval.getChromName(annotation.seqname):
+                if samline.chromid == chromid:
                     # import pdb
                     # pdb.set_trace()
                     pass
                 else:
-                    s_num_badchrom_alignments += 1
+                    stats['num_badchrom_alignments'] += 1
 
 
             # Analyzing parthitmap and parteqmap
@@ -493,29 +611,29 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
                 status = 'HITALL'
             elif oneHit:
                 status = 'HITONE'
-            mapfile.write('QNAME: %s, STATUS: %s\n\n' % (samline_list[0].qname, status))
-            mapfile.write('EXPECTED (%s, %s):\t' % (RNAseqEval.getChromName(annotation.seqname), annotation.strand))
+            mapping.append('QNAME: %s, STATUS: %s\n\n' % (samline_list[0].qname, status))
+            mapping.append('EXPECTED (%s, %s):\t' % (chromnames[chromid], strand))
             for epa in expected_partial_alignments:
-                mapfile.write('(%d, %d)\t' % (epa[0], epa[1]))
-            mapfile.write('\n')
+                mapping.append('(%d, %d)\t' % (epa[0], epa[1]))
+            mapping.append('\n')
             if samline_list[0].flag & 16 == 0:
                 readstrand = Annotation_formats.GFF_STRANDFW
             else:
                 readstrand = Annotation_formats.GFF_STRANDRV
-            mapfile.write('ACTUAL   (%s, %s):\t' % (RNAseqEval.getChromName(samline_list[0].rname), readstrand))
+            mapping.append('ACTUAL   (%s, %s):\t' % (chromnames[samline_list[0].chromid], readstrand))
             for samline in samline_list:
-                mapfile.write('(%d, %d)\t' % (samline.pos, samline.pos + samline.CalcReferenceLengthFromCigar()))
-            mapfile.write('\n\n')
+                mapping.append('(%d, %d)\t' % (samline.pos, samline.pos + RNAseqEval.get_compact_cigar(samline).reflength))
+            mapping.append('\n\n')
 
 
         if oneHit:
-            s_maf_hit_one_part += 1
+            stats['maf_hit_one_part'] += 1
             if isSplitRead:
-                s_maf_split_hit_one_part += 1
+                stats['maf_split_hit_one_part'] += 1
 
             # Writting qnames to files
             if split_qnames:
-                file_hitone.write(samline_list[0].qname + '\n')
+                qnames['hitone'].append(samline_list[0].qname)
 
             if not allHits:
                 if '--debug' in paramdict:
@@ -524,25 +642,25 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
 
             # Misses are calculated only for alignments that have at least one hit
             if has_miss_alignments:
-                s_maf_miss_alignment += 1
+                stats['maf_miss_alignment'] += 1
 
         else:
             # Writting qnames to files
             if split_qnames:
-                file_bad.write(samline_list[0].qname + '\n')
+                qnames['bad'].append(samline_list[0].qname)
 
             # if '--debug' in paramdict:
             #     import pdb
             #     pdb.set_trace()
 
         if allHits:
-            s_maf_hit_all_parts += 1
+            stats['maf_hit_all_parts'] += 1
             if isSplitRead:
-                s_maf_split_hit_all_parts += 1
+                stats['maf_split_hit_all_parts'] += 1
 
             # Writting qnames to files
             if split_qnames:
-                file_hitall.write(samline_list[0].qname + '\n')
+                qnames['hitall'].append(samline_list[0].qname)
 
         # Sanity check
         if '--debug' in paramdict and good_alignment and not allHits:
@@ -551,11 +669,11 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
             pass
 
         if oneEq:
-            s_maf_eq_one_part += 1
+            stats['maf_eq_one_part'] += 1
             if isSplitRead:
-                s_maf_split_eq_one_part += 1
+                stats['maf_split_eq_one_part'] += 1
         if multiHit:
-            s_maf_multihit_parts += 1
+            stats['maf_multihit_parts'] += 1
 
         num_start_hits = 0
         num_end_hits = 0
@@ -565,26 +683,24 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
         whole_alignment_hit = False
         for samline in samline_list:
             startpos = samline.pos - 1
-            reflength = samline.CalcReferenceLengthFromCigar()
+            reflength = RNAseqEval.get_compact_cigar(samline).reflength
             endpos = startpos + reflength
 
             if samline.flag & 16 == 0:
                 readstrand = Annotation_formats.GFF_STRANDFW
-                s_num_fw_strand += 1
+                stats['num_fw_strand'] += 1
             else:
                 readstrand = Annotation_formats.GFF_STRANDRV
-                s_num_rv_strand += 1
-
-            chromname = RNAseqEval.getChromName(samline.rname)
+                stats['num_rv_strand'] += 1
 
-            if chromname == RNAseqEval.getChromName(annotation.seqname) and readstrand != annotation.strand and annotation.overlapsGene(startpos, endpos):
-                s_num_potential_bad_strand += 1
+            if samline.chromid == chromid and readstrand != strand and annotation.overlapsGene(startpos, endpos):
+                stats['num_potential_bad_strand'] += 1
 
-            if chromname == RNAseqEval.getChromName(annotation.seqname) and annotation.overlapsGene(startpos, endpos) and (not P_CHECK_STRAND or readstrand == annotation.strand):
+            if samline.chromid == chromid and annotation.overlapsGene(startpos, endpos) and (not P_CHECK_STRAND or readstrand == strand):
                 whole_alignment_hit = True
-                s_partial_alignment_hits += 1
+                stats['partial_alignment_hits'] += 1
             else:
-                s_partial_alignment_misses +=1
+                stats['partial_alignment_misses'] += 1
 
             # Checking how well partial alignments match exons
             startsItem = False
@@ -599,61 +715,299 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
                     num_end_hits += 1
                     endsItem = True
                 if startsItem and endsItem:
-                    s_num_start_end_hits += 1
+                    stats['num_start_end_hits'] += 1
 
-        s_num_start_hits += num_start_hits
-        s_num_end_hits += num_end_hits
+        stats['num_start_hits'] += num_start_hits
+        stats['num_end_hits'] += num_end_hits
 
         # I'm allowing one start and one end not to match starts and ends of exons
         if (num_hits == num_partial_alignements) and (num_start_hits + num_end_hits >= 2*num_partial_alignements - 2) :
-            s_num_good_alignments += 1
+            stats['num_good_alignments'] += 1
         # else:
         #     if num_hits > 0:
         #         import pdb
         #         pdb.set_trace()
 
         if whole_alignment_hit:
-            s_whole_alignment_hits += 1
+            stats['whole_alignment_hits'] += 1
         else:
-            s_whole_alignment_misses += 1
+            stats['whole_alignment_misses'] += 1
 
-    if printMap:
-        mapfile.close()
+    progress.flush()
+    return [stats, qnames, mapping]
+
+
+# Reads a SAM file grouped according to query names (see RNAseqEval.stream_SAM_groups) and yields the SAM lines
+# of one simulated read at a time. As in RNAseqEval.load_and_process_SAM with BBMapFormat, alignments of queries
+# split into parts by BBMap ('_part_#' added to the query name) are joined, parts must be in consecutive lines
+def stream_sim_groups(sam_file, sam_counts):
+    group = []
+    group_qname = None
+    for samline_list in RNAseqEval.stream_SAM_groups(sam_file, sam_counts):
+        qname = samline_list[0].qname
+        pos = qname.find('_part')
+        if pos > -1:
+            qname = qname[:pos]
+        if qname != group_qname and len(group) > 0:
+            yield group
+            group = []
+        group += samline_list
+        group_qname = qname
+
+    if len(group) > 0:
+        yield group
+
+
+# Streams simulated reads from a SAM file (see stream_sim_groups) and yields them in batches of batch_size reads
+# Reads are processed as in RNAseqEval.load_and_process_SAM and SAM file statistics are set in the report
+# If a file for unmapped query names is given, names are written to it before each batch is yielded
+def stream_sim_batches(sam_file, report, file_unmapped, batch_size):
+    save_qnames = False
+    if file_unmapped is not None:
+        save_qnames = True
+
+    num_reads = 0
+    num_real_split = 0
+    sam_counts = {}
+    batch = []
+    for samline_list in stream_sim_groups(sam_file, sam_counts):
+        samline_list = RNAseqEval.process_SAM_group(samline_list, report, save_qnames)
+        if samline_list is None:
+            continue
+
+        num_reads += 1
+        if len(samline_list) > 1:
+            num_real_split += 1
+        batch.append(samline_list)
+        if len(batch) >= batch_size:
+            if save_qnames:
+                report.write_unmapped_names(file_unmapped)
+                report.unmapped_names = []
+            yield batch
+            batch = []
+
+    if save_qnames:
+        report.write_unmapped_names(file_unmapped)
+        report.unmapped_names = []
+    if len(batch) > 0:
+        yield batch
+
+    report.num_alignments = sam_counts['num_lines']
+    report.num_unique_alignments = sam_counts['num_unique_lines']
+    report.num_real_alignments = num_reads
+    report.num_real_split_alignments = num_real_split
+    report.num_non_alignments = report.num_alignments - num_reads
+
+
+# Evaluates batches of reads (see eval_sim_read_list) in a pool of worker processes, or in this process
+# if pool is None, and yields the results in the order of batches
+# At most max_pending batches are waiting for evaluation at any time, so the SAM file is never fully in memory
+def eval_sim_batches(batches, pool, max_pending):
+    if pool is None:
+        for batch in batches:
+            yield eval_sim_read_list(batch)
+        return
+
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(pool.apply_async(eval_sim_read_list, (batch,)))
+        while len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def processData(datafolder, resultfile, annotationfile, paramdict):
+
+    split_qnames = False
+    filename = ''
+    if '--split-qnames' in paramdict:
+        split_qnames = True
+        filename = paramdict['--split-qnames'][0]
+
+    filename_correct = filename + '_correct.names'
+    filename_hitall = filename + '_hitall.names'
+    filename_hitone = filename + '_hitone.names'
+    filename_bad = filename + '_incorrect.names'
+    filename_unmapped = filename + '_unmapped.names'
+
+    printMap = False
+    filename_mapping = ''
+    if '--print_mapping' in paramdict:
+        filename_mapping = paramdict['--print_mapping'][0]
+        printMap = True
+
+    file_correct = None
+    file_hitall = None
+    file_hitone = None
+    file_bad = None
+    file_unmapped = None
+    folder = os.getcwd()
 
-    # Writting unmapped query names to a file, if so specified
+    # If splittng qnames into files, have to open files first
     if split_qnames:
-        with open(filename_unmapped, 'w+') as file_unmapped:
-            file_unmapped.write(report.get_unmapped_names())
-            file_unmapped.close()
+        file_correct = open(os.path.join(folder, filename_correct), 'w+')
+        file_hitall = open(os.path.join(folder, filename_hitall), 'w+')
+        file_hitone = open(os.path.join(folder, filename_hitone), 'w+')
+        file_bad = open(os.path.join(folder, filename_bad), 'w+')
+        file_unmapped = open(filename_unmapped, 'w+')
+
+    report = EvalReport(ReportType.FASTA_REPORT)    # not really needed, used for unmapped query names
+    # Have to preserve the paramdict
+    # paramdict = {}
+
+    mapfile = None
+    if printMap:
+        mapfile = open(filename_mapping, 'w+')
+
+    # Chromosome names are resolved only once for each annotation (and for each alignment while loading SAM file)
+    # and are later compared using chromosome ids
+    resolver = RNAseqEval.getChromResolver()
+
+    # Read origins (and the genes they were simulated from) are taken from a truth file if it is given
+    # (see build-truth mode), and the SAM file is then streamed and joined with the truth file.
+    # Otherwise the SAM file and the annotations are loaded and origins are calculated from the simulation data
+    truth = None
+    truth_genes = None
+    annotation_dict = None
+    simulation_files = None
+    all_sam_lines = None
+    if '--truth' in paramdict:
+        if annotationfile is not None:
+            sys.stderr.write('\nWARNING: annotations are read from the truth file, ignoring annotations file %s!' % annotationfile)
+        truthfile = paramdict['--truth'][0]
+        sys.stderr.write('\n(%s) Loading truth file ... ' % datetime.now().time().isoformat())
+        [truth, truth_genes, num_annotations, s_num_multiexon_genes] = load_truth(truthfile)
+    else:
+        if annotationfile is None:
+            raise Exception('\nERROR: annotations file is required, unless a truth file is given (option --truth)!')
+
+        # Loading results SAM file
+        sys.stderr.write('\n(%s) Loading and processing SAM file with mappings ... ' % datetime.now().time().isoformat())
+        all_sam_lines = RNAseqEval.load_and_process_SAM(resultfile, paramdict, report, BBMapFormat = True)
+
+        # Writting unmapped query names to a file, if so specified
+        if split_qnames:
+            report.write_unmapped_names(file_unmapped)
+
+        # Reading annotation file
+        annotations = Annotation_formats.Load_Annotation_From_File(annotationfile)
+
+        s_num_multiexon_genes = 0
+
+        # Hashing annotations according to name
+        annotation_dict = {}
+        for annotation in annotations:
+            annotation.chromid = resolver.getChromId(annotation.seqname)
+            if annotation.genename in annotation_dict:
+                sys.stderr.write('\nWARNING: anotation with name %s already in the dictionary!' % annotation.genename)
+            else:
+                annotation_dict[annotation.genename] = annotation
+            if len(annotation.items) > 1:
+                s_num_multiexon_genes += 1
+        num_annotations = len(annotation_dict)
+
+        sys.stderr.write('\n(%s) Loading simulated transcripts ... ' % datetime.now().time().isoformat())
+        simulation_files = load_simulation_files(datafolder)
+
+
+    # Allowed inaccuracy and minimum overlap, from parameters or defaults
+    [allowed_inacc, min_overlap] = RNAseqEval.get_tolerances(paramdict)
+
+    # Reads are evaluated in a single process, unless the number of processes is given
+    num_threads = 1
+    if '-t' in paramdict or '--threads' in paramdict:
+        num_threads = min(RNAseqEval.getNumThreads(paramdict), multiprocessing.cpu_count())
+    if '--debug' in paramdict:
+        num_threads = 1
+
+    context = {'paramdict' : paramdict,
+               'datafolder' : datafolder,
+               'annotation_dict' : annotation_dict,
+               'resolver' : resolver,
+               'truth' : truth,
+               'truth_genes' : truth_genes,
+               'simulation_files' : simulation_files,
+               'allowed_inacc' : allowed_inacc,
+               'min_overlap' : min_overlap,
+               'split_qnames' : split_qnames,
+               'printMap' : printMap}
+
+    monitor = progress.ProgressMonitor(RNAseqEval.get_status_file(paramdict))
+    init_sim_context(context, all_sam_lines)
+    pool = None
+    if num_threads > 1:
+        pool = multiprocessing.Pool(processes = num_threads, initializer = progress.init_worker, initargs = (monitor.queue,))
+    else:
+        progress.init_worker(monitor.queue)
+
+    if truth is not None:
+        # Reads are sent to worker processes in batches while the SAM file is being read,
+        # batches are processed in order so that output files are the same as with one process
+        sys.stderr.write('\n(%s) Streaming SAM file with mappings and evaluating it using %d processes ... ' % (datetime.now().time().isoformat(), num_threads))
+        batches = stream_sim_batches(resultfile, report, file_unmapped, RNAseqEval.STREAM_UNIT_READS)
+        shard_results = eval_sim_batches(batches, pool, num_threads * RNAseqEval.MAX_PENDING_UNITS_PER_PROCESS)
+        monitor.start(resultfile)
+    else:
+        # Reads are split into shards of consecutive reads (sorted according to position) and evaluated
+        # in worker processes, shards are processed in order so that output files are the same as with one process
+        shard_size = RNAseqEval.get_work_unit_size(len(all_sam_lines), num_threads)
+        shards = [(i, min(i + shard_size, len(all_sam_lines))) for i in xrange(0, len(all_sam_lines), shard_size)]
+        sys.stderr.write('\n(%s) Evaluating %d reads in %d shards using %d processes ... ' % (datetime.now().time().isoformat(), len(all_sam_lines), len(shards), num_threads))
+        if pool is None:
+            shard_results = itertools.imap(eval_sim_reads, shards)
+        else:
+            shard_results = pool.imap(eval_sim_reads, shards)
+        monitor.start(resultfile, {SIM_PROGRESS_PART : len(all_sam_lines)})
+
+    stats = new_sim_stats()
+    qname_files = {'correct' : file_correct, 'hitall' : file_hitall, 'hitone' : file_hitone, 'bad' : file_bad}
+    for [shard_stats, shard_qnames, shard_mapping] in shard_results:
+        add_sim_stats(stats, shard_stats)
+        if split_qnames:
+            for category in SIM_QNAME_CATEGORIES:
+                for qname in shard_qnames[category]:
+                    qname_files[category].write(qname + '\n')
+        if printMap:
+            mapfile.write(''.join(shard_mapping))
+    monitor.stop()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if printMap:
+        mapfile.close()
 
     # Printing out results : NEW
     # Variables names matching RNA benchmark paper
     sys.stdout.write('\n\nAnalysis results:')
     sys.stdout.write('\nOriginal Samlines: %d' % report.num_alignments)
-    sys.stdout.write('\nUsable whole alignments (with valid CIGAR string): %d' % len(all_sam_lines))
-    sys.stdout.write('\nAnnotations: %d' % len(annotation_dict))
+    sys.stdout.write('\nUsable whole alignments (with valid CIGAR string): %d' % report.num_real_alignments)
+    sys.stdout.write('\nAnnotations: %d' % num_annotations)
     sys.stdout.write('\nMultiexon genes: %d' % s_num_multiexon_genes)
 
-    sys.stdout.write('\nNumber of exon start hits: %d' % s_num_start_hits)
-    sys.stdout.write('\nNumber of exon end hits: %d' % s_num_end_hits)
-    sys.stdout.write('\nNumber of exon start and end hits: %d' % s_num_start_end_hits)
-    sys.stdout.write('\nNumber of good whole alignments: %d' % s_num_good_alignments)
-    sys.stdout.write('\nNumber of alignments mapped to an incorrect chromosome: %d' % s_num_badchrom_alignments)
+    sys.stdout.write('\nNumber of exon start hits: %d' % stats['num_start_hits'])
+    sys.stdout.write('\nNumber of exon end hits: %d' % stats['num_end_hits'])
+    sys.stdout.write('\nNumber of exon start and end hits: %d' % stats['num_start_end_hits'])
+    sys.stdout.write('\nNumber of good whole alignments: %d' % stats['num_good_alignments'])
+    sys.stdout.write('\nNumber of alignments mapped to an incorrect chromosome: %d' % stats['num_badchrom_alignments'])
 
-    sys.stdout.write('\nMAF: Correct alignment: %d' % s_maf_good_alignments)
-    sys.stdout.write('\nMAF: Hit all parts: %d' % s_maf_hit_all_parts)
-    sys.stdout.write('\nMAF: Hit at least one part: %d' % s_maf_hit_one_part)
-    sys.stdout.write('\nMAF: Equals at least one part: %d' % s_maf_eq_one_part)
+    sys.stdout.write('\nMAF: Correct alignment: %d' % stats['maf_good_alignments'])
+    sys.stdout.write('\nMAF: Hit all parts: %d' % stats['maf_hit_all_parts'])
+    sys.stdout.write('\nMAF: Hit at least one part: %d' % stats['maf_hit_one_part'])
+    sys.stdout.write('\nMAF: Equals at least one part: %d' % stats['maf_eq_one_part'])
 
-    sys.stdout.write('\nMAF: Number of split reads: %d' % s_maf_split_reads)
-    sys.stdout.write('\nMAF: Correct alignment, SPLIT read: %d' % s_maf_good_split_alignments)
-    sys.stdout.write('\nMAF: Hit all parts, SPLIT read: %d' % s_maf_split_hit_all_parts)
-    sys.stdout.write('\nMAF: Hit at least one part, SPLIT read: %d' % s_maf_split_hit_one_part)
-    sys.stdout.write('\nMAF: Equals at least one part, SPLIT read: %d' % s_maf_split_eq_one_part)
+    sys.stdout.write('\nMAF: Number of split reads: %d' % stats['maf_split_reads'])
+    sys.stdout.write('\nMAF: Correct alignment, SPLIT read: %d' % stats['maf_good_split_alignments'])
+    sys.stdout.write('\nMAF: Hit all parts, SPLIT read: %d' % stats['maf_split_hit_all_parts'])
+    sys.stdout.write('\nMAF: Hit at least one part, SPLIT read: %d' % stats['maf_split_hit_one_part'])
+    sys.stdout.write('\nMAF: Equals at least one part, SPLIT read: %d' % stats['maf_split_eq_one_part'])
 
-    sys.stdout.write('\nMAF: Partial alignment that misses: %d' % s_maf_miss_alignment)
-    sys.stdout.write('\nMAF: More alignments than expected: %d' % s_maf_too_many_alignments)
-    sys.stdout.write('\nMAF: Multihit parts (fragmented) alignments: %d' % s_maf_multihit_parts)
+    sys.stdout.write('\nMAF: Partial alignment that misses: %d' % stats['maf_miss_alignment'])
+    sys.stdout.write('\nMAF: More alignments than expected: %d' % stats['maf_too_many_alignments'])
+    sys.stdout.write('\nMAF: Multihit parts (fragmented) alignments: %d' % stats['maf_multihit_parts'])
 
     sys.stdout.write('\nDone!\n')
 
@@ -663,39 +1017,40 @@ def processData(datafolder, resultfile, annotationfile, paramdict):
         file_hitall.close()
         file_hitone.close()
         file_bad.close()
+        file_unmapped.close()
 
     # # Printing out results
     # sys.stdout.write('\n\nAnalysis results:')
     # sys.stdout.write('\nOriginal Samlines: %d' % report.num_alignments)
     # sys.stdout.write('\nUsable whole alignments: %d' % len(all_sam_lines))
-    # sys.stdout.write('\nSplit alignments: %d' % s_num_split_alignment)
+    # sys.stdout.write('\nSplit alignments: %d' % stats['num_split_alignment'])
     # sys.stdout.write('\nAnnotations: %d' % len(annotation_dict))
     # sys.stdout.write('\nMultiexon genes: %d' % s_num_multiexon_genes)
-    # sys.stdout.write('\nPartial alignment hits: %d' % s_partial_alignment_hits)
-    # sys.stdout.write('\nPartial alignment misses: %d' % s_partial_alignment_misses)
-    # sys.stdout.write('\nWhole alignment hits: %d' % s_whole_alignment_hits)
-    # sys.stdout.write('\nWhole alignment misses: %d' % s_whole_alignment_misses)
-    # sys.stdout.write('\nNumber of oversplit alignments: %d' % s_num_oversplit_alignment)
-    # sys.stdout.write('\nNumber of exon start hits: %d' % s_num_start_hits)
-    # sys.stdout.write('\nNumber of exon end hits: %d' % s_num_end_hits)
-    # sys.stdout.write('\nNumber of exon start and end hits: %d' % s_num_start_end_hits)
-    # sys.stdout.write('\nNumber of good whole alignments: %d' % s_num_good_alignments)
-    # sys.stdout.write('\nNumber of alignments mapped to an incorrect chromosome: %d' % s_num_badchrom_alignments)
+    # sys.stdout.write('\nPartial alignment hits: %d' % stats['partial_alignment_hits'])
+    # sys.stdout.write('\nPartial alignment misses: %d' % stats['partial_alignment_misses'])
+    # sys.stdout.write('\nWhole alignment hits: %d' % stats['whole_alignment_hits'])
+    # sys.stdout.write('\nWhole alignment misses: %d' % stats['whole_alignment_misses'])
+    # sys.stdout.write('\nNumber of oversplit alignments: %d' % stats['num_oversplit_alignment'])
+    # sys.stdout.write('\nNumber of exon start hits: %d' % stats['num_start_hits'])
+    # sys.stdout.write('\nNumber of exon end hits: %d' % stats['num_end_hits'])
+    # sys.stdout.write('\nNumber of exon start and end hits: %d' % stats['num_start_end_hits'])
+    # sys.stdout.write('\nNumber of good whole alignments: %d' % stats['num_good_alignments'])
+    # sys.stdout.write('\nNumber of alignments mapped to an incorrect chromosome: %d' % stats['num_badchrom_alignments'])
     # sys.stdout.write('\nPartial alignments on strand (FW / RV): (%d / %d)' % (s_num_fw_strand, s_num_rv_strand))
-    # sys.stdout.write('\nPotential bad strand alignments: %d' % s_num_potential_bad_strand)
-    # sys.stdout.write('\nMAF: Suspicious alignments: %d' % s_maf_suspicious_alignments)
-    # sys.stdout.write('\nMAF: Hit both ends: %d' % s_maf_good_alignments)
-    # sys.stdout.write('\nMAF: Didn\'t hit both ends: %d' % s_maf_bad_alignments)
-    # sys.stdout.write('\nMAF: Hit all parts: %d' % s_maf_hit_all_parts)
-    # sys.stdout.write('\nMAF: Hit at least one part: %d' % s_maf_hit_one_part)
-    # sys.stdout.write('\nMAF: Equals at least one part: %d' % s_maf_eq_one_part)
-    # sys.stdout.write('\nMAF: Multihit parts (fragmented) alignments: %d' % s_maf_multihit_parts)
-    # sys.stdout.write('\nMAF: Number of split reads: %d' % s_maf_split_reads)
-    # sys.stdout.write('\nMAF: Hit both ends, SPLIT alignments: %d' % s_maf_good_split_alignments)
-    # sys.stdout.write('\nMAF: Didn\'t hit both ends, SPLIT alignments: %d' % s_maf_bad_split_alignments)
-    # sys.stdout.write('\nMAF: Hit all parts on split read: %d' % s_maf_split_hit_all_parts)
-    # sys.stdout.write('\nMAF: Hit at least one part on split read: %d' % s_maf_split_hit_one_part)
-    # sys.stdout.write('\nMAF: Equals at least one part on split read: %d' % s_maf_split_eq_one_part)
+    # sys.stdout.write('\nPotential bad strand alignments: %d' % stats['num_potential_bad_strand'])
+    # sys.stdout.write('\nMAF: Suspicious alignments: %d' % stats['maf_suspicious_alignments'])
+    # sys.stdout.write('\nMAF: Hit both ends: %d' % stats['maf_good_alignments'])
+    # sys.stdout.write('\nMAF: Didn\'t hit both ends: %d' % stats['maf_bad_alignments'])
+    # sys.stdout.write('\nMAF: Hit all parts: %d' % stats['maf_hit_all_parts'])
+    # sys.stdout.write('\nMAF: Hit at least one part: %d' % stats['maf_hit_one_part'])
+    # sys.stdout.write('\nMAF: Equals at least one part: %d' % stats['maf_eq_one_part'])
+    # sys.stdout.write('\nMAF: Multihit parts (fragmented) alignments: %d' % stats['maf_multihit_parts'])
+    # sys.stdout.write('\nMAF: Number of split reads: %d' % stats['maf_split_reads'])
+    # sys.stdout.write('\nMAF: Hit both ends, SPLIT alignments: %d' % stats['maf_good_split_alignments'])
+    # sys.stdout.write('\nMAF: Didn\'t hit both ends, SPLIT alignments: %d' % stats['maf_bad_split_alignments'])
+    # sys.stdout.write('\nMAF: Hit all parts on split read: %d' % stats['maf_split_hit_all_parts'])
+    # sys.stdout.write('\nMAF: Hit at least one part on split read: %d' % stats['maf_split_hit_one_part'])
+    # sys.stdout.write('\nMAF: Equals at least one part on split read: %d' % stats['maf_split_eq_one_part'])
     # sys.stdout.write('\nDone!\n')
 
 
@@ -709,6 +1064,7 @@ def verbose_usage_and_exit():
     sys.stderr.write('\n')
     sys.stderr.write('\tmode:\n')
     sys.stderr.write('\t\tprocess\n')
+    sys.stderr.write('\t\tbuild-truth\n')
     sys.stderr.write('\n')
     exit(0)
 
@@ -719,31 +1075,61 @@ if __name__ == '__main__':
     mode = sys.argv[1]
 
     if (mode == 'process'):
-        if (len(sys.argv) < 5):
+        if (len(sys.argv) < 4):
             sys.stderr.write('Processes a folder containing data generated by pbsim.\n')
             sys.stderr.write('Joins all generated reads into a single FASTQ file.\n')
             sys.stderr.write('Expands existing headers with the name of originating reference.\n')
             sys.stderr.write('Usage:\n')
-            sys.stderr.write('%s %s <pbsim data folder> <results file> <annotations file> <options>\n'% (sys.argv[0], sys.argv[1]))
+            sys.stderr.write('%s %s <pbsim data folder> <results file> [<annotations file>] <options>\n'% (sys.argv[0], sys.argv[1]))
             sys.stderr.write('\n')
+            sys.stderr.write('Annotations file is not needed (and is ignored) if a truth file is given.\n')
             sys.stderr.write('\noptions:\n')
             sys.stderr.write('\t\t--split-qnames: while calculating the statistics also sorts query names\n')
             sys.stderr.write('\t\t                into four files - file_correct.names, file_hitall.names\n')
             sys.stderr.write('\t\t                                  file_hitone.names, file_bad.names\n')
             sys.stderr.write('\t\t--print_mapping [filename]: Print information about actual and expected alignments\n')
             sys.stderr.write('\t\t                into a give text file.\n')
+            sys.stderr.write('\t\t--truth [filename]: Read origins of simulated reads and their genes from a truth file\n')
+            sys.stderr.write('\t\t                (see build-truth mode), instead of from pbsim data folder and annotations.\n')
+            sys.stderr.write('\t\t                The results file is then streamed, alignments of each query must be\n')
+            sys.stderr.write('\t\t                in consecutive lines (as in aligner output).\n')
+            sys.stderr.write('\t\t-t (--threads) [int]: Number of processes used to evaluate reads (default 1,\n')
+            sys.stderr.write('\t\t                at most the number of CPUs)\n')
+            sys.stderr.write('\t\t--status_file [filename]: Periodically write progress of the evaluation (evaluated reads,\n')
+            sys.stderr.write('\t\t                throughput and estimated time to finish) to a file in JSON format.\n')
             sys.stderr.write('\n')
             exit(1)
 
         datafolder = sys.argv[2]
         resultfile = sys.argv[3]
-        annotationfile = sys.argv[4]
+        annotationfile = None
+        optionstart = 4
+        if len(sys.argv) > 4 and not sys.argv[4].startswith('-'):
+            annotationfile = sys.argv[4]
+            optionstart = 5
 
         pparser = paramsparser.Parser(paramdefs)
-        paramdict = pparser.parseCmdArgs(sys.argv[5:])
+        paramdict = pparser.parseCmdArgs(sys.argv[optionstart:])
         paramdict['command'] = ' '.join(sys.argv)
 
         processData(datafolder, resultfile, annotationfile, paramdict)
 
+    elif (mode == 'build-truth'):
+        if (len(sys.argv) < 5):
+            sys.stderr.write('Walks through a folder containing data generated by pbsim and writes\n')
+            sys.stderr.write('the origin of each simulated read into a truth file.\n')
+            sys.stderr.write('The truth file can be used in process mode (option --truth) to evaluate\n')
+            sys.stderr.write('multiple SAM files without processing pbsim data again.\n')
+            sys.stderr.write('Usage:\n')
+            sys.stderr.write('%s %s <pbsim data folder> <annotations file> <truth file>\n'% (sys.argv[0], sys.argv[1]))
+            sys.stderr.write('\n')
+            exit(1)
+
+        datafolder = sys.argv[2]
+        annotationfile = sys.argv[3]
+        truthfile = sys.argv[4]
+
+        build_truth(datafolder, annotationfile, truthfile)
+
     else:
         print 'Invalid mode!'
@@ -4,9 +4,16 @@ import sys, os
 import re
 import setup_RNAseqEval, paramsparser
 
-# For copying SAM lines
+# For binding SAM line methods to alignment segments
+import types
+
+# For copying SAM file statistics between reports
 import copy
 
+# For annotation cache
+import cPickle
+import hashlib
+
 from datetime import datetime
 
 # To enable importing from samscripts submodule
@@ -14,19 +21,35 @@ SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(SCRIPT_PATH, 'samscripts/src'))
 import utility_sam
 import Annotation_formats
+import fasta_index
+import profiler
+import progress
 
 from fastqparser import read_fastq
-from report import EvalReport, ReportType
+from report import EvalReport, ReportType, get_comparison_table, report_from_partial, new_annotation_signature
 
 # Multiprocessing stuff
 import multiprocessing
+import collections
 
 # import time
 
 DISTANCE_THRESHOLD = 10000
 MIN_OVERLAP_BASES = 5
-NUM_PROCESS = 12
+NUM_PROCESS = 12                # Default number of worker processes
+STREAM_UNIT_READS = 10000       # Number of reads in a work unit when streaming a SAM file
+MAX_PENDING_UNITS_PER_PROCESS = 2   # Number of work units waiting for evaluation when streaming a SAM file
 NEW_ANNOTATION_MIN = 3
+REPORT_FORMATS = ['text', 'json', 'tsv']    # Formats in which reports can be written (see --format)
+
+# Records times of evaluation stages and worker tasks, enabled with --profile option
+PROFILER = profiler.Profiler()
+
+# Reads are evaluated in work units, each work unit is processed by a single worker process
+# Reads are split so that each worker process gets several work units, which keeps all processes busy
+# until the end, but each work unit should still be large enough so that sending it to a worker is worthwhile
+WORK_UNITS_PER_PROCESS = 4
+WORK_UNIT_MIN_READS = 1000
 
 
 # TODO: Osim broja readova koji pokrivaju pojedini gen, izracunati i coverage
@@ -53,7 +76,16 @@ paramdefs = {'-a' : 1,
              '--graphmap' : 0,
              '--old_bma_calc' : 0,
              '--leave_chrom_names': 0,
-             '--calc_new_annotations': 0}
+             '--calc_new_annotations': 0,
+             '-t' : 1,
+             '--threads' : 1,
+             '--stream_sam' : 0,
+             '--sorted_input' : 0,
+             '--no_annotation_cache' : 0,
+             '--sweep' : 1,
+             '--format' : 1,
+             '--profile' : 0,
+             '--status_file' : 1}
 
 
 def cleanup():
@@ -107,13 +139,19 @@ def isGoodSplitAlignment(exonhitmap, exoncompletemap, exonstartmap, exonendmap):
     return isGood, isSpliced
 
 
+# Regular expressions for searching for long and short chromosome names
+CHROMNAME_LONG_RE = re.compile(r'(chromosome )(\w*)')
+CHROMNAME_SHORT_RE = re.compile(r'(chr)(\w*)')
+
+
 # A helper function that extracts a chromosome name from a fasta header (or other similar strings)
 # Annotations and reference can use different chromosome designations, so this is used to 
 # correctly compare them
 # Chromosome names should be either chromosome [designation] or chr[designation]
 # In the case header represents a mitochondrion, 'chrM' is returned!
 # If there is no need for chromosome name preprocessing, then the parameter processChromNames should be set to False
-def getChromName(header, processChromNames = True):
+# NOTE: This function does not cache its results, in most cases getChromName should be used instead
+def normalizeChromName(header, processChromNames = True):
 
     # If chromosome names do not need to be processed, simply return unchanged argument (up to the first space)
     if not processChromNames:
@@ -124,15 +162,12 @@ def getChromName(header, processChromNames = True):
             return header[:pos]
 
     chromname = ''
-    # regular expressions for searching for long and short chromosome names
-    longre = r'(chromosome )(\w*)'
-    shortre = r'(chr)(\w*)'
 
     if header.find('mitochondrion') > -1 or header.find('chrM') > -1:
         chromname = 'chrM'
     else:
-        match1 = re.search(longre, header)
-        match2 = re.search(shortre, header)
+        match1 = CHROMNAME_LONG_RE.search(header)
+        match2 = CHROMNAME_SHORT_RE.search(header)
         if match1:
             designation = match1.group(2)
             chromname = 'chr%s' % designation
@@ -146,10 +181,212 @@ def getChromName(header, processChromNames = True):
     return chromname
 
 
+# Translates raw chromosome names (from FASTA headers, SAM RNAME fields and annotation seqnames)
+# into normalized chromosome names and small integer chromosome ids
+# Each raw name is normalized only once, after that it is looked up in a dictionary
+# Chromosome ids are assigned in the order in which normalized names are first seen,
+# so the same chromosome always gets the same id, regardless of the raw name used for it
+class ChromNameResolver:
+    def __init__(self, processChromNames = True):
+        self.processChromNames = processChromNames
+        self.cache = {}             # Raw name -> chromosome id
+        self.chromids = {}          # Normalized name -> chromosome id
+        self.chromnames = []        # Chromosome id -> normalized name
+
+    def getChromId(self, header):
+        chromid = self.cache.get(header)
+        if chromid is None:
+            chromname = normalizeChromName(header, self.processChromNames)
+            chromid = self.chromids.get(chromname)
+            if chromid is None:
+                chromid = len(self.chromnames)
+                self.chromids[chromname] = chromid
+                self.chromnames.append(chromname)
+            self.cache[header] = chromid
+        return chromid
+
+    def getChromName(self, header):
+        return self.chromnames[self.getChromId(header)]
+
+
+# Resolvers are shared by the whole pipeline, one for each way of processing chromosome names
+# Worker processes inherit them (together with already assigned chromosome ids) from the parent process
+chrom_resolvers = {True : ChromNameResolver(True), False : ChromNameResolver(False)}
+
+
+def getChromResolver(processChromNames = True):
+    return chrom_resolvers[processChromNames]
+
+
+# Returns a normalized chromosome name for a given header, see normalizeChromName
+def getChromName(header, processChromNames = True):
+    return chrom_resolvers[processChromNames].getChromName(header)
+
+
+
+# Using regular expressions to find repeating digit and skipping one character after that
+# Used to separate CIGAR string into individual operations
+CIGAR_PATTERN = re.compile(r'(\d+)(.)')
+
+# CIGAR operations that consume reference, read and aligned read bases
+CIGAR_REF_OPS = 'MDN=X'
+CIGAR_READ_OPS = 'MIS=X'
+CIGAR_ALIGNED_OPS = 'MI=X'
+CIGAR_CLIP_OPS = 'SH'
+
+
+# A CIGAR string parsed into a list of operations (length, operation)
+# Lengths of an alignment on the reference and on the read are calculated together with parsing
+# so that CIGAR string of an alignment has to be parsed only once (see get_compact_cigar)
+# Can also be created from a list of operations, in which case the CIGAR string is generated
+class CompactCigar:
+
+    def __init__(self, cigar = None, operations = None):
+        if operations is None:
+            operations = [(int(length), op) for (length, op) in CIGAR_PATTERN.findall(cigar)]
+        elif cigar is None:
+            cigar = ''.join('%d%s' % (length, op) for (length, op) in operations)
+        self.cigar = cigar
+        self.operations = operations
+
+        self.reflength = 0          # Same as SAMLine.CalcReferenceLengthFromCigar
+        self.readlength = 0         # Same as SAMLine.CalcReadLengthFromCigar
+        self.alignedlength = 0      # Number of read bases aligned to the reference
+        for (length, op) in operations:
+            if op in CIGAR_REF_OPS:
+                self.reflength += length
+            if op in CIGAR_READ_OPS:
+                self.readlength += length
+            if op in CIGAR_ALIGNED_OPS:
+                self.alignedlength += length
+
+        # Clipped bases at the start and at the end of the alignment
+        self.clip_start = 0
+        self.clip_end = 0
+        num_start_clips = 0
+        for (length, op) in operations:
+            if op not in CIGAR_CLIP_OPS:
+                break
+            self.clip_start += length
+            num_start_clips += 1
+        for (length, op) in reversed(operations[num_start_clips:]):
+            if op not in CIGAR_CLIP_OPS:
+                break
+            self.clip_end += length
+
+    # Returns True if the alignment is split, has Ns in the middle
+    # (Ns cannot appear as the first or the last operation)
+    def isSplit(self):
+        for (length, op) in self.operations[1:-1]:
+            if op == 'N':
+                return True
+        return False
+
+    # Returns a CIGAR in which all deletes of a given length or longer are replaced with Ns of the same length
+    # Returns the same object if there are no such deletes
+    def replaceLongDeletions(self, min_length):
+        changed = False
+        operations = []
+        for (length, op) in self.operations:
+            if op == 'D' and length >= min_length:
+                op = 'N'
+                changed = True
+            operations.append((length, op))
+
+        if not changed:
+            return self
+        return CompactCigar(operations = operations)
+
+
+# Returns a parsed CIGAR string of an alignment
+# Parsed CIGAR is stored with the alignment and parsed again only if the CIGAR string has changed
+def get_compact_cigar(samline):
+    compact_cigar = getattr(samline, 'compact_cigar', None)
+    if compact_cigar is None or compact_cigar.cigar != samline.cigar:
+        compact_cigar = CompactCigar(samline.cigar)
+        samline.compact_cigar = compact_cigar
+    return compact_cigar
+
+
+# Sets a new CIGAR string of an alignment, together with its parsed version
+def set_compact_cigar(samline, compact_cigar):
+    samline.cigar = compact_cigar.cigar
+    samline.compact_cigar = compact_cigar
+
+
+# A part of a split alignment (between two Ns in the CIGAR string), see process_SAM_group
+# Keeps its own position and CIGAR string, and the fields of the original SAM line (parent) used while
+# evaluating alignments (query name, flag, ...). Sequence is shared with the parent, it is not copied for
+# each segment, only segments with hard clipping keep a part of the parent sequence (see process_SAM_group).
+# Other attributes (qualities ...) are taken from the parent when used, and methods of the parent
+# SAM line work on the segment (see calc_extended_cigar for the one used most often)
+class AlignmentSegment(object):
+    __slots__ = ('parent', 'pos', 'clipped_pos', 'cigar', 'compact_cigar', 'chromid', 'seq',
+                 'qname', 'flag', 'rname', 'chosen_quality')
+
+    def __init__(self, parent, pos, clipped_pos):
+        self.parent = parent
+        self.pos = pos
+        self.clipped_pos = clipped_pos
+        self.cigar = parent.cigar
+        self.compact_cigar = get_compact_cigar(parent)
+        self.seq = parent.seq
+        self.qname = parent.qname
+        self.flag = parent.flag
+        self.rname = parent.rname
+        self.chosen_quality = parent.chosen_quality
+
+    # Called only for attributes that are not set on the segment
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(object.__getattribute__(self, 'parent'), name)
+        if isinstance(value, types.MethodType) and value.__self__ is not None:
+            return types.MethodType(value.__func__, self)
+        return value
+
+    # Only attributes set on the segment are pickled, the rest is taken from the parent
+    # (sequence shared with the parent is pickled only once)
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for (name, value) in state.iteritems():
+            setattr(self, name, value)
+
+
+# Calculates an extended CIGAR string (with = and X instead of M) of an alignment against its reference sequence
+# For a segment of a split alignment, the function of the parent SAM line is called directly on the segment,
+# which holds everything it uses (position, CIGAR and sequence) in its own fields
+SAMLINE_EXTENDED_CIGAR = utility_sam.SAMLine.CalcExtendedCIGAR.__func__
+
+def calc_extended_cigar(samline, reference_seq):
+    if isinstance(samline, AlignmentSegment):
+        return SAMLINE_EXTENDED_CIGAR(samline, reference_seq)
+    return samline.CalcExtendedCIGAR(reference_seq)
+
+
+# Opens a FASTA reference, an uncompressed FASTA file is accessed through a .fai index
+# and sequences are read only when needed, otherwise the whole file is loaded
+# Returns [headers, seqs, quals, seqlengths]
+def open_reference(ref_file):
+    if fasta_index.is_indexable_fasta(ref_file):
+        reference = fasta_index.FastaReference(ref_file)
+        return [reference.headers, reference, None, reference.lengths]
+    else:
+        [headers, seqs, quals] = read_fastq(ref_file)
+        return [headers, seqs, quals, [len(seq) for seq in seqs]]
+
 
 def load_and_process_reference(ref_file, paramdict, report):
     # Reading FASTA reference
-    [headers, seqs, quals] = read_fastq(ref_file)
+    [headers, seqs, quals, seqlengths] = open_reference(ref_file)
     processChromNames = True
     if '--leave_chrom_names' in paramdict:
         processChromNames = False
@@ -163,23 +400,24 @@ def load_and_process_reference(ref_file, paramdict, report):
     # The chromname2seq dictionary will have a inferred name as key, and index of the corresponding
     # sequence and headeer as value
     chromname2seq = {}
+    resolver = getChromResolver(processChromNames)
 
     if len(headers) == 1:
-        report.reflength = len(seqs[0])
-        chromname = getChromName(headers[0], processChromNames)
+        report.reflength = seqlengths[0]
+        chromname = resolver.getChromName(headers[0])
         report.chromlengths = {chromname : report.reflength}
         chromname2seq[chromname] = 0
     else:
         for i in xrange(len(headers)):
             header = headers[i]
-            chromname = getChromName(header, processChromNames)
+            chromname = resolver.getChromName(header)
             if chromname in report.chromlengths:
                 raise Exception('\nERROR: Duplicate chromosome name: %s' % chromname)
                 # sys.stderr.write('\nERROR: Duplicate chromosome name: %s' % chromname)
                 exit()
             else:
-                report.chromlengths[chromname] = len(seqs[i])
-                report.reflength += len(seqs[i])
+                report.chromlengths[chromname] = seqlengths[i]
+                report.reflength += seqlengths[i]
                 chromname2seq[chromname] = i
 
     return [chromname2seq, headers, seqs, quals]
@@ -202,6 +440,104 @@ def join_split_alignment(samline_list, samline):
 
 
 
+# Processes all SAM lines belonging to a single query (a read group)
+# Removes unmapped queries, leaves only the first alignment and other alignments that possibly
+# costitute a split alignment together with the first one. Split alignments containing Ns are
+# transformed into multiple alignments with clipping.
+# Returns the list of remaining alignments, or None if the query is considered unmapped
+def process_SAM_group(samline_list, report, save_qnames = False):
+    # NOTE: This is a quick and dirty solution
+    # Setting this to true so that large deletions are turned into Ns
+    # BBMap marks intron RNA alignment gaps with deletions!
+    BBMapFormat = True
+
+    if samline_list[0].cigar <> '*' and samline_list[0].cigar <> '':            # if the first alignment doesn't have a regular cigar string, skip
+
+        if BBMapFormat:
+            # All deletes that are 10 or more bases are replaced with Ns of the same length
+            set_compact_cigar(samline_list[0], get_compact_cigar(samline_list[0]).replaceLongDeletions(10))
+
+        compact_cigar = get_compact_cigar(samline_list[0])
+
+        # If the first alignment is split (had Ns in the middle), keep only the first alignment and drop the others
+        if compact_cigar.isSplit():
+            report.num_split_alignments += 1
+            # Transform split alignments containing Ns into multiple alignments with clipping
+            temp_samline_list = []
+            posread = 0
+            posref = 0      # NOTE: I don't seem to be using this, probably should remove it
+            newoperations = []
+            readlength = compact_cigar.readlength
+            new_samline = AlignmentSegment(samline_list[0], samline_list[0].pos, samline_list[0].clipped_pos)
+            mapping_pos = new_samline.pos
+            clipped_bases = new_samline.pos - new_samline.clipped_pos
+            hclip_seq = 0        # Used with hard clipping, how big part of sequence should be removed
+            clip_type = 'S'     # Soft_clipping by default
+            for (length, op) in compact_cigar.operations:
+                if op == 'N' and length > 1:        # Create a new alignment with clipping
+                    newoperations.append((readlength - posread, 'S'))      # Always use soft clipping at the end
+                    set_compact_cigar(new_samline, CompactCigar(operations = newoperations))
+                    # After some deliberation, I concluded that this samline doesn't have to have its position changed
+                    # The next samline does, and by the size of N operation in cigar string + any operations before
+                    temp_samline_list.append(new_samline)
+                    mapping_pos += length
+                    new_samline = AlignmentSegment(samline_list[0], mapping_pos, mapping_pos - clipped_bases)
+                    posref += length
+                    if clip_type == 'H':
+                        new_samline.seq = new_samline.seq[hclip_seq:]
+                    newoperations = [(posread, clip_type)]
+                else:                   # Expand a current alignment
+                    newoperations.append((length, op))
+                    if op in ('D', 'N'):
+                        posref += length
+                        mapping_pos += length
+                    elif op == 'I':
+                        posread += length
+                        # Everything besides deletes and Ns will be clipped in the next partial alignment
+                        # Therefore have to adjust both pos and clipped pos
+                        clipped_bases += length
+                        hclip_seq += length
+                    elif op in ('S', 'H'):
+                        clip_type = op
+                        # Clipped bases can not appear in the middle of the original cigar string
+                        # And they have already been added to the position,
+                        # so I shouldn't adjust my mapping_pos and clipped_bases again
+                        # TODO: I should probably diferentiate between hars and soft clipping
+                        posread += length
+                        posref += length
+                    else:
+                        posref += length
+                        posread += length
+                        clipped_bases += length
+                        mapping_pos += length
+                        hclip_seq += length
+
+            set_compact_cigar(new_samline, CompactCigar(operations = newoperations))
+            temp_samline_list.append(new_samline)
+
+            return temp_samline_list
+        else:
+            temp_samline_list = [samline_list[0]]        # add the first alignment to the temp list
+            multi_alignment = False
+            for samline in samline_list[1:]:            # look through other alignments and see if they could form a split alignment with the current temp_samline_list
+                if BBMapFormat:
+                    # All deletes that are 10 or more bases are replaced with Ns of the same length
+                    set_compact_cigar(samline, get_compact_cigar(samline).replaceLongDeletions(10))
+                if not join_split_alignment(temp_samline_list, samline):
+                    multi_alignment = True
+
+            if multi_alignment:
+                report.num_multi_alignments += 1
+            if len(temp_samline_list) > 1:
+                report.num_possibly_split_alignements += 1
+            return temp_samline_list
+    else:
+        # Samline has invalid cigar and is considered unmapped
+        if save_qnames:
+            report.unmapped_names.append(samline_list[0].qname)
+        return None
+
+
 def load_and_process_SAM(sam_file, paramdict, report, BBMapFormat = False):
     # Loading SAM file into hash
     # Keeping only SAM lines with regular CIGAR string, and sorting them according to position
@@ -228,11 +564,6 @@ def load_and_process_SAM(sam_file, paramdict, report, BBMapFormat = False):
 
         sam_hash = new_sam_hash
 
-    # NOTE: This is a quick and dirty solution
-    # Setting this to true so that large deletions are turned into Ns
-    # BBMap marks intron RNA alignment gaps with deletions!
-    BBMapFormat = True
-
     # If this option is set in parameters, unmapped queries will be listed in the report
     save_qnames = False
     if '-sqn' in paramdict or '--save_query_names' in paramdict or '--split-qnames' in paramdict:
@@ -241,120 +572,20 @@ def load_and_process_SAM(sam_file, paramdict, report, BBMapFormat = False):
     # Reorganizing SAM lines, removing unmapped queries, leaving only the first alignment and
     # other alignments that possibly costitute a split alignment together with the first one
     samlines = []
-    cnt = 0
-    pattern = '(\d+)(.)'
-    # for samline_list in sam_hash.itervalues():
     for (samline_key, samline_list) in sam_hash.iteritems():
-        cnt += 1
-        if samline_list[0].cigar <> '*' and samline_list[0].cigar <> '':            # if the first alignment doesn't have a regular cigar string, skip
-
-            if BBMapFormat:
-                # All deletes that are 10 or more bases are replaced with Ns of the same length
-                operations = re.findall(pattern, samline_list[0].cigar)
-                newcigar = ''
-                for op in operations:
-                    op1 = op[1]
-                    op0 = op[0]
-                    if op[1] == 'D' and int(op[0]) >= 10:
-                        op1 = 'N'
-                    newcigar += op0 + op1
-                samline_list[0].cigar = newcigar
-
-
-            operations = re.findall(pattern, samline_list[0].cigar)
-            split = False
+        temp_samline_list = process_SAM_group(samline_list, report, save_qnames)
+        if temp_samline_list is not None:
+            samlines.append(temp_samline_list)
 
-            for op in operations[1:-1]:             # Ns cannot appear as the first or the last operation
-                if op[1] == 'N':
-                    split = True
-                    break
-            # If the first alignment is split (had Ns in the middle), keep only the first alignment and drop the others
-            if split:
-                report.num_split_alignments += 1
-                # Transform split alignments containing Ns into multiple alignments with clipping
-                temp_samline_list = []
-                posread = 0
-                posref = 0      # NOTE: I don't seem to be using this, probably should remove it
-                newcigar = ''
-                readlength = samline_list[0].CalcReadLengthFromCigar()
-                new_samline = copy.deepcopy(samline_list[0])
-                mapping_pos = new_samline.pos
-                clipped_bases = new_samline.pos - new_samline.clipped_pos
-                hclip_seq = 0        # Used with hard clipping, how big part of sequence should be removed
-                clip_type = 'S'     # Soft_clipping by default
-                for op in operations:
-                    if op[1] == 'N' and int(op[0]) > 1:        # Create a new alignment with clipping
-                        newcigar += '%dS' % (readlength - posread)      # Always use soft clipping at the end
-                        new_samline.cigar = newcigar
-                        # After some deliberation, I concluded that this samline doesn't have to have its position changed
-                        # The next samline does, and by the size of N operation in cigar string + any operations before
-                        temp_samline_list.append(new_samline)
-                        new_samline = copy.deepcopy(samline_list[0])
-                        mapping_pos += int(op[0])
-                        new_samline.pos = mapping_pos
-                        new_samline.clipped_pos = new_samline.pos - clipped_bases
-                        posref += int(op[0])
-                        if clip_type == 'H':
-                            new_samline.seq = new_samline.seq[hclip_seq:]
-                        newcigar = '%d%c' % (posread, clip_type)
-                    else:                   # Expand a current alignment
-                        newcigar += op[0] + op[1]
-                        if op[1] in ('D', 'N'):
-                            posref += int(op[0])
-                            mapping_pos += int(op[0])
-                        elif op[1] == 'I':
-                            posread += int(op[0])
-                            # Everything besides deletes and Ns will be clipped in the next partial alignment
-                            # Therefore have to adjust both pos and clipped pos
-                            clipped_bases += int(op[0])
-                            hclip_seq += int(op[0])
-                        elif op[1] in ('S', 'H'):
-                            clip_type = op[1]
-                            # Clipped bases can not appear in the middle of the original cigar string
-                            # And they have already been added to the position,
-                            # so I shouldn't adjust my mapping_pos and clipped_bases again
-                            # TODO: I should probably diferentiate between hars and soft clipping
-                            posread += int(op[0])
-                            posref += int(op[0])
-                        else:
-                            posref += int(op[0])
-                            posread += int(op[0])
-                            clipped_bases += int(op[0])
-                            mapping_pos += int(op[0])
-                            hclip_seq += int(op[0])
-
-                new_samline.cigar = newcigar
-                temp_samline_list.append(new_samline)
-
-                samlines.append(temp_samline_list)
-            else:
-                temp_samline_list = [samline_list[0]]        # add the first alignment to the temp list
-                multi_alignment = False
-                for samline in samline_list[1:]:            # look through other alignments and see if they could form a split alignment with the current temp_samline_list
-                    if BBMapFormat:
-                        # All deletes that are 10 or more bases are replaced with Ns of the same length
-                        operations = re.findall(pattern, samline.cigar)
-                        newcigar = ''
-                        for op in operations:
-                            op0 = op[0]
-                            op1 = op[1]
-                            if op[1] == 'D' and int(op[0]) >= 10:
-                                op1 = 'N'
-                            newcigar += op0 + op1
-                        samline.cigar = newcigar
-                    if not join_split_alignment(temp_samline_list, samline):
-                        multi_alignment = True
-
-                if multi_alignment:
-                    report.num_multi_alignments += 1
-                if len(temp_samline_list) > 1:
-                    report.num_possibly_split_alignements += 1
-                samlines.append(temp_samline_list)
-        else:
-            # Samline has invalid cigar and is considered unmapped
-            if save_qnames:
-                report.unmapped_names.append(samline_list[0].qname)
-            pass
+    # Resolving chromosome names only once for each alignment
+    # Later stages compare chromosome ids instead of chromosome names
+    processChromNames = True
+    if '--leave_chrom_names' in paramdict:
+        processChromNames = False
+    resolver = getChromResolver(processChromNames)
+    for samline_list in samlines:
+        for samline in samline_list:
+            samline.chromid = resolver.getChromId(samline.rname)
 
     # Sorting SAM lines according to the position of the first alignment
     samlines.sort(key = lambda samline: samline[0].pos)
@@ -374,20 +605,394 @@ def load_and_process_SAM(sam_file, paramdict, report, BBMapFormat = False):
     return samlines
 
 
+# Reads a SAM file grouped according to query names (all alignments of a query are in consecutive lines,
+# as in aligner output or in a name sorted file) and yields the SAM lines of one query at a time
+# As in utility_sam.HashSAMWithFilter, alignments of a query are sorted according to mapping quality
+# The number of SAM lines and the number of queries are counted in a given dictionary (sam_counts)
+def stream_SAM_groups(sam_file, sam_counts):
+    sam_counts['num_lines'] = 0
+    sam_counts['num_unique_lines'] = 0
+
+    samline_list = []
+    with open(sam_file, 'r') as samfile:
+        for line in samfile:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '@':
+                continue
+
+            samline = utility_sam.SAMLine(line)
+            if len(samline_list) > 0 and samline.qname != samline_list[0].qname:
+                samline_list.sort(reverse = True, key = lambda sline: sline.chosen_quality)
+                yield samline_list
+                samline_list = []
+
+            if len(samline_list) == 0:
+                sam_counts['num_unique_lines'] += 1
+            samline_list.append(samline)
+            sam_counts['num_lines'] += 1
+
+    if len(samline_list) > 0:
+        samline_list.sort(reverse = True, key = lambda sline: sline.chosen_quality)
+        yield samline_list
+
+
+# Reads a SAM file sorted according to position (chromosome by chromosome) and yields the SAM lines of one query
+# at a time, as in stream_SAM_groups. In a sorted file alignments of a query are not in consecutive lines,
+# so alignments of the same query are collected only if they are on the same chromosome and not further than
+# DISTANCE_THRESHOLD from its first alignment (the distance used for split alignments, see join_split_alignment).
+# Only groups containing a primary alignment are yielded, other alignments of the query (secondary or
+# supplementary alignments far from the primary one) are counted as SAM lines, but are otherwise ignored.
+# Unmapped queries are yielded immediately. Groups are yielded in the order of their first alignment,
+# so only alignments within DISTANCE_THRESHOLD of the current position are kept in memory.
+def stream_sorted_SAM_groups(sam_file, sam_counts):
+    sam_counts['num_lines'] = 0
+    sam_counts['num_unique_lines'] = 0
+
+    pending = collections.OrderedDict()     # Query name -> SAM lines, in the order of the first alignment
+    finished_chroms = set()
+    rname = None
+    pos = -1
+    with open(sam_file, 'r') as samfile:
+        for line in samfile:
+            line = line.strip()
+            if len(line) == 0 or line[0] == '@':
+                continue
+
+            samline = utility_sam.SAMLine(line)
+            sam_counts['num_lines'] += 1
+            if samline.cigar == '*' or samline.rname == '*':
+                sam_counts['num_unique_lines'] += 1
+                yield [samline]
+                continue
+
+            if samline.rname != rname:
+                if samline.rname in finished_chroms:
+                    raise Exception('\nERROR: SAM file is not sorted according to position (chromosome %s appears again)!' % samline.rname)
+                if rname is not None:
+                    finished_chroms.add(rname)
+                rname = samline.rname
+                pos = -1
+            elif samline.pos < pos:
+                raise Exception('\nERROR: SAM file is not sorted according to position (%s:%d after %s:%d)!' % (samline.rname, samline.pos, rname, pos))
+            pos = samline.pos
+
+            # Yielding groups that can not get any more alignments (on another chromosome or too far behind)
+            while len(pending) > 0:
+                samline_list = next(pending.itervalues())
+                if samline_list[0].rname == rname and samline_list[0].pos + DISTANCE_THRESHOLD >= pos:
+                    break
+                pending.popitem(last = False)
+                if has_primary_alignment(samline_list):
+                    sam_counts['num_unique_lines'] += 1
+                    samline_list.sort(reverse = True, key = lambda sline: sline.chosen_quality)
+                    yield samline_list
+
+            if samline.qname in pending:
+                pending[samline.qname].append(samline)
+            else:
+                pending[samline.qname] = [samline]
+
+    for samline_list in pending.itervalues():
+        if has_primary_alignment(samline_list):
+            sam_counts['num_unique_lines'] += 1
+            samline_list.sort(reverse = True, key = lambda sline: sline.chosen_quality)
+            yield samline_list
+
+
+# Checks if a group of SAM lines contains a primary alignment (neither secondary nor supplementary)
+def has_primary_alignment(samline_list):
+    for samline in samline_list:
+        if samline.flag & (256 | 2048) == 0:
+            return True
+    return False
+
+
+# Returns the name of the part (chromosome and strand) to which an alignment belongs
+def get_partname(samline, chromnames, check_strand = True):
+    chromname = chromnames[samline.chromid]
+    if not check_strand:
+        return chromname
+    if samline.flag & 16 == 0:
+        return chromname + '+'
+    else:
+        return chromname + '-'
+
+
+# Updates mapping quality statistics in the report with the alignments of a single query
+# Returns the sum of (non zero) mapping qualities, used to calculate the average mapping quality
+def add_quality_stats(report, samline_list):
+    sumq = 0.0
+    for samline in samline_list:
+        quality = samline.chosen_quality
+        if quality > 0:
+            report.num_good_quality += 1
+            if report.max_mapping_quality == 0 or report.max_mapping_quality < quality:
+                report.max_mapping_quality = quality
+            if report.min_mapping_quality == 0 or report.min_mapping_quality > quality:
+                report.min_mapping_quality = quality
+            sumq += quality
+        else:
+            report.num_zero_quality += 1
+    return sumq
+
+
+# Reads alignments from a SAM file grouped according to query names and yields work units for worker processes
+# Whole SAM file is never loaded: each query is processed as in load_and_process_SAM and placed into
+# a buffer for its part (chromosome/strand). A part is turned into work units once it collects enough reads,
+# and all parts are flushed when too many reads are buffered. Work units do not contain annotations,
+# workers use annotations for the whole part (see init_worker).
+# With a SAM file sorted according to position (--sorted_input), the file is read chromosome by chromosome
+# (see stream_sorted_SAM_groups) and all parts are flushed when a chromosome is finished. Annotations for
+# each work unit are then found by a sweep over part annotations, which moves forward together with the reads,
+# and are sent with the work unit, so both reads and annotations are walked through only once.
+# Report statistics calculated in load_and_process_SAM and quality statistics are updated along the way
+def stream_work_units(sam_file, paramdict, report, partlist, unit_size, max_buffered, part_annotations = None):
+    save_qnames = False
+    if '-sqn' in paramdict or '--save_query_names' in paramdict or '--split-qnames' in paramdict:
+        save_qnames = True
+
+    check_strand = True
+    if '--no_check_strand' in paramdict:
+        check_strand = False
+
+    # GraphMap correction has to be applied before alignments are sent to workers
+    correct_gm = False
+    if '--graphmap' in paramdict and '--no_per_base_stats' not in paramdict:
+        correct_gm = True
+
+    processChromNames = True
+    if '--leave_chrom_names' in paramdict:
+        processChromNames = False
+    resolver = getChromResolver(processChromNames)
+
+    sorted_input = False
+    if '--sorted_input' in paramdict:
+        sorted_input = True
+
+    part_buffers = {}
+    for partname in partlist:
+        part_buffers[partname] = []
+    num_buffered = 0
+
+    # Annotation sweeps for the parts of the current chromosome (only for sorted input)
+    part_sweeps = None
+    chromid = None
+
+    num_samlines = 0
+    num_real_split = 0
+    sumq = 0.0
+    sam_counts = {}
+    if sorted_input:
+        samline_groups = stream_sorted_SAM_groups(sam_file, sam_counts)
+    else:
+        samline_groups = stream_SAM_groups(sam_file, sam_counts)
+    for samline_list in samline_groups:
+        # Reads yielded later can not start before the first alignment of this read
+        firstpos = min(samline.pos for samline in samline_list)
+        samline_list = process_SAM_group(samline_list, report, save_qnames)
+        if samline_list is None:
+            continue
+
+        num_samlines += 1
+        if len(samline_list) > 1:
+            num_real_split += 1
+        sumq += add_quality_stats(report, samline_list)
+
+        for samline in samline_list:
+            samline.chromid = resolver.getChromId(samline.rname)
+            if correct_gm and samline.flag & 16 != 0:
+                samline.pos += 1
+
+        partname = get_partname(samline_list[0], resolver.chromnames, check_strand)
+        if partname not in part_buffers:
+            raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (resolver.chromnames[samline_list[0].chromid], samline_list[0].rname))
+
+        if sorted_input:
+            # When a new chromosome starts, reads for the previous one are flushed and its sweeps are dropped
+            if samline_list[0].chromid != chromid:
+                for unit in create_work_units(partlist, part_buffers, None, unit_size, part_sweeps):
+                    yield unit
+                for name in partlist:
+                    part_buffers[name] = []
+                num_buffered = 0
+                part_sweeps = {}
+                chromid = samline_list[0].chromid
+            if partname not in part_sweeps:
+                part_sweeps[partname] = Annotation_formats.AnnotationSweep(part_annotations[partname])
+
+        part_buffers[partname].append(samline_list)
+        num_buffered += 1
+
+        if len(part_buffers[partname]) >= unit_size:
+            for unit in create_work_units([partname], part_buffers, None, unit_size, part_sweeps):
+                yield unit
+            num_buffered -= len(part_buffers[partname])
+            part_buffers[partname] = []
+            if sorted_input:
+                part_sweeps[partname].advance(firstpos)
+        elif num_buffered >= max_buffered:
+            for unit in create_work_units(partlist, part_buffers, None, unit_size, part_sweeps):
+                yield unit
+            for name in partlist:
+                part_buffers[name] = []
+            num_buffered = 0
+            if sorted_input:
+                for sweep in part_sweeps.itervalues():
+                    sweep.advance(firstpos)
+
+    for unit in create_work_units(partlist, part_buffers, None, unit_size, part_sweeps):
+        yield unit
+
+    report.num_alignments = sam_counts['num_lines']
+    report.num_unique_alignments = sam_counts['num_unique_lines']
+    report.num_real_alignments = num_samlines
+    report.num_real_split_alignments = num_real_split
+    report.num_non_alignments = report.num_alignments - num_samlines
+    report.num_evaluated_alignments = num_samlines
+    if report.num_good_quality > 0:
+        report.avg_mapping_quality = sumq / report.num_good_quality
+
+
+
+# Report fields describing the SAM file, calculated while loading it (or while streaming it)
+SAM_STATS = ['num_alignments', 'num_unique_alignments', 'num_multi_alignments', 'num_possibly_split_alignements',
+             'num_split_alignments', 'num_non_alignments', 'num_real_alignments', 'num_real_split_alignments',
+             'num_evaluated_alignments', 'avg_mapping_quality', 'min_mapping_quality', 'max_mapping_quality',
+             'num_good_quality', 'num_zero_quality', 'unmapped_names']
+
+
+# Report fields describing annotations, calculated by calc_annotation_stats
+ANNOTATION_STATS = ['totalGeneLength', 'num_genes', 'num_multiexon_genes', 'max_exons_per_gene', 'num_exons',
+                    'min_gene_length', 'max_gene_length', 'avg_gene_length',
+                    'min_exon_length', 'max_exon_length', 'avg_exon_length']
+
+# Calculates general statistics for a list of annotations
+# Returns a dictionary with a value for each report field in ANNOTATION_STATS
+def calc_annotation_stats(annotations):
+    stats = dict((name, 0) for name in ANNOTATION_STATS)
+    stats['num_genes'] = len(annotations)
+    stats['max_exons_per_gene'] = 1       # Can not be less than 1
+    sumGeneLength = 0.0
+    sumExonLength = 0.0
+    for annotation in annotations:
+        if len(annotation.items) > 1:
+            stats['num_multiexon_genes'] += 1
+
+        # Determining a maximum number of exons per gene
+        if len(annotation.items) > stats['max_exons_per_gene']:
+            stats['max_exons_per_gene'] = len(annotation.items)
+
+        stats['totalGeneLength'] += annotation.getLength()
+        stats['num_exons'] += len(annotation.items)
+        glength = annotation.getLength()
+        if glength < stats['min_gene_length'] or stats['min_gene_length'] == 0:
+            stats['min_gene_length'] = glength
+        if glength > stats['max_gene_length'] or stats['max_gene_length'] == 0:
+            stats['max_gene_length'] = glength
+        sumGeneLength += glength
+        for item in annotation.items:
+            elength = item.getLength()
+            if elength < stats['min_exon_length'] or stats['min_exon_length'] == 0:
+                stats['min_exon_length'] = elength
+            if elength > stats['max_exon_length'] or stats['max_exon_length'] == 0:
+                stats['max_exon_length'] = elength
+            sumExonLength += elength
+    stats['avg_gene_length'] = sumGeneLength / stats['num_genes']
+    stats['avg_exon_length'] = sumExonLength / stats['num_exons']
+
+    return stats
+
+
+# Annotation cache is stored next to the annotation file (<annotations file>.cache)
+# It contains annotations sorted according to position and their statistics, saved using cPickle
+# The cache is valid only for an annotation file with the same fingerprint and for the same cache version
+ANNOTATION_CACHE_VERSION = 1
+ANNOTATION_CACHE_EXT = '.cache'
+FINGERPRINT_SAMPLE_SIZE = 1 << 20       # Number of bytes from the start and the end of a file used for its fingerprint
+
+# Calculates a fingerprint of a file: its size, modification time and
+# md5 hash of its beginning and end (hashing a whole GTF file would take too long)
+def get_file_fingerprint(filename):
+    size = os.path.getsize(filename)
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as file:
+        md5.update(file.read(FINGERPRINT_SAMPLE_SIZE))
+        if size > FINGERPRINT_SAMPLE_SIZE:
+            file.seek(max(FINGERPRINT_SAMPLE_SIZE, size - FINGERPRINT_SAMPLE_SIZE))
+            md5.update(file.read(FINGERPRINT_SAMPLE_SIZE))
+    return [size, os.path.getmtime(filename), md5.hexdigest()]
+
+
+# Loads annotations and their statistics from the cache
+# Returns [annotations, stats], or [None, None] if the cache does not exist or is stale
+def load_annotation_cache(annotations_file):
+    cache_file = annotations_file + ANNOTATION_CACHE_EXT
+    if not os.path.exists(cache_file):
+        return [None, None]
+
+    try:
+        with open(cache_file, 'rb') as file:
+            # Cache header is stored separately, so that a stale cache is detected without loading annotations
+            header = cPickle.load(file)
+            if header['version'] != ANNOTATION_CACHE_VERSION or header['fingerprint'] != get_file_fingerprint(annotations_file):
+                sys.stderr.write('\n(%s) Annotation cache %s is stale, loading annotations from file ... ' % (datetime.now().time().isoformat(), cache_file))
+                return [None, None]
+            [annotations, stats] = cPickle.load(file)
+    except Exception, e:
+        sys.stderr.write('\nWARNING: Unable to read annotation cache %s (%s)!' % (cache_file, str(e)))
+        return [None, None]
+
+    sys.stderr.write('\n(%s) Loaded annotations from cache %s ... ' % (datetime.now().time().isoformat(), cache_file))
+    return [annotations, stats]
+
+
+# Saves annotations and their statistics to the cache
+# If the cache can not be written (e.g. read-only folder), annotations are simply not cached
+def save_annotation_cache(annotations_file, annotations, stats):
+    cache_file = annotations_file + ANNOTATION_CACHE_EXT
+    header = {'version' : ANNOTATION_CACHE_VERSION, 'fingerprint' : get_file_fingerprint(annotations_file)}
+
+    # Writing to a temporary file first, so that other runs never see a partially written cache
+    temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as file:
+            cPickle.dump(header, file, 2)
+            cPickle.dump([annotations, stats], file, 2)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError), e:
+        sys.stderr.write('\nWARNING: Unable to write annotation cache %s (%s)!' % (cache_file, str(e)))
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
 
 def load_and_process_annotations(annotations_file, paramdict, report):
     processChromNames = True
     if '--leave_chrom_names' in paramdict:
         processChromNames = False
 
-    # Reading annotation file
-    annotations = Annotation_formats.Load_Annotation_From_File(annotations_file)
+    use_cache = True
+    if '--no_annotation_cache' in paramdict:
+        use_cache = False
+
+    annotations = None
+    if use_cache:
+        [annotations, stats] = load_annotation_cache(annotations_file)
 
-    # Sorting annotations according to position
-    # NOTE: Might not be necessary because they are generally already sorted in a file
-    annotations.sort(reverse=False, key=lambda annotation: annotation.start)
+    if annotations is None:
+        # Reading annotation file
+        annotations = Annotation_formats.Load_Annotation_From_File(annotations_file)
+
+        # Sorting annotations according to position
+        # NOTE: Might not be necessary because they are generally already sorted in a file
+        annotations.sort(reverse=False, key=lambda annotation: annotation.start)
+
+        stats = calc_annotation_stats(annotations)
+        if use_cache:
+            save_annotation_cache(annotations_file, annotations, stats)
 
     # Analyzing annotations
+    for name in ANNOTATION_STATS:
+        setattr(report, name, stats[name])
 
     # Looking at expressed genes, ones that overlap with at least one read in SAM file
     # Storing them in a dictionary together with a number of hits for each exon in the gene
@@ -399,65 +1004,295 @@ def load_and_process_annotations(annotations_file, paramdict, report):
     # Each gene has one global counter (index 0), and one counter for each exon
     gene_coverage = {}
 
-    report.totalGeneLength = 0
-    report.num_genes = len(annotations)
-    report.max_exons_per_gene = 1       # Can not be less than 1
-    report.num_exons = 0
-    sumGeneLength = 0.0
-    sumExonLength = 0.0
+    resolver = getChromResolver(processChromNames)
+
     for annotation in annotations:
         # Initializing a list of counters for a gene
         # Each gene has one global counted (index 0), and one counter for each exon
         expressed_genes[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
         gene_coverage[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
 
-        if len(annotation.items) > 1:
-            report.num_multiexon_genes += 1
-
-        # Determining a maximum number of exons per gene
-        if len(annotation.items) > report.max_exons_per_gene:
-            report.max_exons_per_gene = len(annotation.items)
-
-        report.totalGeneLength += annotation.getLength()
-        chromname = getChromName(annotation.seqname, processChromNames)
+        # Chromosome ids depend on the order in which names are resolved, so they are never cached
+        annotation.chromid = resolver.getChromId(annotation.seqname)
+        chromname = resolver.chromnames[annotation.chromid]
         if chromname in report.chromlengths:
             report.chromlengths[chromname] += annotation.getLength()
         else:
             report.chromlengths[chromname] = annotation.getLength()
-        report.num_exons += len(annotation.items)
-        glength = annotation.getLength()
-        if glength < report.min_gene_length or report.min_gene_length == 0:
-            report.min_gene_length = glength
-        if glength > report.max_gene_length or report.max_gene_length == 0:
-            report.max_gene_length = glength
-        sumGeneLength += glength
-        for item in annotation.items:
-            elength = item.getLength()
-            if elength < report.min_exon_length or report.min_exon_length == 0:
-                report.min_exon_length = elength
-            if elength > report.max_exon_length or report.max_exon_length == 0:
-                report.max_exon_length = elength
-            sumExonLength += elength
-    report.avg_gene_length = sumGeneLength / report.num_genes
-    report.avg_exon_length = sumExonLength / report.num_exons
 
     return annotations, expressed_genes, gene_coverage
 
 
+# Returns the name of the status file to which progress is written (--status_file parameter), or an empty string
+def get_status_file(paramdict):
+    if '--status_file' in paramdict:
+        return paramdict['--status_file'][0]
+    return ''
+
+
+# Returns the number of worker processes to use, set by -t (--threads) parameter
+def getNumThreads(paramdict):
+    num_threads = NUM_PROCESS
+    if '-t' in paramdict:
+        num_threads = int(paramdict['-t'][0])
+    elif '--threads' in paramdict:
+        num_threads = int(paramdict['--threads'][0])
+
+    if num_threads < 1:
+        raise Exception('\nERROR: Invalid number of threads (%d)!' % num_threads)
+
+    return num_threads
+
+
+# Returns allowed inaccuracy and minimum overlap used when comparing alignments to exons,
+# set by -ai (--alowed_inaccurycy) and -mo (--min_overlap) parameters
+def get_tolerances(paramdict):
+    allowed_inacc = Annotation_formats.DEFAULT_ALLOWED_INACCURACY       # Allowing some shift in positions
+    min_overlap = Annotation_formats.DEFAULT_MINIMUM_OVERLAP            # Minimum overlap that is considered
+
+    if '-ai' in paramdict:
+        allowed_inacc = int(paramdict['-ai'][0])
+    elif '--alowed_inaccurycy' in paramdict:
+        allowed_inacc = int(paramdict['--alowed_inaccurycy'][0])
+
+    if '-mo' in paramdict:
+        min_overlap = int(paramdict['-mo'][0])
+    elif '--min_overlap' in paramdict:
+        min_overlap = int(paramdict['--min_overlap'][0])
+
+    return [allowed_inacc, min_overlap]
+
+
+# Returns a list of tolerance settings (allowed inaccuracy, minimum overlap) for which alignments are evaluated
+# Several settings can be given with --sweep parameter (ai1:mo1,ai2:mo2,...), otherwise only one setting is used
+def get_tolerance_settings(paramdict):
+    if '--sweep' not in paramdict:
+        return [tuple(get_tolerances(paramdict))]
+
+    tolerances = []
+    for setting in paramdict['--sweep'][0].split(','):
+        elements = setting.split(':')
+        if len(elements) != 2:
+            raise Exception('\nERROR: Invalid tolerance setting %s, expected <allowed inaccuracy>:<minimum overlap>!' % setting)
+        tolerances.append((int(elements[0]), int(elements[1])))
+    return tolerances
+
+
+# Calculates a reference span (start and end position) of an alignment
+# A distance between the start of the first alignment and the end of the last alignment
+# for all parts of a split alignment
+def get_alignment_span(samline_list):
+    readrefstart = -1
+    readrefend = -1
+    for samline in samline_list:
+        start = samline.pos
+        reflength = get_compact_cigar(samline).reflength
+        end = start + reflength
+
+        if readrefstart == -1 or readrefstart > start:
+            readrefstart = start
+        if readrefend == -1 or readrefend < end:
+            readrefend = end
+
+    return readrefstart, readrefend
+
+
+# Walks reads (lists of alignments) and annotations together in position order and yields, for each read,
+# the read, its reference span and all annotations overlapping the span
+# Reads must be sorted according to the start of their span and annotations according to their start,
+# only annotations that can overlap the current read are kept (see Annotation_formats.AnnotationSweep)
+def sweep_reads(samlines, annotations):
+    sweep = Annotation_formats.AnnotationSweep(annotations)
+    for samline_list in samlines:
+        readrefstart, readrefend = get_alignment_span(samline_list)
+        sweep.advance(readrefstart)
+        yield samline_list, readrefstart, readrefend, sweep.findOverlapping(readrefstart, readrefend)
+
+
+# Determines how many reads should be placed in a single work unit
+def get_work_unit_size(num_reads, num_threads):
+    unit_size = num_reads / (num_threads * WORK_UNITS_PER_PROCESS)
+    if unit_size < WORK_UNIT_MIN_READS:
+        unit_size = WORK_UNIT_MIN_READS
+    return unit_size
+
+
+# Splits reads from all parts (chromosomes/strands) into work units for worker processes
+# Each work unit is a list of pieces, a piece is a tuple (partname, samlines, annotations)
+# Parts with many reads are split into several pieces, each covering a window of consecutive reads
+# (reads are sorted according to position). Each piece gets all annotations that overlap any of its reads,
+# so reads that straddle a window boundary are evaluated against the same annotations as they would be
+# without splitting. Small parts (e.g. small contigs) are batched together into a single work unit.
+# If part_annotations is None, pieces do not contain annotations and workers use their own (see init_worker)
+# If part_sweeps is given, annotations for each piece are found using the sweep for its part (see stream_work_units)
+def create_work_units(partlist, part_samlines, part_annotations, unit_size, part_sweeps = None):
+    units = []
+    pieces = []
+    unit_reads = 0
+    for partname in partlist:
+        samlines = part_samlines[partname]
+        if len(samlines) == 0:
+            continue
+
+        if part_sweeps is not None:
+            part_index = part_sweeps[partname]
+        elif part_annotations is None:
+            part_index = None
+        else:
+            part_index = Annotation_formats.AnnotationIndex(part_annotations[partname])
+        for i in xrange(0, len(samlines), unit_size):
+            window = samlines[i:i+unit_size]
+            window_annotations = None
+            if part_index is not None:
+                windowstart = -1
+                windowend = -1
+                for samline_list in window:
+                    readrefstart, readrefend = get_alignment_span(samline_list)
+                    if windowstart == -1 or windowstart > readrefstart:
+                        windowstart = readrefstart
+                    if windowend == -1 or windowend < readrefend:
+                        windowend = readrefend
+                window_annotations = part_index.findOverlapping(windowstart, windowend)
+
+            pieces.append((partname, window, window_annotations))
+            unit_reads += len(window)
+            if unit_reads >= unit_size:
+                units.append(pieces)
+                pieces = []
+                unit_reads = 0
+
+    if len(pieces) > 0:
+        units.append(pieces)
+
+    return units
+
+
+# Reference sequences and annotations (separated into parts) used by a worker process
+# They are set when the worker process is started, so that they do not have to be sent with each work unit
+# Annotations are only needed for work units without annotations (see create_work_units)
+worker_seqs = None
+worker_part_annotations = None
+
+def init_worker(seqs, part_annotations = None, progress_queue = None):
+    global worker_seqs, worker_part_annotations
+    worker_seqs = seqs
+    worker_part_annotations = part_annotations
+    progress.init_worker(progress_queue)
+
+
+# Name under which progress of per-base statistics is reported, when they are calculated without annotations
+PER_BASE_PART = 'per-base stats'
+
+# Counters calculated by calc_per_base_stats
+PER_BASE_COUNTERS = ['num_match', 'num_mismatch', 'num_insert', 'num_delete', 'num_lowmatchcnt', 'sum_read_length', 'sum_bases_aligned']
+
+def new_per_base_stats():
+    return dict((name, 0) for name in PER_BASE_COUNTERS)
+
+def add_per_base_stats(total, part):
+    for name in PER_BASE_COUNTERS:
+        total[name] += part[name]
+
+
+# Calculates general mapping statistics (Match/Mismatch/Insert/Delete) from extended CIGAR strings
+# Also counts reads with a low match count and the number of bases of each read that were aligned
+# Returns a dictionary with counters (see PER_BASE_COUNTERS), counters for different lists of alignments can be summed
+def calc_per_base_stats(samlines, seqs, chromname2seq, paramdict):
+    processChromNames = True
+    if '--leave_chrom_names' in paramdict:
+        processChromNames = False
+
+    chromnames = getChromResolver(processChromNames).chromnames
+
+    numMatch = 0
+    numMisMatch = 0
+    numInsert = 0
+    numDelete = 0
+    numLowMatchCnt = 0
+
+    total_read_length = 0
+    total_bases_aligned = 0
+
+    for samline_list in samlines:
+        # For checking cigar strings
+        t_numMatch = 0
+        t_numInsert = 0
+        t_numDelete = 0
+        t_numMisMatch = 0
+
+        # Calculate readlength from the first alignment (should be the same)
+        # and then see how many of those bases were actually aligned
+        readlength = get_compact_cigar(samline_list[0]).readlength
+        basesaligned = 0
+        for samline in samline_list:
+            chromname = chromnames[samline.chromid]
+            if chromname not in chromname2seq:
+                raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline.rname))
+            chromidx = chromname2seq[chromname]
+
+            try:
+                # Extended CIGAR is calculated and parsed only once for each alignment
+                extended_cigar = CompactCigar(calc_extended_cigar(samline, seqs[chromidx]))
+
+                for (length, op) in extended_cigar.operations:
+                    if op in ('M', '='):
+                        numMatch += length
+                        t_numMatch += length
+                        basesaligned += length
+                    elif op == 'I':
+                        t_numInsert += length
+                        numInsert += length
+                        basesaligned += length
+                    elif op == 'D':
+                        t_numDelete += length
+                        numDelete += length
+                    elif op =='X':
+                        t_numMisMatch += length
+                        numMisMatch += length
+                        basesaligned += length
+                    elif op in ('N', 'S', 'H', 'P'):
+                        pass
+                    else:
+                        sys.stderr.write('\nERROR: Invalid CIGAR string operation (%s)' % op)
+            except Exception, e:
+                sys.stderr.write('ERROR: querry/ref/pos/message = %s/%s/%d/%s \n' % (samline.qname, samline.rname, samline.pos, e.message))
+                pass
+
+        # Checking CIGAR strings for low match reads
+        if (t_numMatch < t_numMisMatch + t_numInsert + t_numDelete):
+            numLowMatchCnt += 1
+
+        total_read_length += readlength
+        total_bases_aligned += basesaligned
+        if basesaligned > readlength:
+            raise Exception('\nERROR counting aligned and total bases!')
+
+    return {'num_match' : numMatch,
+            'num_mismatch' : numMisMatch,
+            'num_insert' : numInsert,
+            'num_delete' : numDelete,
+            'num_lowmatchcnt' : numLowMatchCnt,
+            'sum_read_length' : total_read_length,
+            'sum_bases_aligned' : total_bases_aligned}
+
+
 # NOTE: refactoring the code for multiprocessing
-#     - Each process will handle reads and annotations for a single chomosome and strand
+#     - Each process will handle work units, each work unit contains reads and annotations
+#       for a single chomosome and strand, or for several small ones
 # Workflow:
 # 1. Sort Annotations and mappings (SAM fle) according to chromosome and strand
-# 2. For each dataset spawn a new processing
+# 2. Split them into work units and evaluate them using a pool of worker processes
 # 3. Collect data returned by multiple processes
 
 
 # A function that takes samlines and annotations (assumed to be for the same chromosome and strand)
-# This function is called inside a separate process
-def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq, out_q):
+# This function is called inside a worker process
+# Results are returned, or placed in out_q if it is given
+def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq, out_q = None):
 
-    allowed_inacc = Annotation_formats.DEFAULT_ALLOWED_INACCURACY       # Allowing some shift in positions
-    min_overlap = Annotation_formats.DEFAULT_MINIMUM_OVERLAP            # Minimum overlap that is considered
+    # Allowed inaccuracy and minimum overlap for comparing alignments to exons
+    # The evaluation is done for several tolerance settings at once when sweeping them
+    tolerances = get_tolerance_settings(paramdict)
 
     processChromNames = True
     if '--leave_chrom_names' in paramdict:
@@ -467,28 +1302,32 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
     if '--calc_new_annotations' in paramdict:
         calcNewAnnotations = True
 
-    # Setting allowed_inaccuracy from parameters
-    if '--allowed_inacc' in paramdict:
-        allowed_inacc = int(paramdict['--allowed_inacc'][0])
-    elif '-ai' in paramdict:
-        allowed_inacc = int(paramdict['-ai'][0])
-
-    # Setting minimum overlap from parameters
-    if '--allowed_inacc' in paramdict:
-        min_overlap = int(paramdict['--allowed_inacc'][0])
-    elif '-mo' in paramdict:
-        min_overlap = int(paramdict['-mo'][0])
-
     sys.stdout.write('\nStarting process %d...\n' % proc_id)
 
-    expressed_genes = {}
-    gene_coverage = {}
-    new_annotations = []
-    for annotation in annotations:
-        expressed_genes[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
-        gene_coverage[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
-
-    report = EvalReport(ReportType.TEMP_REPORT)
+    # Results (report, gene expression and coverage) are kept for each tolerance setting
+    reports = []
+    expressed_genes_list = []
+    gene_coverage_list = []
+    for (allowed_inacc, min_overlap) in tolerances:
+        expressed_genes = {}
+        gene_coverage = {}
+        for annotation in annotations:
+            expressed_genes[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
+            gene_coverage[annotation.genename] = [0 for i in xrange(len(annotation.items) + 1)]
+        report = EvalReport(ReportType.TEMP_REPORT)
+        report.allowed_inacc = allowed_inacc
+        report.min_overlap = min_overlap
+        reports.append(report)
+        expressed_genes_list.append(expressed_genes)
+        gene_coverage_list.append(gene_coverage)
+
+    chromnames = getChromResolver(processChromNames).chromnames
+
+    # Reads and annotations are walked together in position order to find candidate annotations for each read
+    # Reads are sorted according to the position of their first alignment, which is not always the start
+    # of their span (e.g. for split alignments), so they are sorted again according to the span
+    samlines = sorted(samlines, key = lambda samline_list: get_alignment_span(samline_list)[0])
+    annotations = sorted(annotations, key = lambda annotation: annotation.start)
 
     check_strand = True
     if '--no_check_strand' in paramdict:
@@ -506,21 +1345,13 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
     if '--old_bma_calc' in paramdict:
         old_bma_calc = True
 
-    num_hithalfbases = 0
+    for (samline_list, readrefstart, readrefend, overlapping_annotations) in sweep_reads(samlines, annotations):
+        progress.add_reads()
 
-    for samline_list in samlines:
         # Initializing information for a single read
         genescovered = []   # genes covered by an alignment
-        badsplit = False
-        hit = False
-        exonHit = False
-        isGood = False
-        isSpliced = False
-        exon_cnt = 0        # counting exons spanned by an alignement
         gene_cnt = 0        # counting genes spanned by an alignement
         num_alignments = len(samline_list)
-        num_misses = 0
-        isAlmostGood = False
         max_score = 0
         if num_alignments > 1:
             split = True
@@ -528,7 +1359,8 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
             split = False
 
         # Assuming that all parts of the split alignment are on the same chromosome
-        chromname = getChromName(samline_list[0].rname, processChromNames)
+        chromid = samline_list[0].chromid
+        chromname = chromnames[chromid]
         if chromname not in chromname2seq:
             raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline_list[0].rname))
         chromidx = chromname2seq[chromname]
@@ -541,22 +1373,8 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
         # - check for genes that it intersects
         # - then iterate over parts of alignment and exons to evaluate how well the alignment captures the transcript
 
-        # Calculating total alignment reference length for all parts of a split read
+        # Total alignment reference length for all parts of a split read (calculated in sweep_reads)
         # A distance between the start of the first alignment and the end of the last alignment
-        # If all split alignments of the read were sorted according to position, this could be done faster
-        readrefstart = -1
-        readrefend = -1
-        for samline in samline_list:
-            # start = samline.pos
-            start = samline.pos
-            reflength = samline.CalcReferenceLengthFromCigar()
-            end = start + reflength
-
-            if readrefstart == -1 or readrefstart > start:
-                readrefstart = start
-            if readrefend == -1 or readrefend < end:
-                readrefend = end
-
         readreflength = readrefend - readrefstart
         startpos = readrefstart
         endpos = readrefend
@@ -584,11 +1402,13 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
         # 3 - Calculate everything only for "the best match" annotation
 
         # Finding candidate annotations
+        # Only annotations overlapping the read are kept in the sweep window,
+        # chromosome and strand still have to be checked
         candidate_annotations = []
         best_match_annotation = None
-        for annotation in annotations:
+        for annotation in overlapping_annotations:
             # If its the same chromosome, the same strand and the read and the gene overlap, then proceed with analysis
-            if chromname == getChromName(annotation.seqname, processChromNames) \
+            if chromid == annotation.chromid \
                             and (not check_strand or (readstrand == annotation.strand)) \
                             and annotation.overlapsGene(startpos, endpos):
                 candidate_annotations.append(annotation)
@@ -605,7 +1425,7 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
                     score = 0
                     for samline in samline_list:
                         start = samline.pos
-                        reflength = samline.CalcReferenceLengthFromCigar()
+                        reflength = get_compact_cigar(samline).reflength
                         end = start + reflength
                         slBasesInside = 0
                         for item in cannotation.items:
@@ -630,7 +1450,7 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
                     score = 0
                     for samline in samline_list:
                         start = samline.pos
-                        reflength = samline.CalcReferenceLengthFromCigar()
+                        reflength = get_compact_cigar(samline).reflength
                         end = start + reflength
                         for item in cannotation.items:
                             bases = item.basesInside(start, end)
@@ -643,323 +1463,644 @@ def eval_mapping_part(proc_id, samlines, annotations, paramdict, chromname2seq,
         elif len(candidate_annotations) == 1:
             best_match_annotation = candidate_annotations[0]
 
-        exonhitmap = {}
-        exoncompletemap = {}
-        exonstartmap = {}
-        exonendmap = {}
-
-        if best_match_annotation is not None:
-            annotation = best_match_annotation      # So that I dont have to refactor the code
-
-            hit = True
-
-            if num_alignments > len(annotation.items):
-                # TODO: BAD split!! Alignment is split, but annotation is not!
-                badsplit = True
-                # sys.stderr.write('\nWARNING: Bad split alignment with more parts then annotation has exons!\n')
-
-            # Checking if the alignment covering annotations encompasses at least half the read
-            # max_score represents the number of bases of the read that are aligned within the candidate annotation
-            readlength = samline_list[0].CalcReadLengthFromCigar()
-            # sys.stderr.write('\nINFO: Maxscore = %d, readlength = %d' % (max_score, readlength))
-            if max_score > (readlength / 2):
-                num_hithalfbases += 1
-
-            # Updating gene expression
-            # Since all initial values for expression and coverage are zero, this could all probably default to case one
-            if annotation.genename in expressed_genes.keys():
-                expressed_genes[annotation.genename][0] += 1
-                gene_coverage[annotation.genename][0] += annotation.basesInsideGene(startpos, endpos)
-            else:
-                expressed_genes[annotation.genename][0] = 1
-                gene_coverage[annotation.genename][0] = annotation.basesInsideGene(startpos, endpos)
+        # Candidate annotations and the best matching annotation do not depend on tolerances
+        # Everything below is calculated separately for each tolerance setting
+        for k in xrange(len(tolerances)):
+            (allowed_inacc, min_overlap) = tolerances[k]
+            report = reports[k]
+            expressed_genes = expressed_genes_list[k]
+            gene_coverage = gene_coverage_list[k]
+
+            badsplit = False
+            hit = False
+            exonHit = False
+            isGood = False
+            isSpliced = False
+            exon_cnt = 0        # counting exons spanned by an alignement
+            num_misses = 0
+            isAlmostGood = False
+
+            exonhitmap = {}
+            exoncompletemap = {}
+            exonstartmap = {}
+            exonendmap = {}
+
+            if best_match_annotation is not None:
+                annotation = best_match_annotation      # So that I dont have to refactor the code
+
+                hit = True
+
+                if num_alignments > len(annotation.items):
+                    # TODO: BAD split!! Alignment is split, but annotation is not!
+                    badsplit = True
+                    # sys.stderr.write('\nWARNING: Bad split alignment with more parts then annotation has exons!\n')
+
+                # Checking if the alignment covering annotations encompasses at least half the read
+                # max_score represents the number of bases of the read that are aligned within the candidate annotation
+                readlength = get_compact_cigar(samline_list[0]).readlength
+                # sys.stderr.write('\nINFO: Maxscore = %d, readlength = %d' % (max_score, readlength))
+                if max_score > (readlength / 2):
+                    report.num_halfbases_hit += 1
+
+                # Updating gene expression
+                # Since all initial values for expression and coverage are zero, this could all probably default to case one
+                if annotation.genename in expressed_genes.keys():
+                    expressed_genes[annotation.genename][0] += 1
+                    gene_coverage[annotation.genename][0] += annotation.basesInsideGene(startpos, endpos)
+                else:
+                    expressed_genes[annotation.genename][0] = 1
+                    gene_coverage[annotation.genename][0] = annotation.basesInsideGene(startpos, endpos)
+
+                if annotation.insideGene(startpos, endpos):
+                    partial = False
+                else:
+                    partial = True
+
+                # Initialize exon hit map and exon complete map (also start and end map)
+                # Both have one entry for each exon
+                # Hit map collects how many times has each exon been hit by an alignment (it should be one or zero)
+                # Complete map collects which exons have been completely covered by an alignement
+                # Start map collects which exons are correctly started by an alignment (have the same starting position)
+                # End map collects which exons are correctly ended by an alignment (have the same ending position)
+                # NOTE: test this to see if it slows the program too much
+                exonhitmap = {(i+1):0 for i in xrange(len(annotation.items))}
+                exoncompletemap = {(i+1):0 for i in xrange(len(annotation.items))}
+                exonstartmap = {(i+1):0 for i in xrange(len(annotation.items))}
+                exonendmap = {(i+1):0 for i in xrange(len(annotation.items))}
+                num_misses = 0      # The number of partial alignments that do not overlap any exons
+                                    # Partial alignments that are smaller than allowed_inaccuracy, are not counted
+                for samline in samline_list:
+                    item_idx = 0
+                    lstartpos = samline.pos
+                    reflength = get_compact_cigar(samline).reflength
+                    lendpos = lstartpos + reflength
+                    exonhit = False
+                    for item in annotation.items:
+                        item_idx += 1
+                        if item.overlapsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                            exonhit = True
+                            exonhitmap[item_idx] += 1
+                            if item.equalsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                exoncompletemap[item_idx] = 1
+                                exonstartmap[item_idx] = 1
+                                exonendmap[item_idx] = 1
+                            elif item.startsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                exonstartmap[item_idx] = 1
+                            elif item.endsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                exonendmap[item_idx] = 1
+
+                            exon_cnt += 1
+                            if calculate_expression:
+                                expressed_genes[annotation.genename][item_idx] += 1
+                                gene_coverage[annotation.genename][item_idx] += item.basesInside(lstartpos, lendpos)
+                            exonHit = True
+                            if item.insideItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                exonPartial = False
+                            else:
+                                exonPartial = True
+
+                    # Checking if a partial alignment hit any exons
+                    if not exonhit and reflength > allowed_inacc:
+                        num_misses += 1
+                        # KK: Doesn't work within a separate process
+                        # import pdb
+                        # pdb.set_trace()
+
+                    # TODO: What to do if an exon is partially hit?
+                    # NOTE: Due to information in hit map and complete map
+                    #       This information might be unnecessary
+                    #       It can be deduced from exon maps
+
+                # Analyzing exon maps to extract some statistics
+                num_exons = len(annotation.items)
+                num_covered_exons = len([x for x in exonhitmap.values() if x > 0])      # Exons are considered covered if they are in the hit map
+                                                                                        # This means that they only have to be overlapping with an alignment!
+                if num_covered_exons > 0:
+                    report.num_cover_some_exons += 1    # For alignments covering multiple genes, this will be calculated more than once
+
+                if num_covered_exons == num_exons:
+                    report.num_cover_all_exons += 1
+
+                num_equal_exons = len([x for x in exoncompletemap.values() if x > 0])
+                report.num_equal_exons += num_equal_exons
+                report.num_partial_exons += num_covered_exons - num_equal_exons
+
+                # Exons covered by more than one part of a split alignment
+                multicover_exons = len([x for x in exonhitmap.values() if x > 1])
+                report.num_multicover_exons += multicover_exons
+
+                # Not sure what to do with this
+                report.num_undercover_alignments = 0
+                report.num_overcover_alignments = 0
+
+                # Exon start and end position
+                num_good_starts = len([x for x in exonstartmap.values() if x > 0])
+                num_good_ends = len([x for x in exonendmap.values() if x > 0])
+                report.num_good_starts += num_good_starts
+                report.num_good_ends += num_good_ends
+
+                isGood, isSpliced = isGoodSplitAlignment(exonhitmap, exoncompletemap, exonstartmap, exonendmap)
+
+                # KK: This should probably be included in the isGoodSplitAlignment function
+                isAlmostGood = False
+                if num_misses > 0:
+                    if isGood:
+                        isAlmostGood = True
+                    isGood = False
+
+                #KK: If the alignment starts or ends outside annotation, classify it as not good!
+                #    This was previously incorrect
+                if (startpos < best_match_annotation.start - allowed_inacc) or (endpos > best_match_annotation.end + allowed_inacc):
+                    isGood = False
 
-            if annotation.insideGene(startpos, endpos):
-                partial = False
             else:
-                partial = True
-
-            # Initialize exon hit map and exon complete map (also start and end map)
-            # Both have one entry for each exon
-            # Hit map collects how many times has each exon been hit by an alignment (it should be one or zero)
-            # Complete map collects which exons have been completely covered by an alignement
-            # Start map collects which exons are correctly started by an alignment (have the same starting position)
-            # End map collects which exons are correctly ended by an alignment (have the same ending position)
-            # NOTE: test this to see if it slows the program too much
-            exonhitmap = {(i+1):0 for i in xrange(len(annotation.items))}
-            exoncompletemap = {(i+1):0 for i in xrange(len(annotation.items))}
-            exonstartmap = {(i+1):0 for i in xrange(len(annotation.items))}
-            exonendmap = {(i+1):0 for i in xrange(len(annotation.items))}
-            num_misses = 0      # The number of partial alignments that do not overlap any exons
-                                # Partial alignments that are smaller than allowed_inaccuracy, are not counted
+                # No matching annotations were found
+                # TODO: Check if anything needs to be done here
+                # sys.stderr.write('\nNo matching annotations for %s' % samline_list[0].qname)
+                report.num_cover_no_exons += 1
+
+                if isSpliced:
+                    report.num_possible_spliced_alignment += 1
+
+                    # Calculating alignment start and end
             for samline in samline_list:
-                item_idx = 0
-                lstartpos = samline.pos
-                reflength = samline.CalcReferenceLengthFromCigar()
-                lendpos = lstartpos + reflength
-                exonhit = False
-                for item in annotation.items:
-                    item_idx += 1
-                    if item.overlapsItem(lstartpos, lendpos):
-                        exonhit = True
-                        exonhitmap[item_idx] += 1
-                        if item.equalsItem(lstartpos, lendpos):
-                            exoncompletemap[item_idx] = 1
-                            exonstartmap[item_idx] = 1
-                            exonendmap[item_idx] = 1
-                        elif item.startsItem(lstartpos, lendpos):
-                            exonstartmap[item_idx] = 1
-                        elif item.endsItem(lstartpos, lendpos):
-                            exonendmap[item_idx] = 1
-
-                        exon_cnt += 1
-                        if calculate_expression:
-                            expressed_genes[annotation.genename][item_idx] += 1
-                            gene_coverage[annotation.genename][item_idx] += item.basesInside(lstartpos, lendpos)
-                        exonHit = True
-                        if item.insideItem(lstartpos, lendpos):
-                            exonPartial = False
-                        else:
-                            exonPartial = True
-
-                # Checking if a partial alignment hit any exons
-                if not exonhit and reflength > allowed_inacc:
-                    num_misses += 1
-                    # KK: Doesn't work within a separate process
-                    # import pdb
-                    # pdb.set_trace()
-
-                # TODO: What to do if an exon is partially hit?
-                # NOTE: Due to information in hit map and complete map
-                #       This information might be unnecessary
-                #       It can be deduced from exon maps
-
-            # Analyzing exon maps to extract some statistics
-            num_exons = len(annotation.items)
-            num_covered_exons = len([x for x in exonhitmap.values() if x > 0])      # Exons are considered covered if they are in the hit map
-                                                                                    # This means that they only have to be overlapping with an alignment!
-            if num_covered_exons > 0:
-                report.num_cover_some_exons += 1    # For alignments covering multiple genes, this will be calculated more than once
-
-            if num_covered_exons == num_exons:
-                report.num_cover_all_exons += 1
-
-            num_equal_exons = len([x for x in exoncompletemap.values() if x > 0])
-            report.num_equal_exons += num_equal_exons
-            report.num_partial_exons += num_covered_exons - num_equal_exons
-
-            # Exons covered by more than one part of a split alignment
-            multicover_exons = len([x for x in exonhitmap.values() if x > 1])
-            report.num_multicover_exons += multicover_exons
-
-            # Not sure what to do with this
-            report.num_undercover_alignments = 0
-            report.num_overcover_alignments = 0
-
-            # Exon start and end position
-            num_good_starts = len([x for x in exonstartmap.values() if x > 0])
-            num_good_ends = len([x for x in exonendmap.values() if x > 0])
-            report.num_good_starts += num_good_starts
-            report.num_good_ends += num_good_ends
-
-            isGood, isSpliced = isGoodSplitAlignment(exonhitmap, exoncompletemap, exonstartmap, exonendmap)
-
-            # KK: This should probably be included in the isGoodSplitAlignment function
-            isAlmostGood = False
+                # start = samline.pos
+                start = samline.pos
+                reflength = get_compact_cigar(samline).reflength
+                end = start + reflength
+
+                if readrefstart == -1 or readrefstart > start:
+                    readrefstart = start
+                if readrefend == -1 or readrefend < end:
+                    readrefend = end
+
+            readreflength = readrefend - readrefstart
+            startpos = readrefstart
+            endpos = readrefend
+
+            # Checking for possible new annotations
+            # If the best_match_annotation does not produce a "correct" alignment, maybe it can be improved by combinig it 
+            # with other annotation from the candidate annotations set
+            # For each exon that is not correctly aligned (first exon can have misaligned beginning and last exon can have 
+            # misaligned end, other exons need to have correctly aligned beginning and end)
+            # For each exon that is not correctly aligned to the best match annotation, check another annotations to see if 
+            # it can be correctly aligned to any of them
+            # checking maps with values 0 or 1 for each exon: exonhitmap, exoncompletemap, exonstartmap, exonendmap
+            if calcNewAnnotations and best_match_annotation is not None and not isGood:
+                # Initializa new annotation
+                new_annotation = Annotation_formats.GeneDescription()
+                new_annotation.seqname = chromname
+                new_annotation.genename = "New annotation %d " % (len(report.pot_new_annotations)+1)
+                new_annotation.source = "From: " + best_match_annotation.genename
+                new_annotation.strand = best_match_annotation.strand
+                new_annotation.items = []
+                proposeNew = False      # Determines whether we want to propose a new annotation
+
+                # Adding best match annotation exons that are before the alignment, to the new alignment
+                for aitem in best_match_annotation.items:
+                    if aitem.end < startpos:
+                        new_annotation.items.append(aitem)
+            
+                # Check each partial alignment and compare it to exons in best annotation
+                for samline in samline_list:    # Find an alignment that overlaps the exon
+                    lstartpos = samline.pos
+                    reflength = get_compact_cigar(samline).reflength
+                    lendpos = lstartpos + reflength
+                    good = False
+                    replacementFound = False
+                    ovlitem = None
+                    for aitem in best_match_annotation.items:
+                        if aitem.overlapsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                            ovlitem = aitem
+                            if aitem.equalsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                good = True
+                            break
+
+                    # If partial aligment doesnt perfectly match the exon
+                    # Try to find a better match among other candidate annotations
+                    newItem = None
+                    if not good:
+                        for cannotation in candidate_annotations:
+                            for aitem in cannotation.items:
+                                if aitem.equalsItem(lstartpos, lendpos, allowed_inacc, min_overlap):
+                                    replacementFound = True
+                                    newItem = aitem
+
+                    # If the replacement exon is found, place it in the new annotation, otherwise place old exon (if it exists)
+                    if replacementFound:
+                        new_annotation.items.append(newItem)
+                    elif ovlitem is not None:
+                        new_annotation.items.append(ovlitem)
+                        proposeNew = True
+
+                # Adding best match annotation exons that are after the alignment,to the new alignment
+                for aitem in best_match_annotation.items:
+                    if aitem.start > endpos:
+                        new_annotation.items.append(aitem)
+
+                # If better exon matches have been found, propose a new annotation
+                # (new annotations are collapsed already here, so that fewer of them are sent back from workers)
+                if proposeNew:
+                    report.add_new_annotation(new_annotation, [samline_list[0].qname])
+
+            readreflength = readrefend - readrefstart
+            startpos = readrefstart
+            endpos = readrefend
+
             if num_misses > 0:
-                if isGood:
-                    isAlmostGood = True
-                isGood = False
+                report.num_partial_exon_miss += 1
+
+            if isGood:
+                report.num_good_alignment += 1
+                if save_qnames:
+                    report.contig_names.append(samline_list[0].qname)
+                if isSpliced:
+                    report.num_hit_all += 1
+            else:
+                report.num_bad_alignment += 1
 
-            #KK: If the alignment starts or ends outside annotation, classify it as not good!
-            #    This was previously incorrect
-            if (startpos < best_match_annotation.start - allowed_inacc) or (endpos > best_match_annotation.end + allowed_inacc):
-                isGood = False
+            if isAlmostGood:
+                report.num_almost_good += 1
 
-        else:
-            # No matching annotations were found
-            # TODO: Check if anything needs to be done here
-            # sys.stderr.write('\nNo matching annotations for %s' % samline_list[0].qname)
-            report.num_cover_no_exons += 1
+            if exon_cnt > 1:
+                report.num_multi_exon_alignments += 1
+            elif exon_cnt == 0:
+                report.num_cover_no_exons += 1
 
-            if isSpliced:
-                report.num_possible_spliced_alignment += 1
+            if len(genescovered) > 1:
+                report.num_multi_gene_alignments += 1
 
-                # Calculating alignment start and end
-        for samline in samline_list:
-            # start = samline.pos
-            start = samline.pos
-            reflength = samline.CalcReferenceLengthFromCigar()
-            end = start + reflength
+            if badsplit:
+                report.num_bad_split_alignments += 1
 
-            if readrefstart == -1 or readrefstart > start:
-                readrefstart = start
-            if readrefend == -1 or readrefend < end:
-                readrefend = end
+                # This is obsolete
+                # Partial alignment hits are not calculated any more
+                # if hit and not partial:
+                #     report.num_hit_alignments += 1
+                # elif hit and partial:
+                #     report.num_partial_alignments += 1
+                # else:
+                #     report.num_missed_alignments += 1
 
-        readreflength = readrefend - readrefstart
-        startpos = readrefstart
-        endpos = readrefend
+            if hit:
+                report.num_hit_alignments += 1
+            else:
+                report.num_missed_alignments += 1
+
+                # This is obsolete
+                # Partial alignment hits are not calculated any more
+                # if exonHit and not exonPartial:
+                #     report.num_exon_hit += 1
+                # elif exonHit and exonPartial:
+                #     report.num_exon_partial += 1
+                # else:
+                #     report.num_exon_miss += 1
+
+            if exonHit:
+                report.num_exon_hit += 1
+                if save_qnames:
+                    report.hitone_names.append(samline_list[0].qname)
+            else:
+                report.num_exon_miss += 1
+                if save_qnames:
+                    report.incorr_names.append(samline_list[0].qname)
+
+            if hit and not exonHit:
+                report.num_inside_miss_alignments += 1
+
+                # IMPORTANT: Double counted !!!!!
+                # if len(genescovered) == 1 and not badsplit:
+                #     report.num_good_alignment += 1
+                # else:
+                #    report.num_bad_alignment += 1
+
+    # Returning results for each tolerance setting, in a compact form (see EvalReport.get_partial)
+    results = []
+    for k in xrange(len(tolerances)):
+        reports[k].expressed_genes = expressed_genes_list[k]
+        reports[k].gene_coverage = gene_coverage_list[k]
+        results.append(reports[k].get_partial())
+    sys.stdout.write('\nEnding process %d...\n' % proc_id)
+    if out_q is not None:
+        out_q.put(results)
+    return results
+
+
+# Evaluates all pieces of a single work unit, called inside a worker process
+# Returns evaluation results for each piece and per-base statistics for the whole work unit
+def eval_mapping_unit(args):
+    [unit_id, pieces, paramdict, chromname2seq] = args
+
+    per_base_stats = True
+    if '--no_per_base_stats' in paramdict:
+        per_base_stats = False
+
+    # When profiling, times are recorded for the whole work unit and for each piece,
+    # separately for per-base statistics and for the evaluation against annotations
+    profile = '--profile' in paramdict
+    task = None
+    if profile:
+        unit_start = profiler.measure()
+        task = {'unit' : unit_id, 'pid' : os.getpid(), 'parts' : []}
+
+    results = []
+    per_base = new_per_base_stats()
+    for (partname, samlines, annotations) in pieces:
+        progress.start_part(partname)
+        if annotations is None:
+            annotations = worker_part_annotations[partname]
+        if profile:
+            piece_start = profiler.measure()
+        if per_base_stats:
+            add_per_base_stats(per_base, calc_per_base_stats(samlines, worker_seqs, chromname2seq, paramdict))
+        if profile:
+            per_base_usage = profiler.measure_since(piece_start)
+        results.append(eval_mapping_part(unit_id, samlines, annotations, paramdict, chromname2seq))
+        if profile:
+            usage = profiler.measure_since(piece_start)
+            task['parts'].append({'part' : partname,
+                                  'reads' : len(samlines),
+                                  'start' : piece_start[0],
+                                  'wall' : usage['wall'],
+                                  'cpu' : usage['cpu'],
+                                  'per_base_wall' : per_base_usage['wall']})
+
+    progress.flush()
+    if profile:
+        task.update(profiler.measure_since(unit_start))
+        task['reads'] = sum(piece['reads'] for piece in task['parts'])
+    return [results, per_base, task]
+
+
+# Calculates per-base statistics for a list of alignments, called inside a worker process
+# Progress is reported for all alignments together, after the whole unit is evaluated
+def calc_per_base_unit(args):
+    [samlines, paramdict, chromname2seq] = args
+    per_base = calc_per_base_stats(samlines, worker_seqs, chromname2seq, paramdict)
+    progress.start_part(PER_BASE_PART)
+    progress.add_reads(len(samlines))
+    progress.flush()
+    return per_base
+
+
+# Query name files (-sqn option) for a single report, with names of reads that hit an exon, that are contiguous ...
+# Names are written while the results of work units are collected (see merge_unit_results),
+# so that they are never collected for the whole SAM file
+QNAME_FILE_SUFFIXES = [('hitone_names', '_hit1.names'),
+                       ('hithalfbases_names', '_hithalfbases.names'),
+                       ('contig_names', '_ctg.names'),
+                       ('incorr_names', '_bad.names'),
+                       ('unmapped_names', '_unmmapped.names')]
+
+class QnameFiles:
+
+    def __init__(self, out_filename):
+        self.files = collections.OrderedDict()
+        for (name, suffix) in QNAME_FILE_SUFFIXES:
+            self.files[name] = open(out_filename + suffix, 'w+')
+
+    # Writes a list of query names to the file for a given report field (e.g. hitone_names)
+    def write_names(self, name, qnames):
+        for qname in qnames:
+            self.files[name].write(qname + '\n')
+
+    # Writes all query names from a report and removes them from the report
+    def write(self, report):
+        for name in self.files:
+            self.write_names(name, getattr(report, name))
+            setattr(report, name, [])
+
+    def close(self):
+        for qname_file in self.files.itervalues():
+            qname_file.close()
+
+
+# Writes names of unmapped queries, collected in a report while loading (or streaming) a SAM file,
+# to query name files for all tolerance settings and removes them from the report
+def write_unmapped_names(report, qname_files):
+    if qname_files is not None:
+        for t_qname_files in qname_files:
+            t_qname_files.write_names('unmapped_names', report.unmapped_names)
+    report.unmapped_names = []
+
+
+# Adds the results of a single work unit (see eval_mapping_unit) to the total reports and per-base statistics
+# (evals contains [report, expressed_genes, gene_coverage] for each tolerance setting, gene expression and
+# coverage counters are also held by the report, see new_mapping_report, and are updated when merging)
+# Query names are written to their files (one QnameFiles for each tolerance setting), if they are given
+def merge_unit_results(evals, per_base, unit_result, qname_files = None):
+    PROFILER.start('merge')
+    [results, t_per_base, task] = unit_result
+    add_per_base_stats(per_base, t_per_base)
+    for piece_results in results:
+        for k in xrange(len(evals)):
+            t_report = report_from_partial(piece_results[k])
+            if qname_files is not None:
+                qname_files[k].write(t_report)
+            evals[k][0].merge(t_report)
+    if task is not None:
+        PROFILER.add_task(task)
+    PROFILER.stop('merge')
+
+    # Double counted!! (but since only relative values are taken into account, it's not relevant)
+    # report.num_good_alignment += t_report.num_good_alignment
+    # report.num_bad_alignment += t_report.num_bad_alignment
+
+
+# TODO: Refactor code, place some code in functions
+#       Rewrite analyzing SAM file, detecting multi and split alignments
+# Loads reference and annotations and separates annotations according to chromosome (and strand)
+# Returns a dictionary with everything needed to evaluate one or more SAM files (see eval_mapping_sam)
+# Reference and annotation statistics are stored in a template report, which is copied for each SAM file
+def load_mapping_context(ref_file, annotations_file, paramdict):
+    processChromNames = True
+    if '--leave_chrom_names' in paramdict:
+        processChromNames = False
+
+    check_strand = True
+    if '--no_check_strand' in paramdict:
+        check_strand = False
+
+    report = EvalReport(ReportType.MAPPING_REPORT)
+
+    sys.stderr.write('\n(%s) Loading and processing FASTA reference ... ' % datetime.now().time().isoformat())
+    PROFILER.start('reference load')
+    [chromname2seq, headers, seqs, quals] = load_and_process_reference(ref_file, paramdict, report)
+    PROFILER.stop('reference load')
+
+    sys.stderr.write('\n(%s) Loading and processing annotations file ... ' % datetime.now().time().isoformat())
+    PROFILER.start('annotation load')
+    annotations, expressed_genes, gene_coverage = load_and_process_annotations(annotations_file, paramdict, report)
+
+    chromnames = getChromResolver(processChromNames).chromnames
+
+    # Separating Annotations according to chromosome and strand
+    partlist = []       # A list of keys of parts for processing
+                        # Each part represents a single chromosome strand
+    part_annotations = {}       # A dictionarry containing a list of annotations for each part
+
+    # If separating for the strand
+    if check_strand:
+        for chromname in chromname2seq.keys():      # Initializing
+            partlist.append(chromname + '+')
+            partlist.append(chromname + '-')
+            part_annotations[chromname + '+'] = []
+            part_annotations[chromname + '-'] = []
+
+        # Separating annotations expressed genes and gene coverage
+        for annotation in annotations:
+            partname = ''
+            chromname = chromnames[annotation.chromid]
+            if annotation.strand == Annotation_formats.GFF_STRANDFW:
+                partname = chromname + '+'
+            else:
+                partname = chromname + '-'
+            part_annotations[partname].append(annotation)
+
+    # Not separating according to the strand
+    else:
+        for chromname in chromname2seq.keys():      # Initializing
+            partlist.append(chromname)
+            part_annotations[chromname] = []
+
+        # Separating annotations expressed genes and gene coverage
+        for annotation in annotations:
+            chromname = chromnames[annotation.chromid]
+            partname = chromname
+            try:
+                part_annotations[partname].append(annotation)
+            except Exception:
+                import pdb
+                pdb.set_trace()
+
+    PROFILER.stop('annotation load')
+
+    return {'report' : report,
+            'chromname2seq' : chromname2seq,
+            'seqs' : seqs,
+            'annotations' : annotations,
+            'expressed_genes' : expressed_genes,
+            'gene_coverage' : gene_coverage,
+            'partlist' : partlist,
+            'part_annotations' : part_annotations}
+
+
+# Creates a report for a single SAM file, with reference and annotation statistics copied from the template report
+# Returns [report, expressed_genes, gene_coverage], expression counters initially contain all genes with zero counts
+def new_mapping_report(context, paramdict):
+    template = context['report']
+    report = EvalReport(ReportType.MAPPING_REPORT)
+    if '-ex' in paramdict or '--expression' in paramdict:
+        report.output_gene_expression = True
+
+    report.reflength = template.reflength
+    report.chromlengths = dict(template.chromlengths)
+    for name in ANNOTATION_STATS:
+        setattr(report, name, getattr(template, name))
+
+    expressed_genes = {}
+    gene_coverage = {}
+    for genename, counters in context['expressed_genes'].iteritems():
+        expressed_genes[genename] = [0 for i in xrange(len(counters))]
+        gene_coverage[genename] = [0 for i in xrange(len(counters))]
+    report.expressed_genes = expressed_genes
+    report.gene_coverage = gene_coverage
+
+    return [report, expressed_genes, gene_coverage]
+
+
+# Creates a pool of worker processes for evaluating SAM files
+# Worker processes get reference sequences, annotations and a queue for reporting progress
+# when they are started (see init_worker), progress is collected by a monitor stored in the context
+def create_mapping_pool(context, paramdict):
+    num_threads = getNumThreads(paramdict)
+    context['progress'] = progress.ProgressMonitor(get_status_file(paramdict))
+    return multiprocessing.Pool(processes = num_threads, initializer = init_worker, initargs = (context['seqs'], context['part_annotations'], context['progress'].queue))
 
-        # Checking for possible new annotations
-        # If the best_match_annotation does not produce a "correct" alignment, maybe it can be improved by combinig it 
-        # with other annotation from the candidate annotations set
-        # For each exon that is not correctly aligned (first exon can have misaligned beginning and last exon can have 
-        # misaligned end, other exons need to have correctly aligned beginning and end)
-        # For each exon that is not correctly aligned to the best match annotation, check another annotations to see if 
-        # it can be correctly aligned to any of them
-        # checking maps with values 0 or 1 for each exon: exonhitmap, exoncompletemap, exonstartmap, exonendmap
-        if calcNewAnnotations and best_match_annotation is not None and not isGood:
-            # Initializa new annotation
-            new_annotation = Annotation_formats.GeneDescription()
-            new_annotation.seqname = samline_list[0].qname
-            new_annotation.genename = "New annotation %d " % (len(new_annotations)+1)
-            new_annotation.source = "From: " + best_match_annotation.genename
-            new_annotation.strand = best_match_annotation.strand
-            new_annotation.items = []
-            proposeNew = False      # Determines whether we want to propose a new annotation
-
-            # Adding best match annotation exons that are before the alignment, to the new alignment
-            for aitem in best_match_annotation.items:
-                if aitem.end < startpos:
-                    new_annotation.items.append(aitem)
-            
-            # Check each partial alignment and compare it to exons in best annotation
-            for samline in samline_list:    # Find an alignment that overlaps the exon
-                lstartpos = samline.pos
-                reflength = samline.CalcReferenceLengthFromCigar()
-                lendpos = lstartpos + reflength
-                good = False
-                replacementFound = False
-                ovlitem = None
-                for aitem in best_match_annotation.items:
-                    if aitem.overlapsItem(lstartpos, lendpos):
-                        ovlitem = aitem
-                        if aitem.equalsItem(lstartpos, lendpos):
-                            good = True
-                        break
-
-                # If partial aligment doesnt perfectly match the exon
-                # Try to find a better match among other candidate annotations
-                newItem = None
-                if not good:
-                    for cannotation in candidate_annotations:
-                        for aitem in cannotation.items:
-                            if aitem.equalsItem(lstartpos, lendpos):
-                                replacementFound = True
-                                newItem = aitem
-
-                # If the replacement exon is found, place it in the new annotation, otherwise place old exon (if it exists)
-                if replacementFound:
-                    new_annotation.items.append(newItem)
-                elif ovlitem is not None:
-                    new_annotation.items.append(ovlitem)
-                    proposeNew = True
-
-            # Adding best match annotation exons that are after the alignment,to the new alignment
-            for aitem in best_match_annotation.items:
-                if aitem.start > endpos:
-                    new_annotation.items.append(aitem)
-
-            # If better exon matches have been found, propose a new annotation
-            if proposeNew:
-                new_annotations.append(new_annotation)
 
-        readreflength = readrefend - readrefstart
-        startpos = readrefstart
-        endpos = readrefend
+# Returns a list of reports, one for each tolerance setting (see get_tolerance_settings)
+# Output file names for the reports are used for query name files (see eval_mapping_sam)
+def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict, out_filenames = None):
 
-        report.num_halfbases_hit = num_hithalfbases
+    sys.stderr.write('\n')
+    sys.stderr.write('\n(%s) START: Evaluating mapping with annotations:' % datetime.now().time().isoformat())
 
-        if num_misses > 0:
-            report.num_partial_exon_miss += 1
+    context = load_mapping_context(ref_file, annotations_file, paramdict)
+    pool = create_mapping_pool(context, paramdict)
+    reports = eval_mapping_sam(context, sam_file, paramdict, pool, out_filenames)
 
-        if isGood:
-            report.num_good_alignment += 1
-            report.contig_names.append(samline_list[0].qname)
-            if isSpliced:
-                report.num_hit_all += 1
-        else:
-            report.num_bad_alignment += 1
+    # Wait for all processes to end
+    pool.close()
+    pool.join()
 
-        if isAlmostGood:
-            report.num_almost_good += 1
+    return reports
 
-        if exon_cnt > 1:
-            report.num_multi_exon_alignments += 1
-        elif exon_cnt == 0:
-            report.num_cover_no_exons += 1
 
-        if len(genescovered) > 1:
-            report.num_multi_gene_alignments += 1
+# Separates alignments (SAM lines) according to chromosome and strand, in the same way as annotations
+# are separated in load_mapping_context
+# Returns a dictionary with a list of alignments for each part in partlist
+def separate_samlines(samlines, partlist, paramdict):
+    processChromNames = True
+    if '--leave_chrom_names' in paramdict:
+        processChromNames = False
 
-        if badsplit:
-            report.num_bad_split_alignments += 1
+    check_strand = True
+    if '--no_check_strand' in paramdict:
+        check_strand = False
 
-            # This is obsolete
-            # Partial alignment hits are not calculated any more
-            # if hit and not partial:
-            #     report.num_hit_alignments += 1
-            # elif hit and partial:
-            #     report.num_partial_alignments += 1
-            # else:
-            #     report.num_missed_alignments += 1
+    chromnames = getChromResolver(processChromNames).chromnames
 
-        if hit:
-            report.num_hit_alignments += 1
-        else:
-            report.num_missed_alignments += 1
-
-            # This is obsolete
-            # Partial alignment hits are not calculated any more
-            # if exonHit and not exonPartial:
-            #     report.num_exon_hit += 1
-            # elif exonHit and exonPartial:
-            #     report.num_exon_partial += 1
-            # else:
-            #     report.num_exon_miss += 1
-
-        if exonHit:
-            report.num_exon_hit += 1
-            report.hitone_names.append(samline_list[0].qname)
-        else:
-            report.num_exon_miss += 1
-            report.incorr_names.append(samline_list[0].qname)
+    part_samlines = {}          # A dictionarry containing a list (or deper hierarchy) of samlines for each part
+    for partname in partlist:
+        part_samlines[partname] = []
 
-        if hit and not exonHit:
-            report.num_inside_miss_alignments += 1
+    # If separating for the strand
+    if check_strand:
+        # Separating SAM lines
+        for samline_list in samlines:
+            samline = samline_list[0]           # Looking only at the first samline in the list
+                                                # Due to previous processing, assuming that all
+                                                # others correspond to the same chromosome and strand
+            partname = ''
+            chromname = chromnames[samline.chromid]
+            if samline.flag & 16 == 0:
+                readstrand = Annotation_formats.GFF_STRANDFW
+                partname = chromname + '+'
+            else:
+                readstrand = Annotation_formats.GFF_STRANDRV
+                partname = chromname + '-'
 
-            # IMPORTANT: Double counted !!!!!
-            # if len(genescovered) == 1 and not badsplit:
-            #     report.num_good_alignment += 1
-            # else:
-            #    report.num_bad_alignment += 1
+            if partname not in part_samlines:
+                raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline.rname))
+            part_samlines[partname].append(samline_list)
 
-    report.pot_new_annotations = new_annotations
-    out_q.put([report, expressed_genes, gene_coverage])
-    sys.stdout.write('\nEnding process %d...\n' % proc_id)
-    pass
+    # Not separating according to the strand
+    else:
+        # Separating SAM lines
+        for samline_list in samlines:
+            samline = samline_list[0]           # Looking only at the first samline in the list
+                                                # Due to previous processing, assuming that all
+                                                # others correspond to the same chromosome and strand
+            chromname = chromnames[samline.chromid]
+            partname = chromname
+            if partname not in part_samlines:
+                raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline.rname))
+            part_samlines[partname].append(samline_list)
 
+    return part_samlines
 
-# TODO: Refactor code, place some code in functions
-#       Rewrite analyzing SAM file, detecting multi and split alignments
-def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
 
-    sys.stderr.write('\n')
-    sys.stderr.write('\n(%s) START: Evaluating mapping with annotations:' % datetime.now().time().isoformat())
+# Evaluates a single SAM file using loaded reference and annotations (see load_mapping_context)
+# and a pool of worker processes (see create_mapping_pool)
+# Returns a list of reports, one for each tolerance setting (see get_tolerance_settings)
+# Query names (-sqn option) are written while the SAM file is evaluated, to files named after
+# the output files of the reports (out_filenames, one for each tolerance setting)
+def eval_mapping_sam(context, sam_file, paramdict, pool, out_filenames = None):
 
     processChromNames = True
     if '--leave_chrom_names' in paramdict:
         processChromNames = False
 
-    calcNewAnnotations = False
-    if '--calc_new_annotations' in paramdict:
-        calcNewAnnotations = True
-
-    report = EvalReport(ReportType.MAPPING_REPORT)
-    if '-ex' in paramdict or '--expression' in paramdict:
-        report.output_gene_expression = True
-
     check_strand = True
     if '--no_check_strand' in paramdict:
         check_strand = False
@@ -977,14 +2118,33 @@ def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
         sys.stderr.write('\n(%s) Using option --graphmap ... ' % datetime.now().time().isoformat())        
         correct_gm = True
 
-    sys.stderr.write('\n(%s) Loading and processing FASTA reference ... ' % datetime.now().time().isoformat())
-    [chromname2seq, headers, seqs, quals] = load_and_process_reference(ref_file, paramdict, report)
+    stream_sam = False
+    if '--stream_sam' in paramdict or '--sorted_input' in paramdict:
+        stream_sam = True
 
-    sys.stderr.write('\n(%s) Loading and processing SAM file with mappings ... ' % datetime.now().time().isoformat())
-    samlines = load_and_process_SAM(sam_file, paramdict, report)
+    chromname2seq = context['chromname2seq']
+    partlist = context['partlist']
+    part_annotations = context['part_annotations']
 
-    sys.stderr.write('\n(%s) Loading and processing annotations file ... ' % datetime.now().time().isoformat())
-    annotations, expressed_genes, gene_coverage = load_and_process_annotations(annotations_file, paramdict, report)
+    # A report with gene expression and coverage is calculated for each tolerance setting
+    # SAM file statistics are collected in the first report and copied to the others at the end
+    tolerances = get_tolerance_settings(paramdict)
+    evals = [new_mapping_report(context, paramdict) for tolerance in tolerances]
+    report = evals[0][0]
+
+    qname_files = None
+    if save_qnames:
+        qname_files = [QnameFiles(out_filename) for out_filename in out_filenames]
+
+    # When streaming, SAM file is read later, while the alignments are being evaluated
+    if stream_sam:
+        samlines = []
+    else:
+        sys.stderr.write('\n(%s) Loading and processing SAM file with mappings %s ... ' % (datetime.now().time().isoformat(), sam_file))
+        PROFILER.start('SAM load')
+        samlines = load_and_process_SAM(sam_file, paramdict, report)
+        PROFILER.stop('SAM load')
+        write_unmapped_names(report, qname_files)
 
     numq = 0
     sumq = 0.0
@@ -1000,306 +2160,120 @@ def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
     sys.stderr.write('\n(%s) Calculating chosen quality statistics ... ' % datetime.now().time().isoformat())
     # Calculating chosen quality statistics
     # Separataing it from other analysis for clearer code
+    PROFILER.start('quality stats')
     for samline_list in samlines:
-        for samline in samline_list:
-            quality = samline.chosen_quality
-            if quality > 0:
-                report.num_good_quality += 1
-                if report.max_mapping_quality == 0 or report.max_mapping_quality < quality:
-                    report.max_mapping_quality = quality
-                if report.min_mapping_quality == 0 or report.min_mapping_quality > quality:
-                    report.min_mapping_quality = quality
-                numq += 1
-                sumq += quality
-            else:
-                report.num_zero_quality += 1
+        sumq += add_quality_stats(report, samline_list)
+    numq = report.num_good_quality
+    PROFILER.stop('quality stats')
 
 
     # Calculating general mapping statistics
     # Match/Mismatch/Insert/Delete
-    # TODO: Percentage of reads mapped
-    numMatch = 0
-    numMisMatch = 0
-    numInsert = 0
-    numDelete = 0
-    numLowMatchCnt = 0
-
-    total_read_length = 0
-    total_bases_aligned = 0
-    percentage_bases_aligned = 0.0
-
-    # Setting up some sort of a progress bar
-    if per_base_stats:
-        sys.stderr.write('\n(%s) Analyzing CIGAR strings ...  ' % datetime.now().time().isoformat())
-        sys.stderr.write('\nProgress: | 1 2 3 4 5 6 7 8 9 0 |')
-        sys.stderr.write('\nProgress: | ')
-        numsamlines = len(samlines)
-        progress = 0
-        currentbar = 0.1
+    # Per-base statistics are calculated by worker processes, together with the rest of the evaluation
+    # Since GraphMap correction changes alignment positions, it has to be applied before anything else
+    if per_base_stats and correct_gm:
         for samline_list in samlines:
-            # Calculating progress
-            progress += 1
-            if float(progress)/numsamlines >= currentbar:
-                sys.stderr.write('* ')
-                currentbar += 0.1
-            
-            # For checking cigar strings
-            t_numMatch = 0
-            t_numInsert = 0
-            t_numDelete = 0
-            t_numMisMatch = 0
-
-            # Calculate readlength from the first alignment (should be the same)
-            # and then see how many of those bases were actually aligned
-            readlength = samline_list[0].CalcReadLengthFromCigar()
-            basesaligned = 0
             for samline in samline_list:
-                chromname = getChromName(samline.rname, processChromNames)
-                if chromname not in chromname2seq:
-                    # import pdb
-                    # pdb.set_trace()
-                    raise Exception('\nERROR: Unknown chromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline.rname))
-                chromidx = chromname2seq[chromname]
-
-                # Testing code
-                try:
-                    if correct_gm and samline.flag & 16 != 0:
-                        samline.pos += 1
-                    cigar = samline.CalcExtendedCIGAR(seqs[chromidx])
-                    pos = samline.pos
-                    quals = samline.qual
-
-                    # Using regular expressions to find repeating digit and skipping one character after that
-                    # Used to separate CIGAR string into individual operations
-                    pattern = '(\d+)(.)'
-                    operations = re.findall(pattern, cigar)
-
-                    for op in operations:
-                        if op[1] in ('M', '='):
-                            numMatch += int(op[0])
-                            t_numMatch += int(op[0])
-                            basesaligned += int(op[0])
-                        elif op[1] == 'I':
-                            t_numInsert += int(op[0])
-                            numInsert += int(op[0])
-                            basesaligned += int(op[0])
-                        elif op[1] == 'D':
-                            t_numDelete += int(op[0])
-                            numDelete += int(op[0])
-                        elif op[1] =='X':
-                            t_numMisMatch += int(op[0])
-                            numMisMatch += int(op[0])
-                            basesaligned += int(op[0])
-                        elif op[1] in ('N', 'S', 'H', 'P'):
-                            pass
-                        else:
-                            sys.stderr.write('\nERROR: Invalid CIGAR string operation (%s)' % op[1])
-                except Exception, e:
-                    # import pdb
-                    # pdb.set_trace()
-                    sys.stderr.write('ERROR: querry/ref/pos/message = %s/%s/%d/%s \n' % (samline.qname, samline.rname, samline.pos, e.message))
-                    pass
-
-            # Checking CIGAR strings for low match reads
-            if (t_numMatch < t_numMisMatch + t_numInsert + t_numDelete):
-                strand = '+'
-                if samline_list[0].flag & 16 != 0:
-                    strand = '-'
-                numLowMatchCnt += 1
-                # sys.stderr.write('\nDEBUG: strand / match / mismatch / insert / delete: %c / %d / %d / %d / %d' % (strand, t_numMatch, t_numMisMatch, t_numInsert, t_numDelete))
-                # import pdb
-                # pdb.set_trace()
-            else:
-                pass
-                # import pdb
-                # pdb.set_trace()
-
-            total_read_length += readlength
-            total_bases_aligned += basesaligned
-            if basesaligned > readlength:
-                # import pdb
-                # pdb.set_trace()
-                raise Exception('\nERROR counting aligned and total bases!')
-                # TODO: See what happens here
-                pass
-
-    # Closing progress bar
-    sys.stderr.write('|')
-    sys.stderr.write('\nDone!')
-
-    if total_read_length == 0:
-        percentage_bases_aligned = -1
-    else:
-        percentage_bases_aligned = 100 * float(total_bases_aligned) / total_read_length
-
-    report.sum_read_length = total_read_length
-    report.sum_bases_aligned = total_bases_aligned
-    report.percentage_bases_aligned = percentage_bases_aligned
-
-    # Separating Annotations and Mappings (SAM lines) according to chromosome and strand
-    partlist = []       # A list of keys of parts for processing
-                        # Each part represents a single chromosome strand
-    part_samlines = {}          # A dictionarry containing a list (or deper hierarchy) of samlines for each part
-    part_annotations = {}       # A dictionarry containing a list of annotations for each part
-
-    # If separating for the strand
-    if check_strand:
-        for chromname in chromname2seq.keys():      # Initializing
-            partlist.append(chromname + '+')
-            partlist.append(chromname + '-')
-            part_samlines[chromname + '+'] = []
-            part_samlines[chromname + '-'] = []
-            part_annotations[chromname + '+'] = []
-            part_annotations[chromname + '-'] = []
-
-        # Separating SAM lines
-        for samline_list in samlines:
-            samline = samline_list[0]           # Looking only at the first samline in the list
-                                                # Due to previous processing, assuming that all
-                                                # others correspond to the same chromosome and strand
-            partname = ''
-            chromname = getChromName(samline.rname, processChromNames)
-            if samline.flag & 16 == 0:
-                readstrand = Annotation_formats.GFF_STRANDFW
-                partname = chromname + '+'
-            else:
-                readstrand = Annotation_formats.GFF_STRANDRV
-                partname = chromname + '-'
-
-            part_samlines[partname].append(samline_list)
-
-        # Separating annotations expressed genes and gene coverage
-        for annotation in annotations:
-            partname = ''
-            chromname = getChromName(annotation.seqname, processChromNames)
-            if annotation.strand == Annotation_formats.GFF_STRANDFW:
-                partname = chromname + '+'
-            else:
-                partname = chromname + '-'
-            part_annotations[partname].append(annotation)
-            genename = annotation.genename
-
-    # Not separating according to the strand
+                if samline.flag & 16 != 0:
+                    samline.pos += 1
+
+    # Separating Mappings (SAM lines) according to chromosome and strand
+    # Annotations have already been separated in the same way (see load_mapping_context)
+    PROFILER.start('partitioning')
+    part_samlines = separate_samlines(samlines, partlist, paramdict)
+
+    # Splitting reads into work units and evaluating them using a pool of worker processes
+    # Expression counters initially contain all genes (with zero counts),
+    # counts calculated by the workers are added to them
+    num_threads = getNumThreads(paramdict)
+    per_base = new_per_base_stats()
+    PROFILER.stop('partitioning')
+
+    # When streaming, evaluation includes reading the SAM file
+    # Merging results (see merge_unit_results) is a part of evaluation, but is also recorded separately
+    PROFILER.start('evaluation')
+    if stream_sam:
+        # Work units are created while reading the SAM file, and only a limited number of them
+        # can wait for evaluation at any time. Workers get annotations when they are started,
+        # unless the SAM file is sorted according to position (annotations are then sent with work units)
+        sys.stderr.write('\n(%s) Streaming SAM file with mappings and evaluating it using %d processes ... ' % (datetime.now().time().isoformat(), num_threads))
+        max_pending = num_threads * MAX_PENDING_UNITS_PER_PROCESS
+
+        pending = collections.deque()
+        num_units = 0
+        context['progress'].start(sam_file)
+        for unit in stream_work_units(sam_file, paramdict, report, partlist, STREAM_UNIT_READS, STREAM_UNIT_READS * max_pending, part_annotations):
+            num_units += 1
+            pending.append(pool.apply_async(eval_mapping_unit, ([num_units, unit, paramdict, chromname2seq],)))
+            write_unmapped_names(report, qname_files)
+            while len(pending) >= max_pending:
+                merge_unit_results(evals, per_base, pending.popleft().get(), qname_files)
+
+        write_unmapped_names(report, qname_files)
+        while len(pending) > 0:
+            merge_unit_results(evals, per_base, pending.popleft().get(), qname_files)
+        context['progress'].stop()
+        sys.stderr.write('\n(%s) Evaluated %d work units!' % (datetime.now().time().isoformat(), num_units))
     else:
-        for chromname in chromname2seq.keys():      # Initializing
-            partlist.append(chromname)
-            part_samlines[chromname] = []
-            part_annotations[chromname] = []
-
-        # Separating SAM lines
-        for samline_list in samlines:
-            samline = samline_list[0]           # Looking only at the first samline in the list
-                                                # Due to previous processing, assuming that all
-                                                # others correspond to the same chromosome and strand
-            try:
-                chromname = getChromName(samline.rname, processChromNames)
-                partname = chromname
-                part_samlines[partname].append(samline_list)
-            except Exception:
-                import pdb
-                pdb.set_trace()
-
-
-        # Separating annotations expressed genes and gene coverage
-        for annotation in annotations:
-            chromname = getChromName(annotation.seqname, processChromNames)
-            partname = chromname
-            try:
-                part_annotations[partname].append(annotation)
-            except Exception:
-                import pdb
-                pdb.set_trace()
+        PROFILER.start('partitioning')
+        unit_size = get_work_unit_size(len(samlines), num_threads)
+        units = create_work_units(partlist, part_samlines, part_annotations, unit_size)
+        PROFILER.stop('partitioning')
+        sys.stderr.write('\n(%s) Evaluating %d work units using %d processes ... ' % (datetime.now().time().isoformat(), len(units), num_threads))
+
+        unit_args = []
+        for unit_id in xrange(len(units)):
+            unit_args.append([unit_id + 1, units[unit_id], paramdict, chromname2seq])
+
+        sys.stderr.write('\n(%s) Collecting results!' % datetime.now().time().isoformat())
+
+        context['progress'].start(sam_file, dict((partname, len(part_samlines[partname])) for partname in partlist if len(part_samlines[partname]) > 0))
+        for unit_result in pool.imap_unordered(eval_mapping_unit, unit_args):
+            merge_unit_results(evals, per_base, unit_result, qname_files)
+        context['progress'].stop()
+    PROFILER.stop('evaluation')
+
+    if qname_files is not None:
+        for t_qname_files in qname_files:
+            t_qname_files.close()
+
+    PROFILER.start('finishing reports')
+    reports = []
+    for k in xrange(len(tolerances)):
+        [t_report, expressed_genes, gene_coverage] = evals[k]
+        for name in SAM_STATS:
+            setattr(t_report, name, copy.copy(getattr(report, name)))
+        (t_report.allowed_inacc, t_report.min_overlap) = tolerances[k]
+        finish_mapping_report(t_report, expressed_genes, gene_coverage, per_base, sumq, numq, paramdict)
+        reports.append(t_report)
+    PROFILER.stop('finishing reports')
 
-            genename = annotation.genename
+    sys.stderr.write('\n(%s) Done!' % datetime.now().time().isoformat())
+    sys.stderr.write('\n')
 
-    # import pdb
-    # pdb.set_trace()
+    return reports
 
-    # Spawning and calling processes
-    out_q = multiprocessing.Queue()
-    jobs = []
-    proc_id = 0
-    for partname in partlist:
-        proc_id += 1
-        t_samlines = part_samlines[partname]
-        t_annotations = part_annotations[partname]
-        proc = multiprocessing.Process(name=partname, target=eval_mapping_part, args=(proc_id, t_samlines, t_annotations, paramdict, chromname2seq, out_q,))
-        jobs.append(proc)
-        proc.start()
 
-    # TODO: Summarize results from different processes
-    sys.stderr.write('\n(%s) Collecting results!' % datetime.now().time().isoformat())
+# Calculates final results for a mapping report, from the results collected from all work units
+def finish_mapping_report(report, expressed_genes, gene_coverage, per_base, sumq, numq, paramdict):
+    calcNewAnnotations = False
+    if '--calc_new_annotations' in paramdict:
+        calcNewAnnotations = True
 
-    expressed_genes = {}
-    gene_coverage = {}
-    for i in xrange(len(jobs)):
-        [t_report, t_expressed_genes, t_gene_coverage] = out_q.get()
-        expressed_genes.update(t_expressed_genes)
-        gene_coverage.update(t_gene_coverage)
-        report.num_cover_some_exons += t_report.num_cover_some_exons
-        report.num_cover_all_exons += t_report.num_cover_all_exons
-        report.num_equal_exons += t_report.num_equal_exons
-        report.num_partial_exons += t_report.num_partial_exons
-        report.num_multicover_exons += t_report.num_multicover_exons
-        report.num_undercover_alignments = t_report.num_undercover_alignments
-        report.num_overcover_alignments = t_report.num_overcover_alignments
-        report.num_good_starts += t_report.num_good_starts
-        report.num_good_ends += t_report.num_good_ends
-        report.num_possible_spliced_alignment += t_report.num_possible_spliced_alignment
-        report.num_good_alignment += t_report.num_good_alignment
-        report.num_bad_alignment += t_report.num_bad_alignment
-        report.num_multi_exon_alignments += t_report.num_multi_exon_alignments
-        report.num_cover_no_exons += t_report.num_cover_no_exons
-        report.num_multi_gene_alignments += t_report.num_multi_gene_alignments
-        report.num_bad_split_alignments += t_report.num_bad_split_alignments
-        report.num_hit_alignments += t_report.num_hit_alignments
-        report.num_partial_alignments += t_report.num_partial_alignments
-        report.num_missed_alignments += t_report.num_missed_alignments
-        report.num_exon_hit += t_report.num_exon_hit
-        report.num_exon_partial += t_report.num_exon_partial
-        report.num_exon_miss += t_report.num_exon_miss
-        report.num_halfbases_hit += t_report.num_halfbases_hit
-        report.num_lowmatchcnt = t_report.num_lowmatchcnt
-        report.num_inside_miss_alignments += t_report.num_inside_miss_alignments
-        report.num_partial_exon_miss += t_report.num_partial_exon_miss
-        report.num_almost_good += t_report.num_almost_good
-        report.num_hit_all += t_report.num_hit_all
-        report.hitone_names += t_report.hitone_names
-        report.hithalfbases_names += t_report.hithalfbases_names
-        report.contig_names += t_report.contig_names
-        report.incorr_names += t_report.incorr_names
-        report.unmapped_names += t_report.unmapped_names
-        report.pot_new_annotations += t_report.pot_new_annotations
-        report.alignments_with_pna = len(report.pot_new_annotations)
-
-        # Double counted!! (but since only relative values are taken into account, it's not relevant)
-        # report.num_good_alignment += t_report.num_good_alignment
-        # report.num_bad_alignment += t_report.num_bad_alignment
-
-    # Collecting new annotations (there should be a lot of duplicates)
-    # New annotations details are written to a file: annotations.report
+    # New annotations are already collapsed (see add_new_annotation), here they are named
+    # and counted, and their read lists are keyed by name
     if calcNewAnnotations:
-        collected_new_annotations = []
         cna_count = {}
         cna_readlist = {}
         for pna in report.pot_new_annotations:
-            alreadyExists = False
-            for cna in collected_new_annotations:
-                if pna.itemsEqual(cna):
-                    alreadyExists = True
-                    cna.seqname += ', ' + pna.seqname
-                    cna_count[cna.genename] += 1
-                    cna_readlist[cna.genename].append(pna.seqname)
-                    break
-
-            if not alreadyExists:
-                collected_new_annotations.append(pna)
-                cna_count[pna.genename] = 0
-                cna_readlist[pna.genename] = [pna.seqname]
+            readlist = report.cna_readlist[new_annotation_signature(pna)]
+            pna.genename = "New annotation %d " % (len(cna_readlist)+1)
+            cna_count[pna.genename] = len(readlist) - 1
+            cna_readlist[pna.genename] = readlist
 
         # Preserve only annotations that are generated by at least NEW_ANNOTATION_MIN reads
         filtered_new_annotations = []
-        for cna in collected_new_annotations:
+        for cna in report.pot_new_annotations:
             name = cna.genename
             if cna_count[name] >= NEW_ANNOTATION_MIN:
                 filtered_new_annotations.append(cna)
@@ -1309,11 +2283,6 @@ def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
         report.cna_readlist = cna_readlist
         report.detect_new_annotations = True
 
-
-    # Wait for all processes to end
-    for proc in jobs:
-        proc.join()
-
     # TODO: summarize the results
 
     # Calculating gene/exon hit precission statistics
@@ -1559,14 +2528,21 @@ def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
     #       work with split alignments (ignore Ns)
     #       expand the same logic to exons instead of complete genes
 
-    report.num_match = numMatch
-    report.num_mismatch = numMisMatch
-    report.num_insert = numInsert
-    report.num_delete = numDelete
+    report.num_match = per_base['num_match']
+    report.num_mismatch = per_base['num_mismatch']
+    report.num_insert = per_base['num_insert']
+    report.num_delete = per_base['num_delete']
+
+    total = report.num_match + report.num_mismatch + report.num_insert + report.num_delete
 
-    total = numMatch + numMisMatch + numInsert + numDelete
+    report.num_lowmatchcnt = per_base['num_lowmatchcnt']
 
-    report.num_lowmatchcnt = numLowMatchCnt
+    report.sum_read_length = per_base['sum_read_length']
+    report.sum_bases_aligned = per_base['sum_bases_aligned']
+    if report.sum_read_length == 0:
+        report.percentage_bases_aligned = -1
+    else:
+        report.percentage_bases_aligned = 100 * float(report.sum_bases_aligned) / report.sum_read_length
 
     if total > 0:
         report.match_percentage = float(report.num_match)/total
@@ -1581,11 +2557,6 @@ def eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict):
     report.expressed_genes = expressed_genes
     report.gene_coverage = gene_coverage
 
-    sys.stderr.write('\n(%s) Done!' % datetime.now().time().isoformat())
-    sys.stderr.write('\n')
-
-    return report
-
 
 
 def eval_mapping_fasta(ref_file, sam_file, paramdict):
@@ -1596,10 +2567,14 @@ def eval_mapping_fasta(ref_file, sam_file, paramdict):
     report = EvalReport(ReportType.FASTA_REPORT)
 
     sys.stderr.write('\n(%s) Loading and processing FASTA reference ... ' % datetime.now().time().isoformat())
+    PROFILER.start('reference load')
     [chromname2seq, headers, seqs, quals] = load_and_process_reference(ref_file, paramdict, report)
+    PROFILER.stop('reference load')
 
     sys.stderr.write('\n(%s) Loading and processing SAM file with mappings ... ' % datetime.now().time().isoformat())
+    PROFILER.start('SAM load')
     samlines = load_and_process_SAM(sam_file, paramdict, report)
+    PROFILER.stop('SAM load')
 
     numq = 0
     sumq = 0.0
@@ -1607,18 +2582,11 @@ def eval_mapping_fasta(ref_file, sam_file, paramdict):
     # Analyzing mappings
     sys.stderr.write('\n(%s) Analyzing mappings against FASTA reference ... ' % datetime.now().time().isoformat())
 
-    numMatch = 0
-    numMisMatch = 0
-    numInsert = 0
-    numDelete = 0
-
     per_base_stats = True
     if '--no_per_base_stats' in paramdict:
         per_base_stats = False
 
-    processChromNames = True
-    if '--leave_chrom_names' in paramdict:
-        processChromNames = False
+    per_base = new_per_base_stats()
 
     if per_base_stats:
         # Looking at SAM lines to estimate general mapping quality
@@ -1636,39 +2604,32 @@ def eval_mapping_fasta(ref_file, sam_file, paramdict):
                 else:
                     report.num_zero_quality += 1
 
-                chromname = getChromName(samline.rname, processChromNames)
-                if chromname not in chromname2seq:
-                    raise Exception('\nERROR: Unknown choromosome name in SAM file! (chromname:"%s", samline.rname:"%s")' % (chromname, samline.rname))
-                chromidx = chromname2seq[chromname]
-
-                cigar = samline.CalcExtendedCIGAR(seqs[chromidx])
-                pos = samline.pos
-                quals = samline.qual
-
-                # Using regular expressions to find repeating digit and skipping one character after that
-                pattern = '(\d+)(.)'
-                operations = re.findall(pattern, cigar)
-
-                for op in operations:
-                    if op[1] in ('M', '='):
-                        numMatch += int(op[0])
-                    elif op[1] == 'I':
-                        numInsert += int(op[0])
-                    elif op[1] == 'D':
-                        numDelete += int(op[0])
-                    elif op[1] =='X':
-                        numMisMatch += int(op[0])
-                    elif op[1] in ('N', 'S', 'H', 'P'):
-                        pass
-                    else:
-                        sys.stderr.write('\nERROR: Invalid CIGAR string operation (%s)' % op[1])
-
-    report.num_match = numMatch
-    report.num_mismatch = numMisMatch
-    report.num_insert = numInsert
-    report.num_delete = numDelete
-
-    total = numMatch + numMisMatch + numInsert + numDelete
+        # Calculating per-base statistics using a pool of worker processes
+        num_threads = getNumThreads(paramdict)
+        unit_size = get_work_unit_size(len(samlines), num_threads)
+        # Grouping alignments by chromosome, so that workers load each chromosome from the reference only once
+        chrom_samlines = sorted(samlines, key = lambda samline_list: samline_list[0].chromid)
+        unit_args = []
+        for i in xrange(0, len(chrom_samlines), unit_size):
+            unit_args.append([chrom_samlines[i:i+unit_size], paramdict, chromname2seq])
+
+        PROFILER.start('per-base stats')
+        monitor = progress.ProgressMonitor(get_status_file(paramdict))
+        pool = multiprocessing.Pool(processes = num_threads, initializer = init_worker, initargs = (seqs, None, monitor.queue))
+        monitor.start(sam_file, {PER_BASE_PART : len(samlines)})
+        for t_per_base in pool.imap_unordered(calc_per_base_unit, unit_args):
+            add_per_base_stats(per_base, t_per_base)
+        monitor.stop()
+        pool.close()
+        pool.join()
+        PROFILER.stop('per-base stats')
+
+    report.num_match = per_base['num_match']
+    report.num_mismatch = per_base['num_mismatch']
+    report.num_insert = per_base['num_insert']
+    report.num_delete = per_base['num_delete']
+
+    total = report.num_match + report.num_mismatch + report.num_insert + report.num_delete
     # KK: Just to be sure
     if total == 0:
         total = 1
@@ -1691,79 +2652,205 @@ def eval_mapping_fasta(ref_file, sam_file, paramdict):
 def eval_mapping(ref_file, sam_file, paramdict):
 
     out_filename = ''
-    hitone_filename = ''
-    hithalfbases_filename = ''
-    contig_filename = ''
-    incorr_filename = ''
-    unmapped_filename = ''
-    out_file = None
 
-    save_qnames = False
     if '-sqn' in paramdict or '--save_query_names' in paramdict:
-        save_qnames = True
         if '-o' not in paramdict and '--output' not in paramdict or '-a' not in paramdict:
             sys.stderr.write('\nInvalid parameters. Paramater --save_query_names must be used with paramters --output and -a')
             exit()
 
-    calcNewAnnotations = False
-    if '--calc_new_annotations' in paramdict:
-        calcNewAnnotations = True
-
     if '-o' in paramdict:
         out_filename = paramdict['-o'][0]
     elif '--output' in paramdict:
         out_filename = paramdict['--output'][0]
 
-    if save_qnames:
-        hitone_filename = out_filename + '_hit1.names'
-        hithalfbases_filename = out_filename + '_hithalfbases.names'
-        contig_filename = out_filename + '_ctg.names'
-        incorr_filename = out_filename + '_bad.names'
-        unmapped_filename = out_filename + '_unmmapped.names'
-
-    if out_filename != '':
-        out_file = open(out_filename, 'w+')
-    else:
-        out_file = sys.stdout
+    check_report_format(paramdict, out_filename)
 
+    if '--profile' in paramdict:
+        PROFILER.enable()
 
+    # When sweeping tolerance settings, a report is written for each setting
     if '-a' in paramdict:
+        report_filenames = []
+        for tolerance in get_tolerance_settings(paramdict):
+            report_filename = out_filename
+            if '--sweep' in paramdict and out_filename != '':
+                report_filename = out_filename + get_tolerance_suffix(tolerance)
+            report_filenames.append(report_filename)
         annotations_file = paramdict['-a'][0]
-        report = eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict)
+        reports = eval_mapping_annotations(ref_file, sam_file, annotations_file, paramdict, report_filenames)
+    else:
+        report_filenames = [out_filename]
+        reports = [eval_mapping_fasta(ref_file, sam_file, paramdict)]
+
+    for k in xrange(len(reports)):
+        reports[k].commandline = paramdict['command']
+        write_mapping_report(reports[k], report_filenames[k], paramdict)
+
+    write_profile(out_filename)
+
+
+# Returns the format in which reports are written, set by --format parameter (text, json or tsv, default text)
+def get_report_format(paramdict):
+    report_format = 'text'
+    if '--format' in paramdict:
+        report_format = paramdict['--format'][0]
+    if report_format not in REPORT_FORMATS:
+        sys.stderr.write('\nInvalid parameters. Unknown report format: %s (allowed formats: %s)' % (report_format, ', '.join(REPORT_FORMATS)))
+        exit()
+    return report_format
+
+
+# Checks that report format is valid and can be used with other parameters
+# In machine readable formats, gene expression is written to a separate file, so output file must be given
+def check_report_format(paramdict, out_filename):
+    report_format = get_report_format(paramdict)
+    if report_format != 'text' and ('-ex' in paramdict or '--expression' in paramdict) and out_filename == '':
+        sys.stderr.write('\nInvalid parameters. Paramater --expression with --format %s must be used with paramter --output' % report_format)
+        exit()
+
+
+# Writes a report in the given format (see get_report_format)
+def write_report(report, out_file, report_format):
+    if report_format == 'json':
+        report.write_json(out_file)
+    elif report_format == 'tsv':
+        report.write_tsv(out_file)
     else:
-        report = eval_mapping_fasta(ref_file, sam_file, paramdict)
+        report.write(out_file)
 
-    report.commandline = paramdict['command']
 
+# Writes the profile (see --profile) to a JSON file next to the output file (<output file>_profile.json),
+# or to stderr if there is no output file
+def write_profile(out_filename):
+    if out_filename != '':
+        PROFILER.write(out_filename + '_profile.json')
+    else:
+        PROFILER.write('')
+
+
+# Suffix for output files of a report calculated for a single tolerance setting
+# (allowed inaccuracy, minimum overlap) when sweeping them
+def get_tolerance_suffix(tolerance):
+    return '_ai%d_mo%d' % tolerance
+
+
+# Writes a mapping report to an output file (or to stdout if output filename is empty)
+# Together with the report, new annotations are written to a file, if so specified
+# (query names are written while the SAM file is evaluated, see eval_mapping_sam)
+def write_mapping_report(report, out_filename, paramdict):
+    PROFILER.start('report writing')
+    out_file = None
+
+    calcNewAnnotations = False
+    if '--calc_new_annotations' in paramdict:
+        calcNewAnnotations = True
+
+    if out_filename != '':
+        out_file = open(out_filename, 'w+')
+    else:
+        out_file = sys.stdout
+
+    # Long lists (new annotations, gene expression) are written directly to files,
+    # without building them in memory first
     if calcNewAnnotations:
         annotation_report_filename = out_filename + '_annotation.report'
         with open(annotation_report_filename, 'w+') as annr_file:
-            annr_file.write(report.getAnnotationReport())
-            annr_file.close()
+            report.write_annotation_report(annr_file)
 
-    if save_qnames:
-        with open(hitone_filename, 'w+') as hitone_file:
-            hitone_file.write(report.get_hitone_names())
-            hitone_file.close()
+    report_format = get_report_format(paramdict)
+    write_report(report, out_file, report_format)
 
-        with open(hithalfbases_filename, 'w+') as hithalf_file:
-            hithalf_file.write(report.get_hithalfbases_names())
-            hithalf_file.close()
+    # In machine readable formats, gene expression is written to a separate tab separated file
+    if report_format != 'text' and report.output_gene_expression:
+        with open(out_filename + '_expression.tsv', 'w+') as expression_file:
+            report.write_expression_tsv(expression_file)
 
-        with open(contig_filename, 'w+') as contig_file:
-            contig_file.write(report.get_contig_names())
-            contig_file.close()
+    if out_file != sys.stdout:
+        out_file.close()
+    PROFILER.stop('report writing')
 
-        with open(incorr_filename, 'w+') as incorr_file:
-            incorr_file.write(report.get_incorr_names())
-            incorr_file.close()
 
-        with open(unmapped_filename, 'w+') as unmapped_file:
-            unmapped_file.write(report.get_unmapped_names())
-            unmapped_file.close()
+# Evaluates multiple SAM files (e.g. results of different mappers) against the same reference and annotations
+# Reference and annotations are loaded only once, and the same pool of worker processes is used for all SAM files
+# A report is written for each SAM file, and a table comparing all SAM files is written at the end
+def eval_mapping_multi(ref_file, sam_files, paramdict):
 
-    out_file.write(report.toString())
-    out_file.close()
+    if '-a' not in paramdict:
+        sys.stderr.write('\nInvalid parameters. Annotations (-a) are required when evaluating multiple SAM files')
+        exit()
+    annotations_file = paramdict['-a'][0]
+
+    out_prefix = ''
+    if '-o' in paramdict:
+        out_prefix = paramdict['-o'][0]
+    elif '--output' in paramdict:
+        out_prefix = paramdict['--output'][0]
+
+    if ('-sqn' in paramdict or '--save_query_names' in paramdict) and out_prefix == '':
+        sys.stderr.write('\nInvalid parameters. Paramater --save_query_names must be used with paramter --output')
+        exit()
+
+    check_report_format(paramdict, out_prefix)
+
+    if '--profile' in paramdict:
+        PROFILER.enable()
+
+    # Each SAM file gets a unique name, used for its output files and in the comparison table
+    names = []
+    for sam_file in sam_files:
+        name = os.path.splitext(os.path.basename(sam_file))[0]
+        if name in names:
+            name = '%s_%d' % (name, len(names) + 1)
+        names.append(name)
+
+    sys.stderr.write('\n')
+    sys.stderr.write('\n(%s) START: Evaluating %d mappings with annotations:' % (datetime.now().time().isoformat(), len(sam_files)))
+
+    context = load_mapping_context(ref_file, annotations_file, paramdict)
+    pool = create_mapping_pool(context, paramdict)
+
+    # When sweeping tolerance settings, each SAM file has a report (and a column in comparison) for each setting
+    columns = []
+    reports = []
+    for i in xrange(len(sam_files)):
+        sys.stderr.write('\n(%s) Evaluating mapping %d / %d: %s' % (datetime.now().time().isoformat(), i + 1, len(sam_files), sam_files[i]))
+        t_names = []
+        out_filenames = []
+        for tolerance in get_tolerance_settings(paramdict):
+            name = names[i]
+            if '--sweep' in paramdict:
+                name += get_tolerance_suffix(tolerance)
+            t_names.append(name)
+
+            out_filename = ''
+            if out_prefix != '':
+                out_filename = '%s_%s.report' % (out_prefix, name)
+            out_filenames.append(out_filename)
+
+        t_reports = eval_mapping_sam(context, sam_files[i], paramdict, pool, out_filenames)
+        for k in xrange(len(t_reports)):
+            report = t_reports[k]
+            report.commandline = paramdict['command']
+            write_mapping_report(report, out_filenames[k], paramdict)
+
+            # Per read information is not needed for the comparison, and can take a lot of memory
+            report.pot_new_annotations = []
+            report.cna_readlist = {}
+            columns.append(t_names[k])
+            reports.append(report)
+
+    # Wait for all processes to end
+    pool.close()
+    pool.join()
+
+    comparison = get_comparison_table(columns, reports)
+    if out_prefix != '':
+        with open(out_prefix + '_comparison.tsv', 'w+') as comparison_file:
+            comparison_file.write(comparison)
+    else:
+        sys.stdout.write('\n' + comparison)
+
+    write_profile(out_prefix)
 
 
 def eval_annotations(annotations_file, paramdict):
@@ -1776,6 +2863,8 @@ def eval_annotations(annotations_file, paramdict):
     elif '--output' in paramdict:
         out_filename = paramdict['--output'][0]
 
+    report_format = get_report_format(paramdict)
+
     if out_filename != '':
         out_file = open(out_filename, 'w+')
     else:
@@ -1853,7 +2942,7 @@ def eval_annotations(annotations_file, paramdict):
     else:
         report.output_alternate_splicing = False
 
-    out_file.write(report.toString())
+    write_report(report, out_file, report_format)
 
 
 def eval_maplength(samfile, paramdict):
@@ -1885,7 +2974,7 @@ def eval_maplength(samfile, paramdict):
     # [chromname2seq, headers, seqs, quals] = load_and_process_reference(ref_file, paramdict, report)
 
     sys.stderr.write('\n(%s) Loading and processing SAM file with mappings ... ' % datetime.now().time().isoformat())
-    samlines = load_and_process_SAM(sam_file, paramdict, report)
+    samlines = load_and_process_SAM(samfile, paramdict, report)
 
     # Setting up some sort of a progress bar
     sys.stderr.write('\n(%s) Analyzing mapping lengths ...  ' % datetime.now().time().isoformat())
@@ -1902,9 +2991,14 @@ def eval_maplength(samfile, paramdict):
             currentbar += 0.1
         # Calculate readlength from the first alignment (should be the same)
         # and then see how many of those bases were actually aligned
-        readlength = samline_list[0].CalcReadLengthFromCigar()
+        readlength = get_compact_cigar(samline_list[0]).readlength
         basesaligned = 0
-        for samline in samline_list:
+        # Only the primary alignment and its supplementary alignments are counted, secondary alignments
+        # (joined with them if they are close enough) would count the same bases of the read again
+        counted_samlines = [samline for samline in samline_list if samline.flag & 256 == 0]
+        if len(counted_samlines) == 0:
+            counted_samlines = samline_list[:1]
+        for samline in counted_samlines:
 
             # chromname = getChromName(samline.rname)
             # if chromname not in chromname2seq:
@@ -1918,24 +3012,18 @@ def eval_maplength(samfile, paramdict):
             # pos = samline.pos
             # quals = samline.qual
 
-            cigar = samline.cigar
-
-            # Using regular expressions to find repeating digit and skipping one character after that
-            # Used to separate CIGAR string into individual operations
-            pattern = '(\d+)(.)'
-            operations = re.findall(pattern, cigar)
-
-            for op in operations:
-                if op[1] in ('M', '='):
-                    basesaligned += int(op[0])
-                elif op[1] == 'I':
-                    basesaligned += int(op[0])
-                elif op[1] =='X':
-                    basesaligned += int(op[0])
-                elif op[1] in ('N', 'S', 'H', 'P', 'D'):
+            # CIGAR string was already parsed while loading the SAM file
+            for (length, op) in get_compact_cigar(samline).operations:
+                if op in ('M', '='):
+                    basesaligned += length
+                elif op == 'I':
+                    basesaligned += length
+                elif op =='X':
+                    basesaligned += length
+                elif op in ('N', 'S', 'H', 'P', 'D'):
                     pass
                 else:
-                    sys.stderr.write('\nERROR: Invalid CIGAR string operation (%s)' % op[1])
+                    sys.stderr.write('\nERROR: Invalid CIGAR string operation (%s)' % op)
 
         if basesaligned > readlength:
             # import pdb
@@ -1968,6 +3056,7 @@ def verbose_usage_and_exit():
     # sys.stderr.write('\t\tsetup\n')
     # sys.stderr.write('\t\tcleanup\n')
     sys.stderr.write('\t\teval-mapping\n')
+    sys.stderr.write('\t\teval-mapping-multi\n')
     sys.stderr.write('\t\teval-annotations\n')
     sys.stderr.write('\t\teval-maplength\n')
     sys.stderr.write('\n')
@@ -2028,6 +3117,25 @@ if __name__ == '__main__':
             sys.stderr.write('--calc_new_annotations: calculate potential new annotations, if a sufficient number of alignments (default 3)\n')
             sys.stderr.write('                        better fits a combination of exons then any existing annotation, that combination\n')
             sys.stderr.write('                        of exons is suggested as a new annotation\n')
+            sys.stderr.write('-t (--threads) <int> : the number of worker processes used to evaluate alignments (default %d)\n' % NUM_PROCESS)
+            sys.stderr.write('--stream_sam : read the SAM file while evaluating it, instead of loading it whole into memory\n')
+            sys.stderr.write('               All alignments of a read must be in consecutive lines (e.g. aligner output or\n')
+            sys.stderr.write('               a name sorted SAM file). Used only when annotations are given.\n')
+            sys.stderr.write('--sorted_input : stream a SAM file sorted according to position (e.g. with samtools sort), chromosome\n')
+            sys.stderr.write('                 by chromosome. Alignments of a read are joined only if they are close to its primary\n')
+            sys.stderr.write('                 alignment. Used only when annotations are given.\n')
+            sys.stderr.write('--no_annotation_cache : do not use (or create) annotation cache, a file with processed\n')
+            sys.stderr.write('                        annotations stored next to the annotation file (<annotations file>.cache)\n')
+            sys.stderr.write('--sweep <ai:mo,...> : evaluate alignments for several settings of allowed inaccuracy and minimum overlap\n')
+            sys.stderr.write('                      in a single pass (e.g. 0:5,5:5,10:10). A report is written for each setting,\n')
+            sys.stderr.write('                      with output file name extended by _ai<ai>_mo<mo>. Used only when annotations are given.\n')
+            sys.stderr.write('--format <text|json|tsv> : format of the report (default text). In json and tsv formats, gene expression\n')
+            sys.stderr.write('                           is written to a separate file <output file>_expression.tsv\n')
+            sys.stderr.write('--profile : record wall time, CPU time and peak memory for each stage of the evaluation and for each\n')
+            sys.stderr.write('            work unit evaluated by worker processes. The profile is written in JSON format to\n')
+            sys.stderr.write('            <output file>_profile.json (to stderr if output file is not given)\n')
+            sys.stderr.write('--status_file <file> : periodically write progress of the evaluation (reads evaluated by worker\n')
+            sys.stderr.write('                       processes, throughput and estimated time to finish) to a file in JSON format\n')
             sys.stderr.write('\n')
             exit(1)
 
@@ -2044,6 +3152,36 @@ if __name__ == '__main__':
 
         eval_mapping(ref_file, sam_file, paramdict)
 
+    elif (mode == 'eval-mapping-multi'):
+        if (len(sys.argv) < 4):
+            sys.stderr.write('Evaluates RNAseq mappings from multiple SAM files (e.g. results of different mappers)\n')
+            sys.stderr.write('against the same reference and annotations, loading them only once.\n')
+            sys.stderr.write('Usage:\n')
+            sys.stderr.write('%s %s <reference FASTA file> <input SAM file> [<input SAM file> ...] -a <file> options\n'% (sys.argv[0], sys.argv[1]))
+            sys.stderr.write('options:"\n')
+            sys.stderr.write('-a <file> : a reference annotation (GFF/GTF/BED) file (required)\n')
+            sys.stderr.write('-o (--output) <prefix> : prefix for output files, a report for each SAM file is written to\n')
+            sys.stderr.write('                         <prefix>_<SAM file name>.report and a table comparing all SAM files\n')
+            sys.stderr.write('                         is written to <prefix>_comparison.tsv. If omitted, all is written to stdout\n')
+            sys.stderr.write('All other options are the same as for eval-mapping mode, and are applied to all SAM files\n')
+            sys.stderr.write('\n')
+            exit(1)
+
+        ref_file = sys.argv[2]
+
+        # All arguments after the reference, up to the first option, are SAM files
+        sam_files = []
+        i = 3
+        while i < len(sys.argv) and not sys.argv[i].startswith('-'):
+            sam_files.append(sys.argv[i])
+            i += 1
+
+        pparser = paramsparser.Parser(paramdefs)
+        paramdict = pparser.parseCmdArgs(sys.argv[i:])
+        paramdict['command'] = ' '.join(sys.argv)
+
+        eval_mapping_multi(ref_file, sam_files, paramdict)
+
     elif (mode == 'eval-annotations'):
         if (len(sys.argv) < 3):
             sys.stderr.write('Evaluates gene annotation from a BED or GTF/GFF file.\n')
@@ -2051,6 +3189,7 @@ if __name__ == '__main__':
             sys.stderr.write('%s %s <annotations file> options\n'% (sys.argv[0], sys.argv[1]))
             sys.stderr.write('options:"\n')
             sys.stderr.write('-o (--output) <file> : output file to which the report will be written\n')
+            sys.stderr.write('--format <text|json|tsv> : format of the report (default text)\n')
             sys.stderr.write('\n')
             exit(1)
 
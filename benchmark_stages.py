@@ -0,0 +1,382 @@
+#! /usr/bin/python
+
+# Benchmarks stages of the evaluation pipeline (RNAseqEval.py and Process_pbsim_data.py) in isolation
+# Synthetic datasets of several sizes are generated using generate_synthetic_data.py and each stage is run
+# on each dataset in a separate process, so that its peak memory can be measured
+# Results (throughput and peak memory) are written as a JSON file, which can be used as a baseline
+# for later runs, to detect performance regressions
+
+import sys, os
+import json
+import resource
+import traceback
+import multiprocessing
+import Queue
+import paramsparser
+
+from datetime import datetime
+
+# To enable importing from samscripts submodule
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(SCRIPT_PATH, 'samscripts/src'))
+
+import RNAseqEval
+import Process_pbsim_data
+import generate_synthetic_data
+import profiler
+from report import EvalReport, ReportType
+
+
+DEFAULT_SCALES = [10000, 100000]
+DEFAULT_WORK_FOLDER = 'benchmark_data'
+DEFAULT_REPEAT = 1
+DEFAULT_THREADS = 1
+
+# Relative change in throughput or peak memory that is reported as a regression (or an improvement)
+DEFAULT_TOLERANCE = 0.1
+
+paramdefs = {'--scales' : 1,
+             '--stages' : 1,
+             '--work_folder' : 1,
+             '--repeat' : 1,
+             '-t' : 1,
+             '--threads' : 1,
+             '--baseline' : 1,
+             '--tolerance' : 1}
+
+
+# Each stage function prepares everything a stage needs (this is not measured) and returns a function
+# that runs the stage and returns the number of processed items, and the name of the items
+# Dataset is a dictionary with paths to reference, annotations, SAM file and simulation folder,
+# the number of reads and a folder for temporary outputs
+
+def bench_load_and_process_reference(dataset, paramdict):
+    def run():
+        report = EvalReport(ReportType.MAPPING_REPORT)
+        [chromname2seq, headers, seqs, quals] = RNAseqEval.load_and_process_reference(dataset['reference'], paramdict, report)
+        # Uncompressed references are memory mapped and read only when a sequence is used,
+        # so every sequence is read here, otherwise the stage would only measure opening the index
+        return sum(len(seqs[i]) for i in xrange(len(seqs)))
+    return [run, 'bases']
+
+
+def bench_load_and_process_SAM(dataset, paramdict):
+    def run():
+        report = EvalReport(ReportType.MAPPING_REPORT)
+        RNAseqEval.load_and_process_SAM(dataset['sam'], paramdict, report)
+        return dataset['reads']
+    return [run, 'reads']
+
+
+def bench_load_and_process_annotations(dataset, paramdict):
+    def run():
+        report = EvalReport(ReportType.MAPPING_REPORT)
+        annotations, expressed_genes, gene_coverage = RNAseqEval.load_and_process_annotations(dataset['annotations'], paramdict, report)
+        return len(annotations)
+    return [run, 'annotations']
+
+
+def bench_eval_mapping_part(dataset, paramdict):
+    context = RNAseqEval.load_mapping_context(dataset['reference'], dataset['annotations'], paramdict)
+    samlines = RNAseqEval.load_and_process_SAM(dataset['sam'], paramdict, EvalReport(ReportType.MAPPING_REPORT))
+    part_samlines = RNAseqEval.separate_samlines(samlines, context['partlist'], paramdict)
+    def run():
+        for partname in context['partlist']:
+            if len(part_samlines[partname]) > 0:
+                RNAseqEval.eval_mapping_part(0, part_samlines[partname], context['part_annotations'][partname], paramdict, context['chromname2seq'])
+        return dataset['reads']
+    return [run, 'reads']
+
+
+def bench_calc_per_base_stats(dataset, paramdict):
+    [chromname2seq, headers, seqs, quals] = RNAseqEval.load_and_process_reference(dataset['reference'], paramdict, EvalReport(ReportType.MAPPING_REPORT))
+    samlines = RNAseqEval.load_and_process_SAM(dataset['sam'], paramdict, EvalReport(ReportType.MAPPING_REPORT))
+    def run():
+        RNAseqEval.calc_per_base_stats(samlines, seqs, chromname2seq, paramdict)
+        return dataset['reads']
+    return [run, 'reads']
+
+
+def bench_eval_annotations(dataset, paramdict):
+    out_filename = os.path.join(dataset['folder'], 'benchmark_annotations.json')
+    stage_paramdict = dict(paramdict)
+    stage_paramdict['-o'] = [out_filename]
+    stage_paramdict['--format'] = ['json']
+    def run():
+        RNAseqEval.eval_annotations(dataset['annotations'], stage_paramdict)
+        with open(out_filename, 'rU') as out_file:
+            return json.load(out_file)['stats']['num_genes']
+    return [run, 'annotations']
+
+
+def bench_eval_maplength(dataset, paramdict):
+    stage_paramdict = dict(paramdict)
+    stage_paramdict['-o'] = [os.path.join(dataset['folder'], 'benchmark_maplength.csv')]
+    def run():
+        RNAseqEval.eval_maplength(dataset['sam'], stage_paramdict)
+        return dataset['reads']
+    return [run, 'reads']
+
+
+def bench_processData(dataset, paramdict):
+    def run():
+        Process_pbsim_data.processData(dataset['folder'], dataset['sam'], dataset['annotations'], paramdict)
+        return dataset['reads']
+    return [run, 'reads']
+
+
+STAGES = [('load_and_process_reference', bench_load_and_process_reference),
+          ('load_and_process_SAM', bench_load_and_process_SAM),
+          ('load_and_process_annotations', bench_load_and_process_annotations),
+          ('eval_mapping_part', bench_eval_mapping_part),
+          ('calc_per_base_stats', bench_calc_per_base_stats),
+          ('eval_annotations', bench_eval_annotations),
+          ('eval_maplength', bench_eval_maplength),
+          ('processData', bench_processData)]
+
+
+# While waiting for a result of a separate process, it is checked this often (in seconds) if the process is still alive
+RESULT_POLL_INTERVAL = 5.0
+
+# Runs a function in a separate process, with standard and error output discarded
+# The function should return a JSON-able result, exceptions are passed to the calling process as text
+# If the process ends without a result (e.g. it is killed when running out of memory), an exception is raised
+def run_isolated(function, args):
+    queue = multiprocessing.Queue()
+
+    def target():
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        try:
+            queue.put([function(*args), None])
+        except Exception:
+            queue.put([None, traceback.format_exc()])
+
+    process = multiprocessing.Process(target = target)
+    process.start()
+    while True:
+        try:
+            [result, error] = queue.get(timeout = RESULT_POLL_INTERVAL)
+            break
+        except Queue.Empty:
+            if process.is_alive():
+                continue
+            # The result could have been sent just before the process ended
+            try:
+                [result, error] = queue.get(timeout = 1.0)
+                break
+            except Queue.Empty:
+                process.join()
+                raise Exception('\nERROR: Benchmark process ended without a result (exit code %s)!' % process.exitcode)
+    process.join()
+    if error is not None:
+        raise Exception('\nERROR: Benchmark process failed:\n%s' % error)
+    return result
+
+
+# Prepares and runs a single stage on a dataset, called inside a separate process
+# Peak memory before the stage is started (after the preparation) is recorded as well, worker processes
+# started by the stage (e.g. in processData) are included in CPU time and peak memory
+def measure_stage(stage_function, dataset, paramdict):
+    [run, unit] = stage_function(dataset, paramdict)
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    start = profiler.measure()
+    items = run()
+    usage = profiler.measure_since(start)
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage['cpu'] += (children.ru_utime + children.ru_stime) - (children_start.ru_utime + children_start.ru_stime)
+    usage['max_rss_kb'] = max(usage['max_rss_kb'], children.ru_maxrss)
+    usage['setup_max_rss_kb'] = setup_rss
+    usage['items'] = items
+    usage['unit'] = unit
+    return usage
+
+
+# Generates a synthetic dataset with a given number of reads, unless it already exists in the work folder
+def prepare_dataset(ref_file, annotations_file, work_folder, num_reads):
+    folder = os.path.join(work_folder, 'reads_%d' % num_reads)
+    sam_file = os.path.join(folder, 'simulated.sam')
+    if not os.path.exists(sam_file):
+        sys.stderr.write('\n(%s) Generating dataset with %d reads in %s ...' % (datetime.now().time().isoformat(), num_reads, folder))
+        gen_paramdict = {'-n' : [str(num_reads)],
+                         '-o' : [sam_file],
+                         'command' : 'benchmark_stages.py'}
+        run_isolated(generate_synthetic_data.generate_data, (ref_file, annotations_file, folder, gen_paramdict))
+
+    return {'reference' : ref_file,
+            'annotations' : annotations_file,
+            'sam' : sam_file,
+            'folder' : folder,
+            'reads' : num_reads}
+
+
+def run_benchmark(ref_file, annotations_file, results_file, paramdict):
+    scales = DEFAULT_SCALES
+    if '--scales' in paramdict:
+        scales = [int(scale) for scale in paramdict['--scales'][0].split(',')]
+
+    stage_names = [name for (name, function) in STAGES]
+    if '--stages' in paramdict:
+        stage_names = paramdict['--stages'][0].split(',')
+        for name in stage_names:
+            if name not in dict(STAGES):
+                raise Exception('\nERROR: Unknown stage %s (allowed stages: %s)!' % (name, ', '.join(name for (name, function) in STAGES)))
+
+    work_folder = paramdict['--work_folder'][0] if '--work_folder' in paramdict else DEFAULT_WORK_FOLDER
+    repeat = int(paramdict['--repeat'][0]) if '--repeat' in paramdict else DEFAULT_REPEAT
+
+    num_threads = DEFAULT_THREADS
+    if '-t' in paramdict:
+        num_threads = int(paramdict['-t'][0])
+    elif '--threads' in paramdict:
+        num_threads = int(paramdict['--threads'][0])
+
+    # Parameters given to all stages, annotation cache is not used so that annotations are always processed
+    stage_paramdict = {'-t' : [str(num_threads)],
+                       '--no_annotation_cache' : [],
+                       'command' : paramdict['command']}
+
+    results = []
+    for scale in scales:
+        dataset = prepare_dataset(ref_file, annotations_file, work_folder, scale)
+        for name in stage_names:
+            sys.stderr.write('\n(%s) Running stage %s on %d reads ...' % (datetime.now().time().isoformat(), name, scale))
+            # When a stage is repeated, the fastest run is kept
+            best = None
+            for i in xrange(repeat):
+                usage = run_isolated(measure_stage, (dict(STAGES)[name], dataset, stage_paramdict))
+                if best is None or usage['wall'] < best['wall']:
+                    best = usage
+            best['stage'] = name
+            best['scale'] = scale
+            best['throughput'] = best['items'] / best['wall'] if best['wall'] > 0 else 0.0
+            results.append(best)
+            sys.stderr.write(' %.2f s, %.1f %s/s, peak memory %d kB' % (best['wall'], best['throughput'], best['unit'], best['max_rss_kb']))
+
+    benchmark = {'commandline' : paramdict['command'],
+                 'threads' : num_threads,
+                 'repeat' : repeat,
+                 'results' : results}
+    with open(results_file, 'w+') as out_file:
+        json.dump(benchmark, out_file, indent = 1, sort_keys = True)
+        out_file.write('\n')
+    sys.stderr.write('\n(%s) Results written to %s\n' % (datetime.now().time().isoformat(), results_file))
+
+    if '--baseline' in paramdict:
+        return compare_benchmarks(benchmark, load_benchmark(paramdict['--baseline'][0]), paramdict)
+    return 0
+
+
+def load_benchmark(filename):
+    with open(filename, 'rU') as benchmark_file:
+        return json.load(benchmark_file)
+
+
+# Compares benchmark results with a baseline and writes a table of differences to stdout
+# A stage is marked as a regression if its throughput is lower or its peak memory is higher than in the baseline
+# by more than the given tolerance (relative)
+# Returns the number of regressions
+def compare_benchmarks(benchmark, baseline, paramdict):
+    tolerance = float(paramdict['--tolerance'][0]) if '--tolerance' in paramdict else DEFAULT_TOLERANCE
+
+    baseline_results = {}
+    for result in baseline['results']:
+        baseline_results[(result['stage'], result['scale'])] = result
+
+    num_regressions = 0
+    sys.stdout.write('stage\tscale\tunit\tthroughput\tbaseline_throughput\tthroughput_change\tmax_rss_kb\tbaseline_max_rss_kb\tmemory_change\tstatus\n')
+    for result in benchmark['results']:
+        base = baseline_results.get((result['stage'], result['scale']))
+        if base is None:
+            sys.stdout.write('%s\t%d\t%s\t%.2f\t-\t-\t%d\t-\t-\tNEW\n' % (result['stage'], result['scale'], result['unit'], result['throughput'], result['max_rss_kb']))
+            continue
+
+        throughput_change = result['throughput'] / base['throughput'] - 1 if base['throughput'] > 0 else 0.0
+        memory_change = float(result['max_rss_kb']) / base['max_rss_kb'] - 1 if base['max_rss_kb'] > 0 else 0.0
+        if throughput_change < -tolerance or memory_change > tolerance:
+            status = 'REGRESSION'
+            num_regressions += 1
+        elif throughput_change > tolerance or memory_change < -tolerance:
+            status = 'IMPROVEMENT'
+        else:
+            status = 'OK'
+        sys.stdout.write('%s\t%d\t%s\t%.2f\t%.2f\t%+.1f%%\t%d\t%d\t%+.1f%%\t%s\n' \
+                         % (result['stage'], result['scale'], result['unit'], result['throughput'], base['throughput'], throughput_change * 100, \
+                            result['max_rss_kb'], base['max_rss_kb'], memory_change * 100, status))
+
+    sys.stderr.write('\nStages with regressions (tolerance %g%%): %d\n' % (tolerance * 100, num_regressions))
+    return num_regressions
+
+
+def verbose_usage_and_exit():
+    sys.stderr.write('Benchmark stages - runs stages of the evaluation pipeline on synthetic datasets of different sizes\n')
+    sys.stderr.write('                 - Measures throughput and peak memory and compares them with a baseline.\n')
+    sys.stderr.write('\n')
+    sys.stderr.write('Usage:\n')
+    sys.stderr.write('\t%s [mode]\n' % sys.argv[0])
+    sys.stderr.write('\n')
+    sys.stderr.write('\tmode:\n')
+    sys.stderr.write('\t\trun\n')
+    sys.stderr.write('\t\tcompare\n')
+    sys.stderr.write('\n')
+    exit(0)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        verbose_usage_and_exit()
+
+    mode = sys.argv[1]
+
+    if (mode == 'run'):
+        if (len(sys.argv) < 5):
+            sys.stderr.write('Generates synthetic datasets and runs each stage of the evaluation on each of them.\n')
+            sys.stderr.write('Results are written to a JSON file.\n')
+            sys.stderr.write('Usage:\n')
+            sys.stderr.write('%s %s <reference FASTA file> <annotations file> <results file> options\n' % (sys.argv[0], sys.argv[1]))
+            sys.stderr.write('\n')
+            sys.stderr.write('\noptions:\n')
+            sys.stderr.write('\t--scales <int,int,...>: numbers of reads in generated datasets (default %s)\n' % ','.join(str(scale) for scale in DEFAULT_SCALES))
+            sys.stderr.write('\t--stages <stage,stage,...>: stages to run (default all: %s)\n' % ','.join(name for (name, function) in STAGES))
+            sys.stderr.write('\t--work_folder <folder>: folder for generated datasets, existing datasets are reused (default %s)\n' % DEFAULT_WORK_FOLDER)
+            sys.stderr.write('\t--repeat <int>: number of runs for each stage, the fastest one is kept (default %d)\n' % DEFAULT_REPEAT)
+            sys.stderr.write('\t-t (--threads) <int>: number of worker processes for stages that use them (default %d)\n' % DEFAULT_THREADS)
+            sys.stderr.write('\t--baseline <file>: compare results with a baseline (results of an earlier run)\n')
+            sys.stderr.write('\t--tolerance <float>: relative change reported as a regression (default %g)\n' % DEFAULT_TOLERANCE)
+            sys.stderr.write('\n')
+            exit(1)
+
+        ref_file = sys.argv[2]
+        annotations_file = sys.argv[3]
+        results_file = sys.argv[4]
+
+        pparser = paramsparser.Parser(paramdefs)
+        paramdict = pparser.parseCmdArgs(sys.argv[5:])
+        paramdict['command'] = ' '.join(sys.argv)
+
+        if run_benchmark(ref_file, annotations_file, results_file, paramdict) > 0:
+            exit(1)
+
+    elif (mode == 'compare'):
+        if (len(sys.argv) < 4):
+            sys.stderr.write('Compares benchmark results with a baseline.\n')
+            sys.stderr.write('Usage:\n')
+            sys.stderr.write('%s %s <results file> <baseline file> options\n' % (sys.argv[0], sys.argv[1]))
+            sys.stderr.write('\n')
+            sys.stderr.write('\noptions:\n')
+            sys.stderr.write('\t--tolerance <float>: relative change reported as a regression (default %g)\n' % DEFAULT_TOLERANCE)
+            sys.stderr.write('\n')
+            exit(1)
+
+        pparser = paramsparser.Parser(paramdefs)
+        paramdict = pparser.parseCmdArgs(sys.argv[4:])
+
+        if compare_benchmarks(load_benchmark(sys.argv[2]), load_benchmark(sys.argv[3]), paramdict) > 0:
+            exit(1)
+
+    else:
+        print 'Invalid mode!'
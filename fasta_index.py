@@ -0,0 +1,194 @@
+#! /usr/bin/python
+
+# Memory mapped access to a FASTA reference using a samtools compatible .fai index
+# Sequences are read from the file only when they are needed, so that only chromosomes
+# that are actually used are loaded, and the OS page cache is shared between processes
+
+import sys, os
+import mmap
+
+from datetime import datetime
+
+
+# Columns of a .fai index line
+FAI_NAME = 0
+FAI_LENGTH = 1
+FAI_OFFSET = 2
+FAI_LINEBASES = 3
+FAI_LINEWIDTH = 4
+
+
+# Returns True if a FASTA file can be accessed using an index
+# (uncompressed file, starting with a FASTA header)
+def is_indexable_fasta(fasta_path):
+    if fasta_path.endswith('.gz'):
+        return False
+    try:
+        with open(fasta_path, 'rb') as fasta:
+            firstchar = fasta.read(1)
+    except IOError:
+        return False
+    return firstchar == '>'
+
+
+# Returns True if the index exists and is not older than the FASTA file
+def fai_is_valid(fasta_path, fai_path):
+    if not os.path.exists(fai_path):
+        return False
+    return os.path.getmtime(fai_path) >= os.path.getmtime(fasta_path)
+
+
+# Scans a FASTA file and calculates index entries for all sequences
+# Each entry is a list [name, length, offset, linebases, linewidth], same as in samtools .fai files
+def calc_fai(fasta_path):
+    entries = []
+    entry = None
+    short_line = False
+    offset = 0
+
+    with open(fasta_path, 'rb') as fasta:
+        for line in fasta:
+            linewidth = len(line)
+            if line.startswith('>'):
+                if entry is not None:
+                    entries.append(entry)
+                header = line[1:].strip()
+                name = header.split()[0] if header != '' else ''
+                entry = [name, 0, offset + linewidth, 0, 0]
+                short_line = False
+            elif entry is not None:
+                linebases = len(line.rstrip('\r\n'))
+                if linebases > 0:
+                    if short_line or (entry[FAI_LINEBASES] > 0 and linebases > entry[FAI_LINEBASES]):
+                        raise Exception('\nERROR: Different line lengths in sequence %s, FASTA file cannot be indexed!' % entry[FAI_NAME])
+                    if entry[FAI_LINEBASES] == 0:
+                        entry[FAI_LINEBASES] = linebases
+                        entry[FAI_LINEWIDTH] = linewidth
+                    elif linebases < entry[FAI_LINEBASES]:
+                        short_line = True
+                    entry[FAI_LENGTH] += linebases
+                else:
+                    short_line = True
+            offset += linewidth
+
+    if entry is not None:
+        entries.append(entry)
+
+    return entries
+
+
+# Writes index entries to a .fai file
+def write_fai(entries, fai_path):
+    with open(fai_path, 'w') as fai:
+        for entry in entries:
+            fai.write('%s\t%d\t%d\t%d\t%d\n' % tuple(entry))
+
+
+# Reads index entries from a .fai file
+def read_fai(fai_path):
+    entries = []
+    with open(fai_path, 'r') as fai:
+        for line in fai:
+            elements = line.rstrip('\r\n').split('\t')
+            if len(elements) < 5:
+                continue
+            entries.append([elements[0]] + [int(x) for x in elements[1:5]])
+    return entries
+
+
+# Loads an index for a FASTA file, builds it if it does not exist or if it is older than the FASTA file
+# If the index can not be written next to the FASTA file, it is only kept in memory
+def load_fai(fasta_path):
+    fai_path = fasta_path + '.fai'
+    if fai_is_valid(fasta_path, fai_path):
+        return read_fai(fai_path)
+
+    sys.stderr.write('\n(%s) Building FASTA index %s ... ' % (datetime.now().time().isoformat(), fai_path))
+    entries = calc_fai(fasta_path)
+    try:
+        write_fai(entries, fai_path)
+    except IOError:
+        sys.stderr.write('\nWARNING: Unable to write FASTA index %s, using it only in memory!' % fai_path)
+
+    return entries
+
+
+# A FASTA reference accessed through a memory mapped file
+# Behaves like a list of sequences: reference[i] returns the i-th sequence as a string
+# The last used sequence is cached, so that alignments on the same chromosome do not reload it
+# Parts of a sequence can be read without loading the whole sequence using fetch()
+class FastaReference:
+
+    def __init__(self, fasta_path):
+        self.filename = fasta_path
+        self.entries = load_fai(fasta_path)
+        self.lengths = [entry[FAI_LENGTH] for entry in self.entries]
+
+        self.file = None
+        self.mm = None
+        self.cached_idx = -1
+        self.cached_seq = ''
+
+        self.headers = [self.readHeader(i) for i in xrange(len(self.entries))]
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, idx):
+        if idx != self.cached_idx:
+            self.cached_seq = self.fetch(idx, 0, self.lengths[idx])
+            self.cached_idx = idx
+        return self.cached_seq
+
+    # Memory map can not be sent to a different process, it is reopened when needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file'] = None
+        state['mm'] = None
+        state['cached_idx'] = -1
+        state['cached_seq'] = ''
+        return state
+
+    def open(self):
+        if self.mm is None:
+            self.file = open(self.filename, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.file.close()
+        self.mm = None
+        self.file = None
+        self.cached_idx = -1
+        self.cached_seq = ''
+
+    # Full header line of a sequence (without '>'), index only keeps the first word
+    def readHeader(self, idx):
+        self.open()
+        seqoffset = self.entries[idx][FAI_OFFSET]
+        start = self.mm.rfind('\n', 0, seqoffset - 1) + 1
+        return self.mm[start:seqoffset].rstrip('\r\n')[1:].strip()
+
+    # Byte offset in the file of a given (0-based) position in a sequence
+    def fileOffset(self, idx, pos):
+        [name, length, offset, linebases, linewidth] = self.entries[idx]
+        if linebases == 0:
+            return offset
+        return offset + (pos / linebases) * linewidth + pos % linebases
+
+    # Returns the part of the idx-th sequence between start and end (0-based, end not included)
+    def fetch(self, idx, start, end):
+        length = self.lengths[idx]
+        start = max(0, start)
+        end = min(end, length)
+        if start >= end:
+            return ''
+        if idx == self.cached_idx:
+            return self.cached_seq[start:end]
+
+        self.open()
+        filestart = self.fileOffset(idx, start)
+        fileend = self.fileOffset(idx, end - 1) + 1
+        return self.mm[filestart:fileend].replace('\n', '').replace('\r', '')
@@ -0,0 +1,418 @@
+#! /usr/bin/python
+
+# Generates a synthetic dataset of configurable size from a reference genome and a set of annotations
+# Reads are simulated from transcripts (like PBSIM run on a transcriptome) and written as:
+#   - mappings in SAM format, with spliced alignments, split (supplementary) alignments,
+#     multi-mapped reads (secondary alignments) and unmapped reads
+#   - simulation data organized in the same way as PBSIM output (sd_XXXX.ref, sd_XXXX.fastq and sd_XXXX.maf files),
+#     so that the mappings can be evaluated using Process_pbsim_data.py
+# Intended for testing and benchmarking evaluation scripts on large inputs
+
+import sys, os
+import random
+import string
+import paramsparser
+
+from datetime import datetime
+
+# To enable importing from samscripts submodule
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(SCRIPT_PATH, 'samscripts/src'))
+
+import Annotation_formats
+import fasta_index
+from RNAseq_benchmark import benchmark_params
+
+
+DEFAULT_NUM_READS = 10000
+DEFAULT_READ_LENGTH = 2000
+DEFAULT_ERROR_RATE = 0.09
+DEFAULT_UNMAPPED = 0.02
+DEFAULT_MULTI = 0.05
+DEFAULT_SPLIT = 0.05
+DEFAULT_PREFIX = 'SimG1'
+
+# Transcripts shorter than this are not used, as PBSIM requires (see example_dataset/example.md)
+MIN_TRANSCRIPT_LENGTH = 100
+MIN_READ_LENGTH = 50
+
+# Cumulative probabilities of error types (mismatch, insertion, deletion)
+# Difference ratio 48:42:10 is taken from GraphMap mappings of PBSIM reads in the example dataset
+ERROR_PROFILE = [(0.48, 'X'), (0.90, 'I'), (1.00, 'D')]
+
+FASTQ_QUALITY = '5'
+
+COMPLEMENT = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+paramdefs = {'-n' : 1,
+             '--num_reads' : 1,
+             '-o' : 1,
+             '--output' : 1,
+             '--read_length' : 1,
+             '--error_rate' : 1,
+             '--unmapped' : 1,
+             '--multi' : 1,
+             '--split' : 1,
+             '--seed' : 1,
+             '--prefix' : 1}
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+# Appends an operation to a list of CIGAR operations ([length, operation]), joining it with the last one if they are the same
+def add_cigar_op(cigar, length, op):
+    if length <= 0:
+        return
+    if len(cigar) > 0 and cigar[-1][1] == op:
+        cigar[-1][0] += length
+    else:
+        cigar.append([length, op])
+
+
+def cigar_to_string(cigar):
+    return ''.join('%d%s' % (length, op) for [length, op] in cigar)
+
+
+# Number of reference bases covered by CIGAR operations
+def cigar_reference_length(cigar):
+    return sum(length for [length, op] in cigar if op in 'MDN')
+
+
+# Number of read bases covered by CIGAR operations
+def cigar_query_length(cigar):
+    return sum(length for [length, op] in cigar if op in 'MI')
+
+
+# A transcript used for simulation, with exons in genomic order (0-based, end not included)
+# Sequence of the transcript is kept in genomic orientation, for the reverse strand it has to be reverse complemented
+class SimTranscript:
+
+    def __init__(self, annotation, chromseq):
+        self.annotation = annotation
+        self.exons = sorted((item.start - 1, item.end - 1) for item in annotation.items)
+        self.sequence = ''.join(chromseq[start:end] for (start, end) in self.exons).upper()
+        self.length = len(self.sequence)
+
+        # Position of each exon within transcript sequence
+        self.offsets = []
+        offset = 0
+        for (start, end) in self.exons:
+            self.offsets.append(offset)
+            offset += end - start
+
+    # Sequence in transcript orientation, as it would be in a transcriptome (see generate_transcriptome.py)
+    def getSequence(self):
+        if self.annotation.strand == Annotation_formats.GFF_STRANDRV:
+            return reverse_complement(self.sequence)
+        return self.sequence
+
+    # Converts a part of the transcript (given in transcript orientation) to parts of the genome
+    # Returns [genomic start of the first part, sequences of all parts, lengths of introns between parts]
+    def getParts(self, start, length):
+        if self.annotation.strand == Annotation_formats.GFF_STRANDRV:
+            start = self.length - start - length
+        end = start + length
+
+        parts = []
+        introns = []
+        genomic_start = -1
+        for i in xrange(len(self.exons)):
+            exon_start = self.offsets[i]
+            exon_end = exon_start + self.exons[i][1] - self.exons[i][0]
+            if exon_end <= start or exon_start >= end:
+                continue
+            if genomic_start < 0:
+                genomic_start = self.exons[i][0] + start - exon_start
+            else:
+                introns.append(self.exons[i][0] - self.exons[i-1][1])
+            parts.append(self.sequence[max(start, exon_start):min(end, exon_end)])
+
+        return [genomic_start, parts, introns]
+
+
+# Introduces sequencing errors into parts of the genome covered by a read
+# Errors are placed at geometrically distributed distances, so the time does not depend on the read length
+# Deletions are not placed at the ends of parts and insertions are not placed at the start of a part,
+# so that each part starts and ends with a match (as it would be reported by an aligner)
+# Returns [CIGAR operations, read sequence (in genomic orientation), reference and read alignment columns]
+def apply_errors(parts, introns, rnd, error_rate):
+    cigar = []
+    read_seq = []
+    ref_cols = []
+    read_cols = []
+
+    def next_error_distance():
+        if error_rate <= 0:
+            return sys.maxint
+        return 1 + int(rnd.expovariate(error_rate))
+
+    next_error = next_error_distance() - 1
+    offset = 0
+    for i in xrange(len(parts)):
+        refseq = parts[i]
+        if i > 0:
+            add_cigar_op(cigar, introns[i-1], 'N')
+        pos = 0
+        while pos < len(refseq):
+            errpos = next_error - offset
+            if errpos >= len(refseq):
+                errpos = len(refseq)
+            chunk = refseq[pos:errpos]
+            add_cigar_op(cigar, len(chunk), 'M')
+            read_seq.append(chunk)
+            ref_cols.append(chunk)
+            read_cols.append(chunk)
+            if errpos == len(refseq):
+                break
+
+            base = refseq[errpos]
+            r = rnd.random()
+            for (prob, errtype) in ERROR_PROFILE:
+                if r < prob:
+                    break
+            if errtype == 'D' and (errpos == 0 or errpos == len(refseq) - 1):
+                errtype = 'X'
+            if errtype == 'I' and errpos == 0:
+                errtype = 'X'
+
+            if errtype == 'X':
+                newbase = rnd.choice([b for b in 'ACGT' if b != base])
+                add_cigar_op(cigar, 1, 'M')
+                read_seq.append(newbase)
+                ref_cols.append(base)
+                read_cols.append(newbase)
+            elif errtype == 'I':
+                newbase = rnd.choice('ACGT')
+                add_cigar_op(cigar, 1, 'I')
+                add_cigar_op(cigar, 1, 'M')
+                read_seq.append(newbase + base)
+                ref_cols.append('-' + base)
+                read_cols.append(newbase + base)
+            else:
+                add_cigar_op(cigar, 1, 'D')
+                ref_cols.append(base)
+                read_cols.append('-')
+
+            pos = errpos + 1
+            next_error += next_error_distance()
+        offset += len(refseq)
+
+    return [cigar, ''.join(read_seq), ''.join(ref_cols), ''.join(read_cols)]
+
+
+# Splits a read alignment into two parts, the first one is written as a primary and the second one as a supplementary alignment
+# Split is made at an intron if the alignment has any, otherwise in the middle of the longest match
+# Returns [[pos, CIGAR] for the first part, [pos, CIGAR] for the second part]
+def split_alignment(pos, cigar, rnd):
+    introns = [i for i in xrange(len(cigar)) if cigar[i][1] == 'N']
+    if len(introns) > 0:
+        i = rnd.choice(introns)
+        first = cigar[:i]
+        second = cigar[i+1:]
+    else:
+        i = max(xrange(len(cigar)), key = lambda k: cigar[k][0] if cigar[k][1] == 'M' else 0)
+        length = cigar[i][0]
+        if cigar[i][1] != 'M' or length < 2:
+            return None
+        first = cigar[:i] + [[length / 2, 'M']]
+        second = [[length - length / 2, 'M']] + cigar[i+1:]
+
+    second_pos = pos + cigar_reference_length(cigar) - cigar_reference_length(second)
+    first = first + [[cigar_query_length(second), 'S']]
+    second = [[cigar_query_length(first), 'S']] + second
+    return [[pos, first], [second_pos, second]]
+
+
+def format_samline(qname, flag, rname, pos, mapq, cigar, seq):
+    return '%s\t%d\t%s\t%d\t%d\t%s\t*\t0\t0\t%s\t*\n' % (qname, flag, rname, pos, mapq, cigar, seq)
+
+
+# Distributes reads between transcripts, with transcript expression levels drawn from an exponential distribution
+def distribute_reads(num_transcripts, num_reads, rnd):
+    weights = [rnd.expovariate(1.0) for i in xrange(num_transcripts)]
+    total = sum(weights)
+    counts = [int(num_reads * w / total) for w in weights]
+    for i in xrange(num_reads - sum(counts)):
+        counts[rnd.randrange(num_transcripts)] += 1
+    return counts
+
+
+def generate_data(ref_file, annotations_file, out_folder, paramdict):
+    num_reads = DEFAULT_NUM_READS
+    if '-n' in paramdict:
+        num_reads = int(paramdict['-n'][0])
+    elif '--num_reads' in paramdict:
+        num_reads = int(paramdict['--num_reads'][0])
+
+    sam_file = os.path.join(out_folder, 'simulated.sam')
+    if '-o' in paramdict:
+        sam_file = paramdict['-o'][0]
+    elif '--output' in paramdict:
+        sam_file = paramdict['--output'][0]
+
+    read_length = int(paramdict['--read_length'][0]) if '--read_length' in paramdict else DEFAULT_READ_LENGTH
+    error_rate = float(paramdict['--error_rate'][0]) if '--error_rate' in paramdict else DEFAULT_ERROR_RATE
+    unmapped = float(paramdict['--unmapped'][0]) if '--unmapped' in paramdict else DEFAULT_UNMAPPED
+    multi = float(paramdict['--multi'][0]) if '--multi' in paramdict else DEFAULT_MULTI
+    split = float(paramdict['--split'][0]) if '--split' in paramdict else DEFAULT_SPLIT
+    seed = int(paramdict['--seed'][0]) if '--seed' in paramdict else 0
+    prefix = paramdict['--prefix'][0] if '--prefix' in paramdict else DEFAULT_PREFIX
+
+    if prefix not in benchmark_params.simFolderDict:
+        raise Exception('\nERROR: Simulation prefix %s is not defined in simFolderDict (see RNAseq_benchmark.py)!' % prefix)
+    if num_reads < 1 or read_length < MIN_READ_LENGTH:
+        raise Exception('\nERROR: Invalid number of reads (%d) or read length (%d)!' % (num_reads, read_length))
+
+    rnd = random.Random(seed)
+    sim_folder = os.path.join(out_folder, benchmark_params.simFolderDict[prefix])
+    if not os.path.exists(sim_folder):
+        os.makedirs(sim_folder)
+
+    sys.stderr.write('\n(%s) Loading reference and annotations ...' % datetime.now().time().isoformat())
+    reference = fasta_index.FastaReference(ref_file)
+    chromnames = [entry[fasta_index.FAI_NAME] for entry in reference.entries]
+    chromidx = dict((chromnames[i], i) for i in xrange(len(chromnames)))
+
+    annotations = Annotation_formats.Load_Annotation_From_File(annotations_file)
+    annotations = [annotation for annotation in annotations if annotation.seqname in chromidx]
+    # Keeping annotations for the same chromosome together, so that each chromosome is loaded only once
+    annotations.sort(key = lambda annotation: (chromidx[annotation.seqname], annotation.start))
+    transcript_lengths = [sum(item.getLength() for item in annotation.items) for annotation in annotations]
+    annotations = [annotations[i] for i in xrange(len(annotations)) if transcript_lengths[i] >= MIN_TRANSCRIPT_LENGTH]
+    if len(annotations) == 0:
+        raise Exception('\nERROR: No annotations of sufficient length for chromosomes in the reference!')
+
+    counts = distribute_reads(len(annotations), num_reads, rnd)
+
+    sys.stderr.write('\n(%s) Generating %d reads from %d transcripts ...' % (datetime.now().time().isoformat(), num_reads, len(annotations)))
+    stats = {'reads' : 0, 'alignments' : 0, 'unmapped' : 0, 'multi' : 0, 'split' : 0, 'spliced' : 0}
+    ref_number = 0
+    report_step = max(1, num_reads / 10)
+    with open(sam_file, 'w') as samfile:
+        samfile.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for i in xrange(len(chromnames)):
+            samfile.write('@SQ\tSN:%s\tLN:%d\n' % (chromnames[i], reference.lengths[i]))
+        samfile.write('@PG\tID:generate_synthetic_data\tPN:generate_synthetic_data\tCL:%s\n' % paramdict['command'])
+
+        for k in xrange(len(annotations)):
+            if counts[k] == 0:
+                continue
+            annotation = annotations[k]
+            rname = annotation.seqname
+            transcript = SimTranscript(annotation, reference[chromidx[rname]])
+            ref_number += 1
+            sim_name = 'sd_%04d' % ref_number
+
+            with open(os.path.join(sim_folder, sim_name + '.ref'), 'w') as reffile:
+                reffile.write('>%s\n%s\n' % (annotation.genename, transcript.getSequence()))
+
+            maffile = open(os.path.join(sim_folder, sim_name + '.maf'), 'w')
+            fastqfile = open(os.path.join(sim_folder, sim_name + '.fastq'), 'w')
+            for read_number in xrange(1, counts[k] + 1):
+                sim_qname = 'S%d_%d' % (ref_number, read_number)
+                qname = '%s_%s' % (prefix, sim_qname)
+
+                length = int(rnd.gauss(read_length, read_length / 2))
+                length = min(transcript.length, max(MIN_READ_LENGTH, length))
+                start = rnd.randint(0, transcript.length - length)
+                read_strand = rnd.choice(['+', '-'])
+
+                [pos, parts, introns] = transcript.getParts(start, length)
+                [cigar, seq, ref_cols, read_cols] = apply_errors(parts, introns, rnd, error_rate)
+
+                # MAF alignment is given in transcript orientation
+                if annotation.strand == Annotation_formats.GFF_STRANDRV:
+                    ref_cols = reverse_complement(ref_cols)
+                    read_cols = reverse_complement(read_cols)
+                maffile.write('a\ns ref %d %d + %d %s\n' % (start, length, transcript.length, ref_cols))
+                maffile.write('s %s 0 %d %s %d %s\n\n' % (sim_qname, len(seq), read_strand, len(seq), read_cols))
+
+                # SAM sequence is given in genomic orientation, the read is reversed if its orientation
+                # is different from the orientation of the transcript
+                reverse = (read_strand == '-') != (annotation.strand == Annotation_formats.GFF_STRANDRV)
+                fastq_seq = reverse_complement(seq) if reverse else seq
+                fastqfile.write('@%s\n%s\n+%s\n%s\n' % (sim_qname, fastq_seq, sim_qname, FASTQ_QUALITY * len(fastq_seq)))
+
+                stats['reads'] += 1
+                if stats['reads'] % report_step == 0:
+                    sys.stderr.write('\n(%s) Generated %d reads' % (datetime.now().time().isoformat(), stats['reads']))
+
+                r = rnd.random()
+                if r < unmapped:
+                    samfile.write(format_samline(qname, 4, '*', 0, 0, '*', seq))
+                    stats['unmapped'] += 1
+                    continue
+
+                flag = 16 if reverse else 0
+                pos += 1            # SAM positions are 1-based
+                if len(introns) > 0:
+                    stats['spliced'] += 1
+
+                split_parts = split_alignment(pos, cigar, rnd) if r < unmapped + split else None
+                if split_parts is not None:
+                    [[pos1, cigar1], [pos2, cigar2]] = split_parts
+                    mapq = rnd.randint(20, 60)
+                    samfile.write(format_samline(qname, flag, rname, pos1, mapq, cigar_to_string(cigar1), seq))
+                    samfile.write(format_samline(qname, flag | 2048, rname, pos2, mapq, cigar_to_string(cigar2), seq))
+                    stats['alignments'] += 2
+                    stats['split'] += 1
+                elif r < unmapped + split + multi:
+                    # Secondary alignment is an unspliced alignment to a random position in the genome
+                    samfile.write(format_samline(qname, flag, rname, pos, rnd.randint(0, 3), cigar_to_string(cigar), seq))
+                    chrom = rnd.randrange(len(chromnames))
+                    seclength = len(seq)
+                    secpos = rnd.randint(1, max(1, reference.lengths[chrom] - seclength))
+                    samfile.write(format_samline(qname, flag | 256, chromnames[chrom], secpos, 0, '%dM' % seclength, '*'))
+                    stats['alignments'] += 2
+                    stats['multi'] += 1
+                else:
+                    samfile.write(format_samline(qname, flag, rname, pos, rnd.randint(20, 60), cigar_to_string(cigar), seq))
+                    stats['alignments'] += 1
+
+            maffile.close()
+            fastqfile.close()
+
+    reference.close()
+    sys.stderr.write('\n(%s) Done: %d reads from %d transcripts, %d alignments, %d spliced, %d split, %d multi-mapped, %d unmapped\n' \
+                     % (datetime.now().time().isoformat(), stats['reads'], ref_number, stats['alignments'], stats['spliced'], \
+                        stats['split'], stats['multi'], stats['unmapped']))
+    sys.stderr.write('\nSAM file: %s\nSimulation folder: %s\n' % (sam_file, out_folder))
+
+
+def verbose_usage_and_exit():
+    sys.stderr.write('Generate synthetic data - generates simulated reads and their mappings from a reference and annotations.\n')
+    sys.stderr.write('                        - Writes mappings in SAM format and simulation data in PBSIM format,\n')
+    sys.stderr.write('                          which can be evaluated using Process_pbsim_data.py.\n')
+    sys.stderr.write('\n')
+    sys.stderr.write('Usage:\n')
+    sys.stderr.write('\t%s <reference FASTA file> <annotations file> <output folder> options\n' % sys.argv[0])
+    sys.stderr.write('\n')
+    sys.stderr.write('\toptions:\n')
+    sys.stderr.write('\t-n (--num_reads) <int> : number of simulated reads (default %d)\n' % DEFAULT_NUM_READS)
+    sys.stderr.write('\t-o (--output) <file> : output SAM file (default <output folder>/simulated.sam)\n')
+    sys.stderr.write('\t--read_length <int> : mean read length (default %d)\n' % DEFAULT_READ_LENGTH)
+    sys.stderr.write('\t--error_rate <float> : rate of sequencing errors (mismatches, insertions and deletions) (default %g)\n' % DEFAULT_ERROR_RATE)
+    sys.stderr.write('\t--unmapped <float> : fraction of unmapped reads (default %g)\n' % DEFAULT_UNMAPPED)
+    sys.stderr.write('\t--multi <float> : fraction of reads with a secondary alignment (default %g)\n' % DEFAULT_MULTI)
+    sys.stderr.write('\t--split <float> : fraction of reads split into a primary and a supplementary alignment (default %g)\n' % DEFAULT_SPLIT)
+    sys.stderr.write('\t--seed <int> : seed for the random number generator (default 0)\n')
+    sys.stderr.write('\t--prefix <prefix> : simulation prefix of read names, must be defined in simFolderDict (default %s)\n' % DEFAULT_PREFIX)
+    sys.stderr.write('\n')
+    exit(0)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 4):
+        verbose_usage_and_exit()
+
+    ref_file = sys.argv[1]
+    annotations_file = sys.argv[2]
+    out_folder = sys.argv[3]
+
+    pparser = paramsparser.Parser(paramdefs)
+    paramdict = pparser.parseCmdArgs(sys.argv[4:])
+    paramdict['command'] = ' '.join(sys.argv)
+
+    generate_data(ref_file, annotations_file, out_folder, paramdict)
@@ -0,0 +1,112 @@
+#! /usr/bin/python
+
+# Records wall time, CPU time and peak memory (RSS) for stages of the evaluation and for tasks
+# executed by worker processes (used with --profile option)
+# The whole profile is written as a JSON file
+
+import sys
+import time
+import resource
+import json
+import collections
+
+
+# Returns a snapshot of the current process resource usage: [wall time, CPU time, peak RSS in kB]
+# CPU time includes both user and system time
+def measure():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return [time.time(), usage.ru_utime + usage.ru_stime, usage.ru_maxrss]
+
+
+# Returns resource usage between a snapshot (see measure) and now, as a dictionary
+# Peak RSS is the peak for the whole process up to now
+def measure_since(start):
+    [wall, cpu, max_rss] = measure()
+    return {'wall' : wall - start[0],
+            'cpu' : cpu - start[1],
+            'max_rss_kb' : max_rss}
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = None
+        self.stages = collections.OrderedDict()     # Stage name -> times and peak memory, summed over all runs of a stage
+        self.running = {}                           # Stage name -> snapshot taken when the stage was started
+        self.tasks = []                             # Tasks executed by worker processes
+
+    def enable(self):
+        self.enabled = True
+        self.start_time = measure()
+
+    # Stages are started and stopped by name, so they can overlap (e.g. merging results is a part of evaluation)
+    # A stage can be run several times (e.g. once for each SAM file), its times are then summed
+    def start(self, name):
+        if self.enabled:
+            self.running[name] = measure()
+
+    def stop(self, name):
+        if not self.enabled:
+            return
+        usage = measure_since(self.running.pop(name))
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = {'wall' : 0.0, 'cpu' : 0.0, 'max_rss_kb' : 0, 'count' : 0}
+            self.stages[name] = stage
+        stage['wall'] += usage['wall']
+        stage['cpu'] += usage['cpu']
+        stage['max_rss_kb'] = max(stage['max_rss_kb'], usage['max_rss_kb'])
+        stage['count'] += 1
+
+    # Adds information on a task executed by a worker process (a dictionary, see RNAseqEval.eval_mapping_unit)
+    def add_task(self, task):
+        if self.enabled:
+            self.tasks.append(task)
+
+    # Returns the whole profile as a dictionary
+    # Besides stages and tasks, it contains totals for the main process and for all worker processes,
+    # and a summary for each part of the evaluation (chromosome and strand) over all tasks
+    # Pieces of a part can be evaluated at the same time, so wall times of pieces are not summed,
+    # the summary contains the time from the start of the first piece to the end of the last one (elapsed)
+    def get_profile(self):
+        parts = collections.OrderedDict()
+        for task in self.tasks:
+            for piece in task['parts']:
+                part = parts.get(piece['part'])
+                end = piece['start'] + piece['wall']
+                if part is None:
+                    part = {'reads' : 0, 'cpu' : 0.0, 'start' : piece['start'], 'end' : end}
+                    parts[piece['part']] = part
+                part['reads'] += piece['reads']
+                part['cpu'] += piece['cpu']
+                part['start'] = min(part['start'], piece['start'])
+                part['end'] = max(part['end'], end)
+        for part in parts.itervalues():
+            part['elapsed'] = part.pop('end') - part.pop('start')
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'total' : measure_since(self.start_time),
+                'workers' : {'cpu' : children.ru_utime + children.ru_stime,
+                             'max_rss_kb' : children.ru_maxrss,
+                             'tasks' : len(self.tasks)},
+                'stages' : [dict(stage, name = name) for (name, stage) in self.stages.iteritems()],
+                'parts' : [dict(part, name = name) for (name, part) in parts.iteritems()],
+                'tasks' : self.tasks}
+
+    # Writes the profile to a JSON file, or to stderr if the filename is empty
+    def write(self, filename):
+        if not self.enabled:
+            return
+        if filename != '':
+            with open(filename, 'w+') as profile_file:
+                json.dump(self.get_profile(), profile_file, indent = 1)
+                profile_file.write('\n')
+        else:
+            sys.stderr.write('\nProfile:\n')
+            json.dump(self.get_profile(), sys.stderr, indent = 1)
+            sys.stderr.write('\n')
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,184 @@
+#! /usr/bin/python
+
+# Progress reporting for evaluations done by worker processes
+# Workers count evaluated reads for each part (e.g. chromosome strand) and send the counts to the main
+# process through a queue, every PROGRESS_READS reads. The main process collects them in a separate thread
+# and periodically writes total progress, throughput and estimated time to finish to stderr, and optionally
+# to a status file (JSON) that can be polled by other programs (used with --status_file option)
+
+import sys, os
+import time
+import json
+import threading
+import multiprocessing
+import Queue
+
+from datetime import datetime, timedelta
+
+
+# Workers send their counts after this many reads
+PROGRESS_READS = 1000
+
+# Progress is written to stderr and to the status file at most once in this many seconds
+PROGRESS_INTERVAL = 10.0
+
+
+# Worker side
+# Queue is given to each worker process when it is started (see init_worker), reads are counted for the current part
+worker_queue = None
+worker_part = None
+worker_count = 0
+
+def init_worker(queue):
+    global worker_queue
+    worker_queue = queue
+
+# Sets the part for which reads are counted, counts for the previous part are sent first
+def start_part(partname):
+    global worker_part
+    flush()
+    worker_part = partname
+
+def add_reads(num_reads = 1):
+    global worker_count
+    worker_count += num_reads
+    if worker_count >= PROGRESS_READS:
+        flush()
+
+# Sends the counted reads to the main process
+def flush():
+    global worker_count
+    if worker_queue is not None and worker_count > 0:
+        worker_queue.put((worker_part, worker_count))
+    worker_count = 0
+
+
+# Main process side
+class ProgressMonitor:
+
+    def __init__(self, status_file = ''):
+        self.queue = multiprocessing.Queue()
+        self.status_file = status_file
+        self.thread = None
+        self.stopping = threading.Event()
+
+        self.name = ''
+        self.start_time = 0.0
+        self.last_write = 0.0
+        self.part_totals = None         # Part name -> the number of reads in the part, None if not known (streaming)
+        self.part_done = {}             # Part name -> the number of evaluated reads
+
+    # Starts collecting progress for an evaluation (e.g. of a single SAM file)
+    # Part totals are the number of reads in each part, if they are known in advance
+    def start(self, name, part_totals = None):
+        # Counts left over from an earlier evaluation are discarded
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+        self.name = name
+        self.start_time = time.time()
+        self.last_write = self.start_time
+        self.part_totals = part_totals
+        self.part_done = {}
+        if part_totals is not None:
+            for partname in part_totals:
+                self.part_done[partname] = 0
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self.collect)
+        self.thread.daemon = True
+        self.thread.start()
+        self.write_status('running')
+
+    # Stops collecting progress and writes the final status
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.write_progress()
+        self.write_status('done')
+
+    # Runs in a separate thread, collects counts sent by workers until stopped
+    def collect(self):
+        while True:
+            try:
+                (partname, num_reads) = self.queue.get(timeout = 0.5)
+                self.part_done[partname] = self.part_done.get(partname, 0) + num_reads
+            except Queue.Empty:
+                if self.stopping.is_set():
+                    break
+
+            now = time.time()
+            if now - self.last_write >= PROGRESS_INTERVAL:
+                self.last_write = now
+                self.write_progress()
+                self.write_status('running')
+
+    # Returns current progress as a dictionary
+    # Total number of reads and estimated time to finish are None if part totals are not known
+    def get_status(self, state):
+        elapsed = time.time() - self.start_time
+        done = sum(self.part_done.values())
+        total = None
+        eta = None
+        if self.part_totals is not None:
+            total = sum(self.part_totals.values())
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if total is not None and rate > 0:
+            eta = max(0.0, (total - done) / rate)
+
+        parts = {}
+        for partname in sorted(self.part_done):
+            parts[partname] = {'done' : self.part_done[partname],
+                               'total' : self.part_totals.get(partname) if self.part_totals is not None else None}
+
+        return {'name' : self.name,
+                'state' : state,
+                'pid' : os.getpid(),
+                'updated' : datetime.now().isoformat(),
+                'elapsed' : elapsed,
+                'reads_done' : done,
+                'reads_total' : total,
+                'reads_per_second' : rate,
+                'eta_seconds' : eta,
+                'parts' : parts}
+
+    # Writes total progress and parts that are being evaluated to stderr
+    def write_progress(self):
+        status = self.get_status('running')
+        line = '\n(%s) Progress: %d' % (datetime.now().time().isoformat(), status['reads_done'])
+        if status['reads_total'] is not None:
+            total = status['reads_total']
+            line += ' / %d reads (%.1f%%)' % (total, 100.0 * status['reads_done'] / total if total > 0 else 100.0)
+        else:
+            line += ' reads'
+        line += ', %.1f reads/s' % status['reads_per_second']
+        if status['eta_seconds'] is not None:
+            line += ', ETA %s' % str(timedelta(seconds = int(status['eta_seconds'])))
+
+        if self.part_totals is not None:
+            finished = [partname for partname in self.part_totals if self.part_done[partname] >= self.part_totals[partname]]
+            running = [partname for partname in sorted(self.part_totals) if 0 < self.part_done[partname] < self.part_totals[partname]]
+            line += '\n\tParts finished: %d / %d' % (len(finished), len(self.part_totals))
+            if len(running) > 0:
+                line += ', in progress: ' + ', '.join('%s %.0f%%' % (partname, 100.0 * self.part_done[partname] / self.part_totals[partname]) for partname in running)
+        sys.stderr.write(line)
+
+    # Writes progress to the status file, the file is replaced at once so that it is never read incomplete
+    def write_status(self, state):
+        if self.status_file == '':
+            return
+        temp_filename = self.status_file + '.tmp'
+        with open(temp_filename, 'w') as temp_file:
+            json.dump(self.get_status(state), temp_file, indent = 1, sort_keys = True)
+            temp_file.write('\n')
+        os.rename(temp_filename, self.status_file)
+
+
+if __name__ == '__main__':
+    pass
@@ -1,5 +1,14 @@
 #! /usr/bin/python
 
+# Reports are built in memory only when returned as a string
+from cStringIO import StringIO
+
+# Used to recreate potential new annotations from partial results
+import Annotation_formats
+
+# Used for machine readable reports
+import json
+
 
 class ReportType:
     FASTA_REPORT = 0
@@ -7,6 +16,33 @@ class ReportType:
     ANNOTATION_REPORT = 2
     TEMP_REPORT = 10        # Report used to temporarily store some data
 
+# Report type names used in machine readable reports
+REPORT_TYPE_NAMES = {ReportType.FASTA_REPORT : 'fasta',
+                     ReportType.MAPPING_REPORT : 'mapping',
+                     ReportType.ANNOTATION_REPORT : 'annotation',
+                     ReportType.TEMP_REPORT : 'temp'}
+
+# Report fields combined when merging reports (see EvalReport.merge)
+# Counters are summed, minimums and maximums (where 0 means not set) are combined
+MERGE_SUM_FIELDS = ['num_alignments', 'num_unique_alignments', 'num_multi_alignments', 'num_possibly_split_alignements',
+                    'num_split_alignments', 'num_non_alignments', 'num_real_alignments', 'num_real_split_alignments',
+                    'num_good_quality', 'num_zero_quality', 'num_evaluated_alignments',
+                    'num_cover_some_exons', 'num_cover_all_exons', 'num_equal_exons', 'num_partial_exons',
+                    'num_multicover_exons', 'num_undercover_alignments', 'num_overcover_alignments',
+                    'num_good_starts', 'num_good_ends', 'num_possible_spliced_alignment',
+                    'num_good_alignment', 'num_bad_alignment', 'num_multi_exon_alignments', 'num_cover_no_exons',
+                    'num_multi_gene_alignments', 'num_bad_split_alignments',
+                    'num_hit_alignments', 'num_partial_alignments', 'num_missed_alignments',
+                    'num_exon_hit', 'num_exon_partial', 'num_exon_miss', 'num_halfbases_hit', 'num_lowmatchcnt',
+                    'num_inside_miss_alignments', 'num_partial_exon_miss', 'num_almost_good', 'num_hit_all']
+MERGE_MIN_FIELDS = ['min_mapping_quality']
+MERGE_MAX_FIELDS = ['max_mapping_quality']
+
+# Query name lists, sent with partial results (see EvalReport.get_partial) but not merged,
+# since they are written to files as soon as partial results are collected (see RNAseqEval.QnameFiles)
+QNAME_FIELDS = ['hitone_names', 'hithalfbases_names', 'contig_names', 'incorr_names', 'unmapped_names']
+
+
 class EvalReport:
 
 
@@ -77,6 +113,7 @@ class EvalReport:
 
         # Advanced mapping information
         self.allowed_inacc = 0
+        self.min_overlap = 0
         self.sum_read_length = 0
         self.sum_bases_aligned = 0
         self.percentage_bases_aligned = 0.0
@@ -186,6 +223,70 @@ class EvalReport:
         self.cna_count = {}
         self.cna_readlist = {}
 
+    # Adds the results from another report to this one, used to combine the results of evaluating
+    # different parts of a SAM file (see MERGE_* lists above for the fields that are combined)
+    # Gene expression and coverage counters are summed, and equal potential new annotations are collapsed
+    # Final results (percentages, averages) are not merged and have to be calculated after merging,
+    # query name lists are not merged either (see QNAME_FIELDS)
+    def merge(self, other):
+        for name in MERGE_SUM_FIELDS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in MERGE_MIN_FIELDS:
+            value = getattr(other, name)
+            if getattr(self, name) == 0 or (value != 0 and value < getattr(self, name)):
+                setattr(self, name, value)
+        for name in MERGE_MAX_FIELDS:
+            value = getattr(other, name)
+            if value > getattr(self, name):
+                setattr(self, name, value)
+        add_gene_counters(self.expressed_genes, other.expressed_genes)
+        add_gene_counters(self.gene_coverage, other.gene_coverage)
+
+        for pna in other.pot_new_annotations:
+            self.add_new_annotation(pna, other.cna_readlist[new_annotation_signature(pna)])
+
+    # Adds a potential new annotation, proposed by the given reads, to the report
+    # Equal new annotations are collapsed into one (the first one added), and the names of all reads proposing it
+    # are collected in cna_readlist (keyed by annotation signature while collecting)
+    def add_new_annotation(self, annotation, readnames):
+        signature = new_annotation_signature(annotation)
+        readlist = self.cna_readlist.get(signature)
+        if readlist is None:
+            self.pot_new_annotations.append(annotation)
+            self.cna_readlist[signature] = list(readnames)
+        else:
+            readlist += readnames
+        self.alignments_with_pna += len(readnames)
+
+    # Returns the fields combined by merge as a dictionary containing only basic types (numbers, strings,
+    # lists and dictionaries), which can be sent between processes or saved as JSON, and merged later
+    # Only counters that are not zero and genes that are expressed are included
+    # The report can be recreated using report_from_partial
+    def get_partial(self):
+        partial = {'rtype' : self.rtype,
+                   'allowed_inacc' : self.allowed_inacc,
+                   'min_overlap' : self.min_overlap}
+        for name in MERGE_SUM_FIELDS + MERGE_MIN_FIELDS + MERGE_MAX_FIELDS + QNAME_FIELDS:
+            value = getattr(self, name)
+            if value:
+                partial[name] = value
+
+        partial['expressed_genes'] = {}
+        partial['gene_coverage'] = {}
+        for genename, counters in self.expressed_genes.iteritems():
+            if any(counters):
+                partial['expressed_genes'][genename] = counters
+                partial['gene_coverage'][genename] = self.gene_coverage[genename]
+
+        # Each potential new annotation is stored with the names of reads that proposed it
+        partial['pot_new_annotations'] = []
+        for pna in self.pot_new_annotations:
+            items = [[item.start, item.end] for item in pna.items]
+            readnames = self.cna_readlist[new_annotation_signature(pna)]
+            partial['pot_new_annotations'].append([pna.seqname, pna.strand, pna.genename, pna.source, items, readnames])
+
+        return partial
+
     def chromosomes(self):
         output = '\t\t'
         for chrom in sorted(self.chromlengths.keys()):
@@ -195,81 +296,155 @@ class EvalReport:
 
         return output
 
+    # Query name lists are written one name per line
+    # get_* functions return them as a string, while write_* functions write them directly to a file
+    def write_names(self, out_file, names):
+        for name in names:
+            out_file.write(name + '\n')
+
+    def write_hitone_names(self, out_file):
+        self.write_names(out_file, self.hitone_names)
+
+    def write_hithalfbases_names(self, out_file):
+        self.write_names(out_file, self.hithalfbases_names)
+
+    def write_contig_names(self, out_file):
+        self.write_names(out_file, self.contig_names)
+
+    def write_incorr_names(self, out_file):
+        self.write_names(out_file, self.incorr_names)
+
+    def write_unmapped_names(self, out_file):
+        self.write_names(out_file, self.unmapped_names)
+
     def get_hitone_names(self):
-        report = ''
-        for name in self.hitone_names:
-            report += name + '\n'
-        return report
+        return ''.join(name + '\n' for name in self.hitone_names)
 
     def get_hithalfbases_names(self):
-        report = ''
-        for name in self.hithalfbases_names:
-            report += name + '\n'
-        return report    
+        return ''.join(name + '\n' for name in self.hithalfbases_names)
 
     def get_contig_names(self):
-        report = ''
-        for name in self.contig_names:
-            report += name + '\n'
-        return report
+        return ''.join(name + '\n' for name in self.contig_names)
 
     def get_incorr_names(self):
-        report = ''
-        for name in self.incorr_names:
-            report += name + '\n'
-        return report
+        return ''.join(name + '\n' for name in self.incorr_names)
 
     def get_unmapped_names(self):
-        report = ''
-        for name in self.unmapped_names:
-            report += name + '\n'
-        return report
+        return ''.join(name + '\n' for name in self.unmapped_names)
+
+    # Writes detailed information on potential new annotations to a file
+    def write_annotation_report(self, out_file):
+        for pna in self.pot_new_annotations:
+            name = pna.genename
+            out_file.write("\nName: %s\nBased on:%s\nStrand: %s\nNumber of reads: %d\n" % (pna.genename, pna.source, pna.strand, self.cna_count[name]))
+            out_file.write("Reads:\n")
+            for rname in self.cna_readlist[name]:
+                out_file.write("\n" + rname)
+            out_file.write("Items:\n")
+            out_file.write(''.join(" [%d, %d]" % (item.start, item.end) for item in pna.items))
+            out_file.write("\n")
 
     def getAnnotationReport(self):
-        report = ''
-        try:
-            for pna in self.pot_new_annotations:
-                name = pna.genename
-                reportline = "\nName: %s\nBased on:%s\nStrand: %s\nNumber of reads: %d\n" % (pna.genename, pna.source, pna.strand, self.cna_count[name])
-                reportline += "Reads:\n"
-                for rname in self.cna_readlist[name]:
-                    reportline += "\n" + rname
-                reportline += "Items:\n"
-                for item in pna.items:
-                    reportline += " [%d, %d]" % (item.start, item.end)
-                reportline += "\n"
-                report += reportline
-        except Exception:
-            import pdb
-            pdb.set_trace()
-
-        return report
-
-    # New toString function for printing out reports
-    # Values reported are consistent with the benchmark paper!
-    def toString(self):
-        if self.rtype == ReportType.FASTA_REPORT:
-            report = """\n
-            Reference format: FASTA
-            General information:
-            Reference length = %d bp
-            Number of chromosomes = %d
-            Chromosomes:\n%s
-            Number of alignments (total / unique) = %d / %d
-            Alignments with / without CIGAR string = %d / %d
-            Mapping quality without zeroes (avg / min / max) = %.2f / %d / %d
-            Alignments with mapping quality (>0 / =0) = %d / %d
-            Number of matches / mismatches / inserts / deletes = %d / %d / %d / %d
-            Percentage of matches / mismatches / inserts / deletes = %.2f / %.2f / %.2f / %.2f
-            """ % (self.reflength, len(self.chromlengths), self.chromosomes(), \
-                   self.num_alignments, self.num_unique_alignments, \
-                   self.num_alignments - self.num_non_alignments, self.num_non_alignments, \
-                   self.avg_mapping_quality, self.min_mapping_quality, self.max_mapping_quality, self.num_good_quality, self.num_zero_quality, \
-                   self.num_match, self.num_mismatch, self.num_insert, self.num_delete, \
-                   self.match_percentage, self.mismatch_percentage, self.insert_percentage, self.delete_percentage)
-            return report + '\n'
-        elif self.rtype == ReportType.MAPPING_REPORT:
-            report = """\n
+        report = StringIO()
+        self.write_annotation_report(report)
+        return report.getvalue()
+
+    # Writes gene expression and coverage information to a file, one line for each expressed transcript
+    # Transcripts are written in sorted order
+    def write_expression(self, out_file):
+        # Counting the number of expressed genes
+        # This has already been written in the report, but this way the value can be double checked
+        exp_gn_cnt = 0
+        for expression in self.expressed_genes.values():
+            if expression[0] > 0:
+                exp_gn_cnt += 1
+
+        out_file.write("""\n
+            Transcript/exon expression and coverage information:
+            Number of expressed Transcripts = %d
+            Expressed transcripts:
+            genename  number_of_exons  gene_hits / gene_covered_bases  [(exon_hits / exon_covered_bases)]...
+                """ % exp_gn_cnt)
+
+        if len(self.expressed_genes) != len(self.gene_coverage):
+            raise Exception('ERROR: Gene expression and gene coverage dictionaries do not match in length! (%d <> %d)' \
+                          % (len(self.expressed_genes), len(self.gene_coverage)))
+
+        for genename in sorted(self.expressed_genes.keys()):
+            numexons = len(self.expressed_genes[genename]) - 1
+            genehits = self.expressed_genes[genename][0]
+            gene_cov_bs = self.gene_coverage[genename][0]
+            if genehits > 0:
+                reportline = '%s  %d  %d  %d' % (genename, numexons, genehits, gene_cov_bs)
+                for i in range(1, numexons+1):
+                    exonhits = self.expressed_genes[genename][i]
+                    exon_cov_bs = self.gene_coverage[genename][i]
+                    reportline += '  (%d / %d)' % (exonhits, exon_cov_bs)
+
+                out_file.write(reportline + '\n')
+
+    # Returns all numerical report fields (counters, percentages and other statistics) as a list of
+    # (name, value) pairs sorted by name, names are the same as report attribute names
+    def get_stats(self):
+        stats = []
+        for name in sorted(vars(self).keys()):
+            value = getattr(self, name)
+            if name != 'rtype' and isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                stats.append((name, value))
+        if self.detect_new_annotations:
+            stats.append(('num_pot_new_annotations', len(self.pot_new_annotations)))
+        return stats
+
+    # Writes the report as a JSON object, containing report type, command line,
+    # chromosome lengths and all numerical fields (see get_stats)
+    def write_json(self, out_file):
+        report = {'report_type' : REPORT_TYPE_NAMES[self.rtype],
+                  'commandline' : self.commandline,
+                  'chromosomes' : self.chromlengths,
+                  'stats' : dict(self.get_stats())}
+        json.dump(report, out_file, sort_keys = True, indent = 1)
+        out_file.write('\n')
+
+    # Writes the report as a tab separated file with two columns (field and value)
+    # Chromosome lengths are written as fields named chromosome_length:<chromosome name>
+    def write_tsv(self, out_file):
+        out_file.write('field\tvalue\n')
+        out_file.write('report_type\t%s\n' % REPORT_TYPE_NAMES[self.rtype])
+        out_file.write('commandline\t%s\n' % self.commandline)
+        for (name, value) in self.get_stats():
+            out_file.write('%s\t%s\n' % (name, repr(value)))
+        for chrom in sorted(self.chromlengths.keys()):
+            out_file.write('chromosome_length:%s\t%d\n' % (chrom, self.chromlengths[chrom]))
+
+    # Writes gene expression and coverage information as a tab separated file, one line for each exon
+    # of each expressed transcript (exon 0 holds the values for the whole transcript)
+    # Transcripts are written in sorted order
+    def write_expression_tsv(self, out_file):
+        out_file.write('transcript\texon\thits\tcovered_bases\n')
+        for genename in sorted(self.expressed_genes.keys()):
+            expression = self.expressed_genes[genename]
+            coverage = self.gene_coverage[genename]
+            if expression[0] > 0:
+                for i in xrange(len(expression)):
+                    out_file.write('%s\t%d\t%d\t%d\n' % (genename, i, expression[i], coverage[i]))
+
+    # Writes the report to a file
+    # For a mapping report, expression information is written line by line, instead of building
+    # the whole report in memory, other reports are written as returned by toString
+    def write(self, out_file):
+        if self.rtype != ReportType.MAPPING_REPORT:
+            out_file.write(self.toString())
+            return
+
+        out_file.write(self.mapping_report_head())
+        if self.output_gene_expression:
+            self.write_expression(out_file)
+        out_file.write(self.mapping_report_tail())
+
+    # Mapping report is written in three parts: general and mapping quality information (head),
+    # expression information (see write_expression) and information on new annotations (tail)
+    def mapping_report_head(self):
+        report = """\n
             Command Line: %s
             Reference format: ANNOTATION
             General information:
@@ -284,13 +459,13 @@ class EvalReport:
             Number of matches / mismatches / inserts / deletes = %d / %d / %d / %d
             Percentage of matches / mismatches / inserts / deletes = %.2f / %.2f / %.2f / %.2f
             """ % (self.commandline, self.reflength, len(self.chromlengths), self.chromosomes(), \
-                   self.num_alignments, self.num_unique_alignments, \
-                   self.num_alignments - self.num_non_alignments, self.num_non_alignments, \
-                   self.avg_mapping_quality, self.min_mapping_quality, self.max_mapping_quality, self.num_good_quality, self.num_zero_quality, \
-                   self.num_match, self.num_mismatch, self.num_insert, self.num_delete, \
-                   self.match_percentage, self.mismatch_percentage, self.insert_percentage, self.delete_percentage)
+               self.num_alignments, self.num_unique_alignments, \
+               self.num_alignments - self.num_non_alignments, self.num_non_alignments, \
+               self.avg_mapping_quality, self.min_mapping_quality, self.max_mapping_quality, self.num_good_quality, self.num_zero_quality, \
+               self.num_match, self.num_mismatch, self.num_insert, self.num_delete, \
+               self.match_percentage, self.mismatch_percentage, self.insert_percentage, self.delete_percentage)
 
-            report += """\n
+        report += """\n
             Annotation statistics:
             Total gene length = %d
             Number of Transcripts / Exons (Multiexon transcripts) = %d / %d (%d)
@@ -298,21 +473,22 @@ class EvalReport:
             Gene size (Min / Max / Avg) = %d / %d / %.2f
             Exon size (Min / Max / Avg) = %d / %d / %.2f
             """ % (self.totalGeneLength, self.num_genes, self.num_exons, self.num_multiexon_genes, self.max_exons_per_gene, \
-                   self.min_gene_length, self.max_gene_length, self.avg_gene_length, \
-                   self.min_exon_length, self.max_exon_length, self.avg_exon_length)
-
-            # report += """\n
-            # Grouped annotation (alternate splicing) statistics:
-            # Number of annotation groups (genes) = %d
-            # Number of genes with alternate splicing = %d
-            # Maximum / minimum number of alternate spliced alignments for a gene = %d / %d
-            # Maximum / minimum number of exons in spliced alignments = %d / %d
-            # """ % (self.num_annotation_groups, self.num_alternate_spliced_genes, \
-            #        self.max_spliced_alignments, self.min_spliced_alignments, \
-            #        self.max_spliced_exons, self.min_spliced_exons)
-
-            report += """\n
+               self.min_gene_length, self.max_gene_length, self.avg_gene_length, \
+               self.min_exon_length, self.max_exon_length, self.avg_exon_length)
+
+        # report += """\n
+        # Grouped annotation (alternate splicing) statistics:
+        # Number of annotation groups (genes) = %d
+        # Number of genes with alternate splicing = %d
+        # Maximum / minimum number of alternate spliced alignments for a gene = %d / %d
+        # Maximum / minimum number of exons in spliced alignments = %d / %d
+        # """ % (self.num_annotation_groups, self.num_alternate_spliced_genes, \
+        #        self.max_spliced_alignments, self.min_spliced_alignments, \
+        #        self.max_spliced_exons, self.min_spliced_exons)
+
+        report += """\n
             Mapping quality information:
+            Allowed inaccuracy / minimum overlap = %d / %d
             Bases in reads (aligned / total) (percent) = (%d / %d) (%.2f%%)
             Transcripts covered / missed / total = %d / %d / %d
             Exons covered / missed / total = %d / %d / %d
@@ -325,64 +501,65 @@ class EvalReport:
             Alignments with a partial miss (not good / "almost "good) = %d / %d
             Contiguous / non contiguous alignments: %d (%.2f%%) / %d (%.2f%%)
             Hit all for real reads: %d (%.2f%%)
-            """ % (self.sum_bases_aligned, self.sum_read_length, self.percentage_bases_aligned, \
-                   self.num_genes_covered, self.num_genes - self.num_genes_covered, self.num_genes, \
-                   self.num_exons_covered, self.num_exons - self.num_exons_covered, self.num_exons, \
-                   self.num_evaluated_alignments, \
-                   self.num_hit_alignments, self.num_missed_alignments, \
-                   self.num_exon_hit, self.num_exon_miss, \
-                   self.num_halfbases_hit, \
-                   self.num_lowmatchcnt, \
-                   self.num_good_starts, self.num_good_ends, self.num_equal_exons, \
-                   self.num_partial_exon_miss, self.num_almost_good, \
-                   self.num_good_alignment, self.good_alignment_percent, self.num_bad_alignment, self.bad_alignment_percent, \
-                   self.num_hit_all, self.hit_all_percent)
-
-            # Counting the number of expressed genes
-            # This has already been written in the report, but this way the value can be double checked
-            exp_gn_cnt = 0
-            for expression in self.expressed_genes.values():
-                if expression[0] > 0:
-                    exp_gn_cnt += 1
-
-            if self.output_gene_expression:
+            """ % (self.allowed_inacc, self.min_overlap, \
+               self.sum_bases_aligned, self.sum_read_length, self.percentage_bases_aligned, \
+               self.num_genes_covered, self.num_genes - self.num_genes_covered, self.num_genes, \
+               self.num_exons_covered, self.num_exons - self.num_exons_covered, self.num_exons, \
+               self.num_evaluated_alignments, \
+               self.num_hit_alignments, self.num_missed_alignments, \
+               self.num_exon_hit, self.num_exon_miss, \
+               self.num_halfbases_hit, \
+               self.num_lowmatchcnt, \
+               self.num_good_starts, self.num_good_ends, self.num_equal_exons, \
+               self.num_partial_exon_miss, self.num_almost_good, \
+               self.num_good_alignment, self.good_alignment_percent, self.num_bad_alignment, self.bad_alignment_percent, \
+               self.num_hit_all, self.hit_all_percent)
+
+        return report
+
+    def mapping_report_tail(self):
+        report = ''
+        if self.detect_new_annotations:
+            if len(self.pot_new_annotations) > 0:
                 report += """\n
-            Transcript/exon expression and coverage information:
-            Number of expressed Transcripts = %d
-            Expressed transcripts:
-            genename  number_of_exons  gene_hits / gene_covered_bases  [(exon_hits / exon_covered_bases)]...
-                """ % exp_gn_cnt
-
-                if len(self.expressed_genes) != len(self.gene_coverage):
-                    raise Exception('ERROR: Gene expression and gene coverage dictionaries do not match in length! (%d <> %d)' \
-                                  % (len(self.expressed_genes), len(self.gene_coverage)))
-
-                for genename in self.expressed_genes.keys():
-                    numexons = len(self.expressed_genes[genename]) - 1
-                    genehits = self.expressed_genes[genename][0]
-                    gene_cov_bs = self.gene_coverage[genename][0]
-                    if genehits > 0:
-                        reportline = '%s  %d  %d  %d' % (genename, numexons, genehits, gene_cov_bs)
-                        for i in range(1, numexons+1):
-                            exonhits = self.expressed_genes[genename][i]
-                            exon_cov_bs = self.gene_coverage[genename][i]
-                            reportline += '  (%d / %d)' % (exonhits, exon_cov_bs)
-
-                        report += reportline + '\n'
-
-            if self.detect_new_annotations:
-                if len(self.pot_new_annotations) > 0:
-                    report += """\n
                     Found %d potential new annotations with %d alignments
                     """ % (len(self.pot_new_annotations), self.alignments_with_pna)
-                else:
-                    report += """\n
+            else:
+                report += """\n
                     Found NO potential new annotations:
                     """
 
-                report += """\nDetailed report on annotations can be found in an '_annotations.report' file.\n"""
+            report += """\nDetailed report on annotations can be found in an '_annotations.report' file.\n"""
 
+        return report + '\n'
+
+    # New toString function for printing out reports
+    # Values reported are consistent with the benchmark paper!
+    def toString(self):
+        if self.rtype == ReportType.FASTA_REPORT:
+            report = """\n
+            Reference format: FASTA
+            General information:
+            Reference length = %d bp
+            Number of chromosomes = %d
+            Chromosomes:\n%s
+            Number of alignments (total / unique) = %d / %d
+            Alignments with / without CIGAR string = %d / %d
+            Mapping quality without zeroes (avg / min / max) = %.2f / %d / %d
+            Alignments with mapping quality (>0 / =0) = %d / %d
+            Number of matches / mismatches / inserts / deletes = %d / %d / %d / %d
+            Percentage of matches / mismatches / inserts / deletes = %.2f / %.2f / %.2f / %.2f
+            """ % (self.reflength, len(self.chromlengths), self.chromosomes(), \
+                   self.num_alignments, self.num_unique_alignments, \
+                   self.num_alignments - self.num_non_alignments, self.num_non_alignments, \
+                   self.avg_mapping_quality, self.min_mapping_quality, self.max_mapping_quality, self.num_good_quality, self.num_zero_quality, \
+                   self.num_match, self.num_mismatch, self.num_insert, self.num_delete, \
+                   self.match_percentage, self.mismatch_percentage, self.insert_percentage, self.delete_percentage)
             return report + '\n'
+        elif self.rtype == ReportType.MAPPING_REPORT:
+            report = StringIO()
+            self.write(report)
+            return report.getvalue()
         elif self.rtype == ReportType.ANNOTATION_REPORT:
             report = """\n
             Command Line: %s
@@ -617,5 +794,104 @@ class EvalReport:
     #         return "\nERROR: Report not initialized!\n"
 
 
+# Report fields compared when evaluating multiple mappings (eval-mapping-multi)
+# Each entry is (description, attribute of EvalReport)
+COMPARISON_FIELDS = [('Number of alignments (total)', 'num_alignments'),
+                     ('Number of alignments (unique)', 'num_unique_alignments'),
+                     ('Alignments without CIGAR string', 'num_non_alignments'),
+                     ('Average mapping quality (without zeroes)', 'avg_mapping_quality'),
+                     ('Percentage of matches', 'match_percentage'),
+                     ('Percentage of mismatches', 'mismatch_percentage'),
+                     ('Percentage of inserts', 'insert_percentage'),
+                     ('Percentage of deletes', 'delete_percentage'),
+                     ('Bases in reads aligned', 'sum_bases_aligned'),
+                     ('Bases in reads total', 'sum_read_length'),
+                     ('Bases in reads aligned (percent)', 'percentage_bases_aligned'),
+                     ('Transcripts covered', 'num_genes_covered'),
+                     ('Exons covered', 'num_exons_covered'),
+                     ('Total number of evaluated alignments', 'num_evaluated_alignments'),
+                     ('Alignments on transcript hit', 'num_hit_alignments'),
+                     ('Alignments on transcript missed', 'num_missed_alignments'),
+                     ('Alignments on exons hit', 'num_exon_hit'),
+                     ('Alignments on exons missed', 'num_exon_miss'),
+                     ('Alignments with more than 50% bases within an annotation', 'num_halfbases_hit'),
+                     ('Alignments with low match count', 'num_lowmatchcnt'),
+                     ('Alignments hitting an exon start', 'num_good_starts'),
+                     ('Alignments hitting an exon end', 'num_good_ends'),
+                     ('Alignments hitting an exon start and end', 'num_equal_exons'),
+                     ('Alignments with a partial miss (not good)', 'num_partial_exon_miss'),
+                     ('Alignments with a partial miss ("almost" good)', 'num_almost_good'),
+                     ('Contiguous alignments', 'num_good_alignment'),
+                     ('Contiguous alignments (percent)', 'good_alignment_percent'),
+                     ('Non contiguous alignments', 'num_bad_alignment'),
+                     ('Non contiguous alignments (percent)', 'bad_alignment_percent'),
+                     ('Hit all', 'num_hit_all'),
+                     ('Hit all (percent)', 'hit_all_percent')]
+
+# Adds gene expression or coverage counters from one dictionary to another
+# (genename -> list of counters, one for the whole gene and one for each exon)
+def add_gene_counters(total, part):
+    for genename, counters in part.iteritems():
+        total_counters = total.get(genename)
+        if total_counters is None or len(total_counters) != len(counters):
+            total[genename] = list(counters)
+        else:
+            for i in xrange(len(counters)):
+                total_counters[i] += counters[i]
+
+
+# Returns a hashable description of a potential new annotation: chromosome, strand and exon positions
+# Potential new annotations with equal signatures are considered to be the same annotation
+def new_annotation_signature(annotation):
+    return (annotation.seqname, annotation.strand, annotation.itemsSignature())
+
+
+# Creates a report from partial results (see EvalReport.get_partial)
+# Lists are copied, so that the report can be merged with other reports without changing partial results
+def report_from_partial(partial):
+    report = EvalReport(partial['rtype'])
+    report.allowed_inacc = partial['allowed_inacc']
+    report.min_overlap = partial['min_overlap']
+    for name in MERGE_SUM_FIELDS + MERGE_MIN_FIELDS + MERGE_MAX_FIELDS:
+        if name in partial:
+            setattr(report, name, partial[name])
+    for name in QNAME_FIELDS:
+        if name in partial:
+            setattr(report, name, list(partial[name]))
+
+    report.expressed_genes = dict((genename, list(counters)) for genename, counters in partial['expressed_genes'].iteritems())
+    report.gene_coverage = dict((genename, list(counters)) for genename, counters in partial['gene_coverage'].iteritems())
+
+    for [seqname, strand, genename, source, items, readnames] in partial['pot_new_annotations']:
+        pna = Annotation_formats.GeneDescription()
+        pna.seqname = seqname
+        pna.strand = strand
+        pna.genename = genename
+        pna.source = source
+        pna.items = [Annotation_formats.GeneItem(start, end) for [start, end] in items]
+        pna.calcBoundsFromItems()
+        report.cna_readlist[new_annotation_signature(pna)] = list(readnames)
+        report.pot_new_annotations.append(pna)
+    report.alignments_with_pna = sum(len(readnames) for readnames in report.cna_readlist.itervalues())
+
+    return report
+
+
+# Returns a tab separated table comparing several mapping reports side by side
+# Each row contains one field (see COMPARISON_FIELDS), and each column one report
+def get_comparison_table(names, reports):
+    table = 'Metric\t%s\n' % '\t'.join(names)
+    for (description, field) in COMPARISON_FIELDS:
+        values = []
+        for report in reports:
+            value = getattr(report, field)
+            if isinstance(value, float):
+                values.append('%.2f' % value)
+            else:
+                values.append('%d' % value)
+        table += '%s\t%s\n' % (description, '\t'.join(values))
+    return table
+
+
 if __name__ == "__main__":
     pass;